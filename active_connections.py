@@ -2,7 +2,7 @@ import boto3
 from datetime import datetime, timedelta, timezone
 
 
-def get_active_connections(db_cluster_identifier, region='us-east-1'):
+def get_cluster_metric(db_cluster_identifier, metric_name, region='us-east-1', statistic='Average'):
     cloudwatch = boto3.client('cloudwatch', region_name=region)
 
     # Define the time range for the metric query
@@ -11,7 +11,7 @@ def get_active_connections(db_cluster_identifier, region='us-east-1'):
 
     response = cloudwatch.get_metric_statistics(
         Namespace='AWS/RDS',
-        MetricName='DatabaseConnections',
+        MetricName=metric_name,
         Dimensions=[
             {
                 'Name': 'DBClusterIdentifier',
@@ -21,20 +21,32 @@ def get_active_connections(db_cluster_identifier, region='us-east-1'):
         StartTime=start_time,
         EndTime=end_time,
         Period=60,  # 1-minute granularity
-        Statistics=['Average']
+        Statistics=[statistic]
     )
 
-    # Extract and return the average connections
+    # Sort datapoints by timestamp and return the latest one
     if 'Datapoints' in response and response['Datapoints']:
-        # Sort datapoints by timestamp and get the latest one
         latest_data = sorted(response['Datapoints'], key=lambda x: x['Timestamp'], reverse=True)[0]
-        return latest_data['Average']
-    else:
-        # No data points mean zero active connections
-        return 0
+        return latest_data[statistic]
+    return None
+
+
+def get_active_connections(db_cluster_identifier, region='us-east-1'):
+    active_connections = get_cluster_metric(db_cluster_identifier, 'DatabaseConnections', region)
+    # No data points mean zero active connections
+    return active_connections if active_connections is not None else 0
+
+
+def get_max_acu(db_cluster_identifier, region='us-east-1'):
+    rds = boto3.client('rds', region_name=region)
+    cluster = rds.describe_db_clusters(DBClusterIdentifier=db_cluster_identifier)['DBClusters'][0]
+    # Only Serverless v2 clusters have an ACU ceiling
+    scaling = cluster.get('ServerlessV2ScalingConfiguration')
+    return scaling['MaxCapacity'] if scaling else None
 
 
-db_cluster_identifier = 'your-cluster-identifier'
-region = 'us-east-1'
-active_connections = get_active_connections(db_cluster_identifier, region)
-print(f"Active connections: {active_connections}")
+if __name__ == '__main__':
+    db_cluster_identifier = 'your-cluster-identifier'
+    region = 'us-east-1'
+    active_connections = get_active_connections(db_cluster_identifier, region)
+    print(f"Active connections: {active_connections}")
@@ -0,0 +1,203 @@
+import threading
+import time
+
+import psycopg
+
+from active_connections import get_active_connections, get_cluster_metric, get_max_acu
+
+# Instead of a fixed max_workers, the ingest runs up to an upper bound of
+# workers and a controller decides how many of them may be active.  Every
+# interval it compares client-side rows/sec and insert latency with DB-side
+# signals, and then either:
+#   - backs off sharply when the database is near its connection limit,
+#     near its ACU ceiling, or commit/insert latency has spiked;
+#   - grows by a step while throughput improves by more than `improvement`,
+#     and holds when it is flat;
+#   - undoes the last step when growing made throughput worse.
+
+
+class ConcurrencyLimiter:
+    """
+    A semaphore whose limit can change while workers are waiting on it.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+class CloudWatchMetrics:
+    """
+    DB-side signals from the Aurora cluster's CloudWatch metrics (1 minute granularity).
+    The limits are required, since the connection and ACU back-off compare against them;
+    for_cluster reads them from the cluster.
+
+    :param max_connections: the database's max_connections.
+    :param max_acu: the Serverless v2 MaxCapacity, or None for a provisioned cluster.
+    """
+
+    def __init__(self, db_cluster_identifier, max_connections, max_acu, region='us-east-1'):
+        self.db_cluster_identifier = db_cluster_identifier
+        self.region = region
+        self.max_connections = max_connections
+        self.max_acu = max_acu
+
+    @classmethod
+    def for_cluster(cls, db_cluster_identifier, conn_params, region='us-east-1'):
+        """
+        Reads max_connections from the database and max_acu from the cluster's scaling configuration.
+        """
+        with psycopg.connect(**conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SHOW max_connections;")
+                max_connections = int(cur.fetchone()[0])
+        return cls(db_cluster_identifier, max_connections, get_max_acu(db_cluster_identifier, region), region)
+
+    def sample(self):
+        return {
+            "connections": get_active_connections(self.db_cluster_identifier, self.region),
+            "max_connections": self.max_connections,
+            "acu": get_cluster_metric(self.db_cluster_identifier, 'ServerlessDatabaseCapacity', self.region),
+            "max_acu": self.max_acu,
+            "commit_latency_ms": get_cluster_metric(self.db_cluster_identifier, 'CommitLatency', self.region),
+        }
+
+
+class PgStatActivityMetrics:
+    """
+    DB-side signals read from pg_stat_activity, for when CloudWatch is not available
+    (for example against a local Postgres).
+    """
+
+    def __init__(self, conn_params):
+        self.conn_params = conn_params
+
+    def sample(self):
+        with psycopg.connect(**self.conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT COUNT(*) FROM pg_stat_activity WHERE backend_type = 'client backend';")
+                connections = cur.fetchone()[0]
+                cur.execute("SHOW max_connections;")
+                max_connections = int(cur.fetchone()[0])
+        return {"connections": connections, "max_connections": max_connections}
+
+
+class AdaptiveController:
+    """
+    Adjusts how many ingest workers may run at once.  Workers enter controller.limiter
+    around each batch and report every database write with record_batch.
+
+    :param metrics: object whose sample() returns a dict with any of connections,
+        max_connections, acu, max_acu and commit_latency_ms; missing values are ignored.
+    :param initial_workers: active workers at the start of the run.
+    :param min_workers: never go below this many active workers.
+    :param max_workers: never go above this many; size the thread and connection pools to it.
+    :param interval: seconds between decisions.
+    :param step: workers added per increase.
+    :param connection_headroom: back off above this fraction of max_connections (or max_acu).
+    :param latency_limit: back off when p90 insert latency or commit latency (seconds) exceeds it.
+    :param improvement: grow only when rows/sec rose by more than this fraction since the last interval.
+    """
+
+    def __init__(self, metrics, initial_workers=4, min_workers=1, max_workers=32, interval=30, step=2,
+                 connection_headroom=0.8, latency_limit=10.0, improvement=0.05):
+        self.metrics = metrics
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.step = step
+        self.connection_headroom = connection_headroom
+        self.latency_limit = latency_limit
+        self.improvement = improvement
+        self.limiter = ConcurrencyLimiter(max(min_workers, min(initial_workers, max_workers)))
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.latencies = []
+        self.previous_rate = None
+        self.last_change = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="adaptive-controller", daemon=True)
+
+    def record_batch(self, rows, seconds):
+        with self.lock:
+            self.rows += rows
+            self.latencies.append(seconds)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        last_tick = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            with self.lock:
+                rows, latencies = self.rows, sorted(self.latencies)
+                self.rows, self.latencies = 0, []
+            rate = rows / (now - last_tick)
+            last_tick = now
+            p90 = latencies[int(len(latencies) * 0.9)] if latencies else None
+            try:
+                sample = self.metrics.sample()
+            except Exception as e:
+                print(f"Error sampling database metrics: {e}")
+                sample = {}
+            self.set_workers(self.decide(rate, p90, sample), rate, p90, sample)
+
+    def overloaded(self, p90, sample):
+        connections, max_connections = sample.get("connections"), sample.get("max_connections")
+        if connections is not None and max_connections and connections >= max_connections * self.connection_headroom:
+            return True
+        acu, max_acu = sample.get("acu"), sample.get("max_acu")
+        if acu is not None and max_acu and acu >= max_acu * self.connection_headroom:
+            return True
+        commit_latency = sample.get("commit_latency_ms")
+        if commit_latency is not None and commit_latency / 1000 > self.latency_limit:
+            return True
+        return p90 is not None and p90 > self.latency_limit
+
+    def decide(self, rate, p90, sample):
+        workers = self.limiter.limit
+        if self.overloaded(p90, sample):
+            self.previous_rate = rate
+            self.last_change = 0
+            return int(workers * 0.75)
+        previous, self.previous_rate = self.previous_rate, rate
+        # A plateau is not an improvement, so concurrency does not creep up to max_workers on it
+        if previous is None or rate > previous * (1 + self.improvement):
+            self.last_change = self.step
+            return workers + self.step
+        if self.last_change > 0 and rate < previous * 0.9:
+            # The last increase cost throughput, so take it back
+            self.last_change = -self.last_change
+            return workers + self.last_change
+        self.last_change = 0
+        return workers
+
+    def set_workers(self, workers, rate, p90, sample):
+        workers = max(self.min_workers, min(self.max_workers, workers))
+        p90_text = f"{p90:.2f}s" if p90 is not None else "n/a"
+        print(f"Adaptive: {rate:.0f} rows/s, p90 insert {p90_text}, db {sample}, "
+              f"workers {self.limiter.limit} -> {workers}")
+        self.limiter.set_limit(workers)
@@ -0,0 +1,259 @@
+import asyncio
+import time
+
+from aiobotocore.session import get_session
+
+from entities import COMMENTS
+from metrics import (BATCHES_FAILED, BATCHES_OK, BYTES_FETCHED, FETCH_IN_FLIGHT, FETCH_SECONDS, KEYS_LISTED,
+                     KEYS_SKIPPED, LIST_SECONDS, OBJECTS_FETCHED, PARSE_BATCH_SECONDS, PARSE_IN_FLIGHT, QUEUE_DEPTH,
+                     errors)
+from parse_pool import parse_payloads
+from router import EntityRouter
+from s3_listing import ShardProgress, is_comment_key, normalize_prefix, shard_levels
+
+# Ingest is bound by S3 round-trip latency, so instead of one blocking GET per
+# key we keep hundreds of GETs in flight on a single event loop.  Finished
+# bodies are grouped into batches and handed to the parse stage as they land.
+
+
+async def list_comment_pages(client, bucket_name, prefix, since=None, accept=is_comment_key):
+    paginator = client.get_paginator('list_objects_v2')
+    started = time.perf_counter()
+    async for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        LIST_SECONDS.observe(time.perf_counter() - started)
+        keys = []
+        for obj in page.get('Contents', []):
+            if not accept(obj['Key']):
+                continue
+            KEYS_LISTED.inc()
+            if since and obj['LastModified'] < since:
+                KEYS_SKIPPED.inc()
+                continue
+            keys.append((obj['Key'], obj['ETag']))
+        yield keys
+        # The next page is requested when the loop resumes
+        started = time.perf_counter()
+
+
+async def list_comment_keys(client, bucket_name, prefix, since=None):
+    async for keys in list_comment_pages(client, bucket_name, prefix, since):
+        for key in keys:
+            yield key
+
+
+async def child_prefixes(client, bucket_name, prefix):
+    paginator = client.get_paginator('list_objects_v2')
+    prefixes = []
+    async for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+    return prefixes
+
+
+async def discover_shards(client, bucket_name, prefix):
+    # Same expansion as s3_listing.discover_shards, on the event loop
+    shards = [normalize_prefix(prefix)]
+    for _ in range(shard_levels(shards[0])):
+        children = await asyncio.gather(*(child_prefixes(client, bucket_name, shard) for shard in shards))
+        shards = [child for shard, found in zip(shards, children) for child in (found or [shard])]
+    return shards
+
+
+async def list_comment_pages_sharded(client, bucket_name, prefix, progress=None, since=None, max_listers=16,
+                                     accept=is_comment_key):
+    """
+    Yields the (key, etag) pairs of every listing page under a prefix as a list, listing up to
+    max_listers docket prefixes at once.  See s3_listing.list_comment_keys_sharded.
+    """
+    progress = progress or ShardProgress()
+    shards = await discover_shards(client, bucket_name, prefix)
+    progress.start(shards)
+    pending = iter(shards)
+    # Bounded, so listing only runs a little ahead of the GETs
+    pages = asyncio.Queue(maxsize=max_listers * 4)
+
+    async def lister():
+        try:
+            for shard in pending:
+                progress.begin(shard)
+                try:
+                    async for keys in list_comment_pages(client, bucket_name, shard, since, accept):
+                        progress.listed(shard, len(keys))
+                        await pages.put(keys)
+                except Exception as e:
+                    progress.finish(shard, e)
+                else:
+                    progress.finish(shard)
+        finally:
+            await pages.put(None)
+
+    listers = [asyncio.create_task(lister()) for _ in range(min(max_listers, len(shards)))]
+    try:
+        remaining = len(listers)
+        while remaining:
+            keys = await pages.get()
+            if keys is None:
+                remaining -= 1
+                continue
+            yield keys
+    finally:
+        for task in listers:
+            task.cancel()
+
+
+async def list_comment_keys_sharded(client, bucket_name, prefix, progress=None, since=None, max_listers=16,
+                                    accept=is_comment_key):
+    """
+    Yields (key, etag) for every comment under a prefix; see list_comment_pages_sharded.
+    """
+    async for keys in list_comment_pages_sharded(client, bucket_name, prefix, progress, since, max_listers, accept):
+        for key in keys:
+            yield key
+
+
+async def fetch_object(client, bucket_name, key, etag=None, cache=None):
+    with FETCH_IN_FLIGHT.track(), FETCH_SECONDS.time():
+        # Cache reads and writes are blocking file I/O, so they run off the event loop
+        body = await asyncio.to_thread(cache.get, bucket_name, key, etag) if cache else None
+        if body is None:
+            response = await client.get_object(Bucket=bucket_name, Key=key)
+            async with response['Body'] as stream:
+                body = await stream.read()
+            if cache:
+                await asyncio.to_thread(cache.put, bucket_name, key, response['ETag'], body)
+    OBJECTS_FETCHED.inc()
+    BYTES_FETCHED.inc(len(body))
+    return key, body
+
+
+async def fetch_and_ingest(bucket_name, prefix, write_rows, parse_pool=None, max_in_flight=256,
+                           batch_size=1000, max_writers=8, region='us-east-1', endpoint_url=None, checkpoint=None,
+                           since=None, max_listers=16, router=None, text_loader=None, cache=None, staging=False):
+    """
+    Lists, fetches and parses every comment under a prefix, calling write_rows for each batch.
+    Returns True if every object was fetched and every batch committed.
+
+    :param bucket_name: S3 bucket to read from.
+    :param prefix: key prefix to ingest (agency or docket folder, '' or '/' for the whole bucket).
+    :param write_rows: blocking callable taking a list of row tuples and their entities.Entity,
+        and returning True once they are committed; run in a thread.
+    :param parse_pool: executor for parse_payloads, or None to parse in the default thread pool.
+    :param max_in_flight: maximum number of concurrent GET requests.
+    :param batch_size: number of objects per parsed batch, unless the router sets one for the entity.
+    :param max_writers: maximum number of batches being parsed or written at once.
+    :param region: AWS region of the bucket.
+    :param endpoint_url: alternate S3 endpoint, e.g. a local moto server or MinIO.
+    :param checkpoint: optional CheckpointStore; finished keys are skipped and new ones recorded.
+    :param since: optional timezone-aware datetime; objects last modified before it are skipped.
+    :param max_listers: number of docket prefixes listed at once.
+    :param router: EntityRouter choosing which entities are ingested; defaults to comments only.
+        Every batch holds a single entity.
+    :param text_loader: attachment_text.TextLoader that the keys of its entity are handed to instead of
+        being fetched here; it streams them on threads of its own and records them in the checkpoint.
+    :param cache: optional s3_cache.ObjectCache to read objects from before GETting them; listed keys
+        and fetched objects are added to it.  An offline cache is not supported here.
+    :param staging: write_rows puts comments into the staging table, so their keys are checkpointed
+        as staged until it is merged.
+    """
+    router = router or EntityRouter(batch_size=batch_size)
+    loop = asyncio.get_running_loop()
+    get_slots = asyncio.Semaphore(max_in_flight)
+    write_slots = asyncio.Semaphore(max_writers)
+    fetches = set()
+    writes = set()
+    payloads = {entity.name: [] for entity in router.entities}
+    etags = {}
+    failures = 0
+    progress = ShardProgress()
+
+    async def write_batch(entity, batch):
+        nonlocal failures
+        try:
+            with PARSE_IN_FLIGHT.track(), PARSE_BATCH_SECONDS.time():
+                rows = await loop.run_in_executor(parse_pool, parse_payloads, batch, None, entity.name)
+            committed = await asyncio.to_thread(write_rows, rows, entity)
+            if not committed:
+                BATCHES_FAILED.inc()
+                failures += 1
+                return
+            BATCHES_OK.inc()
+            if checkpoint:
+                done = [(key, etags[key]) for key, _ in batch]
+                await asyncio.to_thread(checkpoint.mark_done, done, staging and entity is COMMENTS)
+        except Exception as e:
+            print(f"Error writing batch starting at {batch[0][0]}: {e}")
+            BATCHES_FAILED.inc()
+            failures += 1
+        finally:
+            # Kept until here either way, so a failed batch does not leave its ETags behind
+            for key, _ in batch:
+                etags.pop(key, None)
+            QUEUE_DEPTH.dec()
+            write_slots.release()
+
+    async def flush(full_only=True):
+        for entity in router.entities:
+            batch = payloads[entity.name]
+            if not batch or (full_only and len(batch) < router.batch_sizes[entity.name]):
+                continue
+            payloads[entity.name] = []
+            QUEUE_DEPTH.inc()
+            # Waiting for a write slot stops fetching from running ahead of the database
+            await write_slots.acquire()
+            task = asyncio.create_task(write_batch(entity, batch))
+            writes.add(task)
+            task.add_done_callback(writes.discard)
+
+    def fetched(task):
+        nonlocal failures
+        fetches.discard(task)
+        get_slots.release()
+        try:
+            key, body = task.result()
+            payloads[router.route(key).name].append((key, body))
+        except Exception as e:
+            print(f"Error processing file {task.get_name()}: {e}")
+            errors('fetch').inc()
+            failures += 1
+            etags.pop(task.get_name(), None)
+
+    session = get_session()
+    async with session.create_client('s3', region_name=region, endpoint_url=endpoint_url) as client:
+        async for keys in list_comment_pages_sharded(client, bucket_name, prefix, progress, since, max_listers,
+                                                     router.accepts):
+            # The checkpoint and cache are SQLite, so each page is looked up and recorded in one call off the loop
+            if cache:
+                await asyncio.to_thread(cache.record_page, bucket_name, keys)
+            if checkpoint:
+                listed = len(keys)
+                keys = await asyncio.to_thread(checkpoint.pending, keys)
+                KEYS_SKIPPED.inc(listed - len(keys))
+            for key, etag in keys:
+                if text_loader and router.entity_for(key) is text_loader.entity:
+                    router.route(key)
+                    # Blocks while the text pipeline is full, which holds the listing back with it
+                    if not await asyncio.to_thread(text_loader.add, (key, etag)):
+                        raise RuntimeError("text pipeline is not running")
+                    continue
+                if checkpoint:
+                    etags[key] = etag
+                await get_slots.acquire()
+                task = asyncio.create_task(fetch_object(client, bucket_name, key, etag, cache), name=key)
+                fetches.add(task)
+                task.add_done_callback(fetched)
+                await flush()
+
+        while fetches:
+            await asyncio.wait(set(fetches))
+            await flush()
+        await flush(full_only=False)
+        if writes:
+            await asyncio.wait(set(writes))
+    # Keys of a shard that failed to list were never fetched
+    return failures == 0 and not progress.failures
+
+
+def ingest_async(bucket_name, prefix, write_rows, **kwargs):
+    """
+    Synchronous wrapper around fetch_and_ingest for the ingest scripts.
+    """
+    return asyncio.run(fetch_and_ingest(bucket_name, prefix, write_rows, **kwargs))
@@ -0,0 +1,270 @@
+import codecs
+import hashlib
+import os
+import queue
+import tempfile
+import threading
+
+from psycopg.errors import Error
+
+from copy_loader import create_load_table, record_upsert
+from entities import COMMENT_TEXT
+from metrics import (BATCHES_FAILED, BATCHES_OK, BYTES_FETCHED, OBJECTS_FETCHED, ROWS_WRITTEN, errors, in_flight,
+                     stage_seconds)
+from pipeline import END, Pipeline
+
+# Text extracted from attachments holds most of what commenters wrote, and
+# some files are several MB, so it never goes through the JSON parse stage.
+# A fetch stage spools each object to a temporary file (kept in memory up to
+# SPOOL_SIZE) and a write stage streams the spools into a text COPY in
+# CHUNK_SIZE pieces, so no file is ever held in memory whole.  Both stages
+# have their own worker counts and run as a pipeline of their own, fed from
+# the same listing as the JSON through a bounded queue.
+
+CHUNK_SIZE = 1 << 20
+SPOOL_SIZE = 1 << 20
+
+# COPY text format escapes; Postgres text cannot hold NUL, so it is dropped
+ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\x00": None})
+
+TEXT_FETCH_SECONDS = stage_seconds("text_fetch")
+TEXT_WRITE_SECONDS = stage_seconds("text_write")
+TEXT_FETCH_IN_FLIGHT = in_flight("text_fetch")
+TEXT_WRITE_IN_FLIGHT = in_flight("text_write")
+
+
+def text_identity(path):
+    """
+    Splits the path of an extracted text file into its primary key.
+
+    <comment>_attachment_<n>_extracted.txt under comments_extracted_text/<extractor>/
+    gives (comment, 'attachment_<n>', extractor); extractor is '' for a file directly
+    in comments_extracted_text.
+    """
+    parts = path.replace(os.sep, "/").split("/")
+    name = parts[-1][:-len(COMMENT_TEXT.suffix)]
+    if name.endswith("_extracted"):
+        name = name[:-len("_extracted")]
+    # Comment ids are letters, digits and hyphens, so the first underscore ends the id
+    comment_id, _, attachment = name.partition("_")
+    extractor = parts[-2] if len(parts) > 1 and parts[-2] != COMMENT_TEXT.folder else ""
+    return comment_id, attachment, extractor
+
+
+def spool_object(s3, bucket_name, key):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        with TEXT_FETCH_IN_FLIGHT.track(), TEXT_FETCH_SECONDS.time():
+            body = s3.get_object(Bucket=bucket_name, Key=key)["Body"]
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                spool.write(chunk)
+                BYTES_FETCHED.inc(len(chunk))
+    except BaseException:
+        spool.close()
+        raise
+    OBJECTS_FETCHED.inc()
+    spool.seek(0)
+    return spool
+
+
+def open_cached(cache, s3, bucket_name, key, etag):
+    with TEXT_FETCH_IN_FLIGHT.track(), TEXT_FETCH_SECONDS.time():
+        file = cache.open(s3, bucket_name, key, etag)
+    OBJECTS_FETCHED.inc()
+    return file
+
+
+def fetch_text_batch(batch, s3, bucket_name, cache=None):
+    """
+    Fetch stage: spools every key of an (entity, keys_batch) batch, or opens it in an
+    s3_cache.ObjectCache, which is already on disk.  Returns (entity, keys_batch, fetched, files),
+    where files holds (key, file object) pairs for the write stage.
+    """
+    entity, keys_batch = batch
+    fetched = []
+    files = []
+    for key, etag in keys_batch:
+        try:
+            if cache:
+                files.append((key, open_cached(cache, s3, bucket_name, key, etag)))
+            else:
+                files.append((key, spool_object(s3, bucket_name, key)))
+            fetched.append((key, etag))
+        except Exception as e:
+            print(f"Error fetching text file {key}: {e}")
+            errors('text_fetch').inc()
+    return entity, keys_batch, fetched, files
+
+
+def open_text_batch(batch):
+    """
+    Fetch stage for the local mirror: opens every file of an (entity, files_batch) batch.
+    """
+    entity, files_batch = batch
+    fetched = []
+    files = []
+    for file_path, version in files_batch:
+        try:
+            files.append((file_path, open(file_path, "rb")))
+            fetched.append((file_path, version))
+        except OSError as e:
+            print(f"Error opening text file {file_path}: {e}")
+            errors('text_fetch').inc()
+    return entity, files_batch, fetched, files
+
+
+def copy_text(copy, key, file):
+    """
+    Writes one file as a row of a text COPY, reading it CHUNK_SIZE bytes at a time.
+    Invalid UTF-8 is replaced rather than failing the batch; the hash is over the raw bytes.
+    """
+    fields = (*text_identity(key), key)
+    copy.write("\t".join(field.translate(ESCAPES) for field in fields).encode("utf-8") + b"\t")
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    digest = hashlib.sha256()
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        copy.write(decoder.decode(chunk).translate(ESCAPES).encode("utf-8"))
+    tail = decoder.decode(b"", final=True).translate(ESCAPES)
+    copy.write(f"{tail}\t{digest.hexdigest()[:32]}\n".encode("utf-8"))
+
+
+def write_text_batch(batch, db_pool, checkpoint=None, entity=COMMENT_TEXT):
+    """
+    Write stage: streams the files of a batch into a temp table with one COPY, then
+    upserts them into comment_text, rewriting only files whose content hash changed.
+    """
+    _, keys_batch, fetched, files = batch
+    columns = ", ".join(entity.columns)
+    keys = ", ".join(entity.key_columns)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in entity.columns
+                        if column not in entity.key_columns)
+    committed = False
+    try:
+        with db_pool.connection() as conn:
+            try:
+                with TEXT_WRITE_IN_FLIGHT.track(), TEXT_WRITE_SECONDS.time(), conn.cursor() as cur:
+                    create_load_table(cur, entity)
+                    with cur.copy(f"COPY {entity.table}_load ({columns}) FROM STDIN") as copy:
+                        for key, file in files:
+                            copy_text(copy, key, file)
+                    cur.execute(f"""
+                    WITH merged AS (
+                        INSERT INTO {entity.table} AS existing ({columns})
+                        SELECT DISTINCT ON ({keys}) {columns} FROM {entity.table}_load
+                        ON CONFLICT ({keys}) DO UPDATE SET {updates}
+                        WHERE existing.contentHash IS DISTINCT FROM EXCLUDED.contentHash
+                        RETURNING (xmax = 0) AS inserted
+                    )
+                    SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted)
+                    FROM merged;
+                    """)
+                    inserted, updated = cur.fetchone()
+                conn.commit()
+                committed = True
+                outcome = record_upsert('update', len(files), inserted, updated, entity)
+                print(f"Copied {len(files)} text files into {entity.table}: {outcome}.")
+            except Error as e:
+                print(f"Error copying text files: {e}")
+                conn.rollback()
+    finally:
+        for _, file in files:
+            file.close()
+    if committed:
+        ROWS_WRITTEN.inc(len(files))
+        if checkpoint:
+            checkpoint.mark_done(fetched)
+    else:
+        errors('text_write').inc()
+    complete = committed and len(fetched) == len(keys_batch)
+    (BATCHES_OK if complete else BATCHES_FAILED).inc()
+    return complete
+
+
+class TextLoader:
+    """
+    Runs the text fetch and write stages as a pipeline of their own, in a background
+    thread, fed batches from the main listing.
+
+    :param stages: list of pipeline.Stage, e.g. a fetch stage and a write stage.
+    :param batch_size: files per batch for add().
+    :param queue_size: batches waiting for the fetch stage before put() blocks the listing.
+    :param fatal: exception types that stop the text pipeline.
+    """
+
+    entity = COMMENT_TEXT
+
+    def __init__(self, stages, batch_size=50, queue_size=4, fatal=()):
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = []
+        self.pipeline = Pipeline(self.batches(), stages, fatal)
+        self.thread = None
+        self.complete = False
+        self.error = None
+
+    def batches(self):
+        while True:
+            batch = self.queue.get()
+            if batch is END:
+                return
+            yield batch
+
+    def run(self):
+        try:
+            self.complete = self.pipeline.run()
+        except BaseException as e:
+            self.error = e
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="text-pipeline", daemon=True)
+        self.thread.start()
+        return self
+
+    def put(self, batch):
+        """
+        Hands an (entity, batch) pair to the text pipeline, blocking while it is full.
+        Returns False if the text pipeline has stopped.
+        """
+        while self.thread.is_alive():
+            try:
+                self.queue.put(batch, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def add(self, item):
+        """
+        Adds one (key, etag) or (path, version) pair, handing on a batch when it is full.
+        """
+        self.pending.append(item)
+        if len(self.pending) < self.batch_size:
+            return True
+        batch, self.pending = self.pending, []
+        return self.put((self.entity, batch))
+
+    def close(self, abort=False):
+        """
+        Sends the last batch and waits for the text pipeline to finish.
+
+        :param abort: stop without finishing the queued batches, e.g. after the main pipeline failed.
+        :return: True if every text batch committed.
+        :raises: the text pipeline's fatal error.
+        """
+        if abort:
+            self.pipeline.stop()
+        elif self.pending:
+            self.put((self.entity, self.pending))
+            self.pending = []
+        self.put(END)
+        while self.thread.is_alive():
+            self.thread.join(timeout=0.5)
+        if abort:
+            return False
+        if self.error is not None:
+            raise self.error
+        return self.complete
@@ -0,0 +1,219 @@
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import time
+
+import psycopg
+from psycopg.conninfo import conninfo_to_dict
+
+from benchmarks.corpus import generate_corpus, upload_corpus
+
+# End-to-end benchmark of the ingest strategies against a local S3 stand-in
+# (moto_server or MinIO) and a local Postgres.  Every configuration runs in a
+# fresh process on an empty comments table, so peak RSS belongs to that run
+# alone.  Each run loads through the staging table and publishes it with a
+# swap, as a full reload of the scripts would.
+#
+#   one_at_a_time     ingest_comments_one_at_a_time.py, one INSERT per object
+#   batched           ingest_comments.py, sequential batches
+#   concurrent        ingest_comments_concurrent.py, per fetcher
+#   concurrent_local  ingest_comments_concurrent_local.py, from the corpus directory
+#
+# Batch latency is the time of one call to the function named in latency_of:
+# a single INSERT or one batch write.
+
+STRATEGIES = ("one_at_a_time", "batched", "concurrent", "concurrent_local")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def timed(function, latencies):
+    # Wraps a module-level function so every call's duration is recorded
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+    return wrapper
+
+
+def reset_tables(module, conn_params):
+    from staging_load import create_staging_table
+
+    with psycopg.connect(**conn_params) as conn:
+        conn.execute("DROP TABLE IF EXISTS comments, comments_staging, comments_swap;")
+        conn.commit()
+        module.create_comments_table(conn)
+        create_staging_table(conn, reset=True)
+
+
+def run_strategy(config, conn_params, latencies):
+    """
+    Runs one configuration and returns the name of the timed function.
+    """
+    from staging_load import STAGING_TABLE, finish_staging
+
+    strategy = config["strategy"]
+    if strategy == "one_at_a_time":
+        import ingest_comments_one_at_a_time as module
+        reset_tables(module, conn_params)
+        module.execute_query = timed(module.execute_query, latencies)
+        with psycopg.connect(**conn_params) as conn:
+            module.ingest_comments(config["bucket"], config["prefix"], conn, STAGING_TABLE)
+            finish_staging(conn, full_reload=True)
+        return "execute_query"
+    if strategy == "batched":
+        import ingest_comments as module
+        reset_tables(module, conn_params)
+        module.batch_insert_records = timed(module.batch_insert_records, latencies)
+        with psycopg.connect(**conn_params) as conn:
+            module.ingest_comments(config["bucket"], config["prefix"], conn, config["loader"], STAGING_TABLE,
+                                   config["batch_size"])
+            finish_staging(conn, full_reload=True)
+        return "batch_insert_records"
+    if strategy == "concurrent":
+        import ingest_comments_concurrent as module
+        reset_tables(module, conn_params)
+        module.insert_rows = timed(module.insert_rows, latencies)
+        module.ingest_comments(config["bucket"], config["prefix"], conn_params, config["workers"], config["loader"],
+                               config["parser_processes"], config["fetcher"], config["max_in_flight"],
+                               table=STAGING_TABLE, batch_size=config["batch_size"])
+        with psycopg.connect(**conn_params) as conn:
+            finish_staging(conn, full_reload=True)
+        return "insert_rows"
+    if strategy == "concurrent_local":
+        import ingest_comments_concurrent_local as module
+        reset_tables(module, conn_params)
+        module.write_batch = timed(module.write_batch, latencies)
+        module.ingest_comments(config["corpus"], conn_params, config["workers"], config["loader"],
+                               config["parser_processes"], table=STAGING_TABLE, batch_size=config["batch_size"])
+        with psycopg.connect(**conn_params) as conn:
+            finish_staging(conn, full_reload=True)
+        return "write_batch"
+    raise ValueError(f"Unknown strategy '{strategy}'")
+
+
+def run_in_child(config, conn_params, results, verbose=False):
+    latencies = []
+    started = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if not verbose:
+            # The scripts print every key; keep that off the terminal
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+        try:
+            latency_of = run_strategy(config, conn_params, latencies)
+        except Exception as e:
+            # Report the failure instead of leaving the parent waiting on the queue
+            results.put({**config, "error": str(e)})
+            return
+    elapsed = time.perf_counter() - started
+    with psycopg.connect(**conn_params) as conn:
+        rows = conn.execute("SELECT COUNT(*) FROM comments;").fetchone()[0]
+    # ru_maxrss is in kilobytes on Linux; parser processes are reported separately
+    results.put({
+        **config,
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_second": rows / elapsed if elapsed else None,
+        "batches": len(latencies),
+        "latency_of": latency_of,
+        "p50_batch_seconds": percentile(latencies, 0.5),
+        "p99_batch_seconds": percentile(latencies, 0.99),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    })
+
+
+def configurations(args):
+    base = {"bucket": args.bucket, "prefix": args.prefix, "corpus": args.corpus, "loader": args.loader,
+            "parser_processes": args.parser_processes, "max_in_flight": args.max_in_flight}
+    for strategy in args.strategies:
+        if strategy == "one_at_a_time":
+            # Neither workers nor batch size apply to one INSERT per object
+            yield {**base, "strategy": strategy, "workers": 1, "batch_size": 1, "fetcher": None}
+        elif strategy == "batched":
+            for batch_size in args.batch_sizes:
+                yield {**base, "strategy": strategy, "workers": 1, "batch_size": batch_size, "fetcher": None}
+        else:
+            fetchers = args.fetchers if strategy == "concurrent" else [None]
+            for fetcher, workers, batch_size in itertools.product(fetchers, args.workers, args.batch_sizes):
+                yield {**base, "strategy": strategy, "workers": workers, "batch_size": batch_size,
+                       "fetcher": fetcher}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput of each ingest strategy")
+    parser.add_argument('--corpus', required=True, help="corpus directory, generated if it does not exist")
+    parser.add_argument('--comments', type=int, default=10000, help="size of a generated corpus")
+    parser.add_argument('--bucket', default='mirrulations-bench')
+    parser.add_argument('--prefix', default='')
+    parser.add_argument('--endpoint-url', default='http://localhost:5000',
+                        help="local S3 stand-in, e.g. moto_server or MinIO")
+    parser.add_argument('--upload', action='store_true', help="upload the corpus to the bucket first")
+    parser.add_argument('--dsn', default='host=localhost dbname=postgres user=postgres',
+                        help="connection string of a local Postgres; its comments table is dropped")
+    parser.add_argument('--strategies', nargs='+', choices=STRATEGIES, default=list(STRATEGIES))
+    parser.add_argument('--workers', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--fetchers', nargs='+', choices=['threads', 'async'], default=['threads', 'async'])
+    parser.add_argument('--loader', choices=['copy', 'executemany'], default='copy')
+    parser.add_argument('--parser-processes', type=int, default=None)
+    parser.add_argument('--max-in-flight', type=int, default=256)
+    parser.add_argument('--output', default='bench_ingest_results.json')
+    parser.add_argument('--verbose', action='store_true', help="show the scripts' own output")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.corpus):
+        generate_corpus(args.corpus, comments=args.comments)
+        args.upload = True
+    if args.upload:
+        upload_corpus(args.corpus, args.bucket, args.endpoint_url)
+
+    # The scripts build their own S3 clients; botocore reads the endpoint from the environment
+    os.environ["AWS_ENDPOINT_URL_S3"] = args.endpoint_url
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    conn_params = conninfo_to_dict(args.dsn)
+
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for config in configurations(args):
+        queue = context.Queue()
+        child = context.Process(target=run_in_child, args=(config, conn_params, queue, args.verbose))
+        child.start()
+        result = queue.get()
+        child.join()
+        results.append(result)
+        if "error" in result:
+            print(f"{result['strategy']:>16} failed: {result['error']}")
+            continue
+        p50, p99 = result["p50_batch_seconds"] or 0, result["p99_batch_seconds"] or 0
+        print(f"{result['strategy']:>16} {str(result['fetcher'] or ''):>7} workers={result['workers']:<3} "
+              f"batch={result['batch_size']:<5} {result['rows_per_second']:9.0f} rows/s  "
+              f"p50 {p50 * 1000:8.1f} ms  p99 {p99 * 1000:8.1f} ms  "
+              f"rss {result['peak_rss_mb']:7.1f} MB (+{result['peak_child_rss_mb']:.1f} MB parsers)")
+
+    with open(args.output, 'w') as file:
+        json.dump({
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+            "results": results,
+        }, file, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import argparse
+import random
+import time
+
+from benchmarks.corpus import make_comment_json
+from copy_loader import record_to_row
+from entities import parse_json_to_record
+from json_backends import BACKENDS, parse_to_row
+
+# Microbenchmark of the parse stage: the original dict path against each
+# installed backend's bytes-to-row path, over payloads sized like real
+# regulations.gov comment documents.
+
+
+def baseline(payload):
+    return record_to_row(parse_json_to_record(payload.decode('utf-8')))
+
+
+def time_per_record(parse, payloads, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for payload in payloads:
+            parse(payload)
+        best = min(best, time.perf_counter() - start)
+    return best / len(payloads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-record cost of each JSON parse backend")
+    parser.add_argument('--records', type=int, default=5000)
+    parser.add_argument('--comment-words', type=int, default=400)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    payloads = [make_comment_json(i, args.comment_words) for i in range(args.records)]
+    size = sum(len(payload) for payload in payloads) / len(payloads)
+    print(f"{args.records} records, {size:.0f} bytes on average")
+
+    base = time_per_record(baseline, payloads, args.repeat)
+    print(f"{'dict (original)':>16}: {base * 1e6:8.2f} us/record")
+    for name, backend in BACKENDS.items():
+        cost = time_per_record(lambda payload: parse_to_row(payload, backend), payloads, args.repeat)
+        print(f"{name:>16}: {cost * 1e6:8.2f} us/record  {base / cost:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import platform
+import time
+
+import psycopg
+from psycopg.conninfo import conninfo_to_dict
+
+from benchmarks.bench_ingest import percentile
+from benchmarks.corpus import AGENCIES, ORGANIZATIONS
+from entities import COMMENTS, create_entity_table
+from queries import LISTINGS, RESULT_COLUMNS, create_read_indexes, list_comments
+
+# Latency of the keyset-paginated listings in queries.py on a synthetic
+# multi-million-row comments table, next to the OFFSET pagination they
+# replace.  The table is generated inside Postgres with generate_series, so a
+# few million rows take seconds rather than a JSON corpus of that size.
+# Docket sizes are skewed (a few dockets hold most comments), about a fifth of
+# comments have an organization and 1% have no postedDate.
+#
+# Every listing is paged --pages deep, timing each page; OFFSET queries are
+# timed at the same depths.  A listing passes when its keyset p99 is under
+# --target-ms.
+
+
+def generate_table(conn, rows, dockets, seed):
+    """
+    Recreates comments with synthetic rows and returns the largest docket, agency and organization.
+    """
+    conn.execute("DROP TABLE IF EXISTS comments;")
+    conn.commit()
+    create_entity_table(conn, COMMENTS)
+    agencies = "ARRAY[" + ", ".join(f"'{agency}'" for agency in AGENCIES) + "]"
+    organizations = "ARRAY[" + ", ".join(f"'{organization}'" for organization in ORGANIZATIONS) + "]"
+    conn.execute("SELECT setseed(%s);", (seed,))
+    conn.execute(f"""
+    INSERT INTO comments (id, apiurl, docketId, agencyId, organization, title, postedDate, comment)
+    SELECT docket || '-' || lpad(n::text, 8, '0'),
+           'https://api.regulations.gov/v4/comments/' || docket || '-' || lpad(n::text, 8, '0'),
+           docket, agency,
+           CASE WHEN random() < 0.2 THEN ({organizations})[1 + floor(random() * {len(ORGANIZATIONS)})::int] END,
+           'Comment from Doe, Jane',
+           CASE WHEN random() >= 0.01
+                THEN timestamp '2015-01-01' + random() * interval '3650 days' END,
+           'See attached file(s)'
+    FROM (
+        SELECT n, agency, agency || '-' || (2015 + d % 10) || '-' || lpad(d::text, 4, '0') AS docket
+        FROM (
+            SELECT n, d, ({agencies})[1 + d % {len(AGENCIES)}] AS agency
+            FROM (SELECT n, floor(power(random(), 3) * %s)::int AS d FROM generate_series(1, %s) AS n) drawn
+        ) named
+    ) generated;
+    """, (dockets, rows))
+    conn.commit()
+    largest = {}
+    for listing, (column, _) in LISTINGS.items():
+        largest[listing] = conn.execute(f"""
+        SELECT {column} FROM comments WHERE {column} IS NOT NULL
+        GROUP BY {column} ORDER BY COUNT(*) DESC LIMIT 1;
+        """).fetchone()[0]
+    conn.commit()
+    return largest
+
+
+def offset_page(conn, column, value, limit, offset):
+    conn.execute(f"""
+    SELECT {", ".join(RESULT_COLUMNS)} FROM comments WHERE {column} = %s
+    ORDER BY postedDate, id LIMIT %s OFFSET %s;
+    """, (value, limit, offset)).fetchall()
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of the keyset-paginated read queries")
+    parser.add_argument('--dsn', default='host=localhost dbname=postgres user=postgres',
+                        help="connection string of a local Postgres; its comments table is dropped")
+    parser.add_argument('--rows', type=int, default=3_000_000)
+    parser.add_argument('--dockets', type=int, default=2000)
+    parser.add_argument('--seed', type=float, default=0.42, help="setseed value, between -1 and 1")
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=200, help="pages read per listing")
+    parser.add_argument('--target-ms', type=float, default=20.0, help="p99 latency a keyset page must stay under")
+    parser.add_argument('--output', default='bench_queries_results.json')
+    args = parser.parse_args()
+
+    results = []
+    with psycopg.connect(**conninfo_to_dict(args.dsn)) as conn:
+        started = time.perf_counter()
+        largest = generate_table(conn, args.rows, args.dockets, args.seed)
+        print(f"Generated {args.rows} comments in {time.perf_counter() - started:.1f}s.")
+        started = time.perf_counter()
+        create_read_indexes(conn)
+        index_seconds = time.perf_counter() - started
+        print(f"Built the covering indexes in {index_seconds:.1f}s.")
+
+        for listing, (column, _) in LISTINGS.items():
+            value = largest[listing]
+            keyset = []
+            cursor = None
+            for page in range(args.pages):
+                started = time.perf_counter()
+                _, cursor = list_comments(conn, listing, value, args.page_size, cursor)
+                keyset.append(time.perf_counter() - started)
+                if cursor is None:
+                    break
+            offset = []
+            for page in range(len(keyset)):
+                started = time.perf_counter()
+                offset_page(conn, column, value, args.page_size, page * args.page_size)
+                offset.append(time.perf_counter() - started)
+            for method, latencies in (("keyset", keyset), ("offset", offset)):
+                p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+                passed = p99 * 1000 <= args.target_ms
+                verdict = ("pass" if passed else "FAIL") if method == "keyset" else ""
+                print(f"{listing:>12} {method:>6} {len(latencies):4} pages  p50 {p50 * 1000:8.2f} ms  "
+                      f"p99 {p99 * 1000:8.2f} ms  last {latencies[-1] * 1000:8.2f} ms  {verdict}")
+                results.append({"listing": listing, "value": value, "method": method, "pages": len(latencies),
+                                "p50_seconds": p50, "p99_seconds": p99, "last_page_seconds": latencies[-1],
+                                "within_target": passed})
+
+    with open(args.output, 'w') as file:
+        json.dump({
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+            "index_seconds": index_seconds,
+            "results": results,
+        }, file, indent=2, default=str)
+    print(f"Wrote {len(results)} results to {args.output}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import platform
+import random
+import time
+
+import psycopg
+from psycopg.conninfo import conninfo_to_dict
+
+from benchmarks.bench_ingest import percentile
+from benchmarks.corpus import AGENCIES, comment_words, docket_sizes, make_comment_json
+from copy_loader import copy_insert_rows, record_to_row
+from entities import COMMENTS, create_entity_table, parse_json_to_record
+from rollups import create_rollup_tables
+from search import create_search_index, search_comments
+
+# Ranked full-text search (search.py) against the ILIKE scan analysts run
+# today, on a synthetic comments table in a local Postgres.
+#
+# The corpus vocabulary is small, so every long comment contains the common
+# words; a few rare terms are mixed into a fraction of the comments to give
+# queries with realistic selectivity.  Each query runs unscoped, scoped to an
+# agency and scoped to the largest docket.  For search, the first page and a
+# page reached by following the keyset cursor are timed separately.
+
+RARE_WORDS = ("glyphosate", "apprenticeship", "telework", "paystub", "crosswalk")
+
+QUERIES = ("overtime", "telework", "paystub exemption", '"small business" -oppose')
+
+
+def load_comments(conn, comments, dockets, median_words, seed, batch_size=5000):
+    """
+    Recreates comments with synthetic rows and returns the docket ids with their sizes.
+    """
+    rng = random.Random(seed)
+    conn.execute("DROP TABLE IF EXISTS comments;")
+    conn.commit()
+    create_entity_table(conn, COMMENTS)
+    create_rollup_tables(conn)
+    docket_ids = [f"{AGENCIES[d % len(AGENCIES)]}-{2015 + d % 10}-{d + 1:04d}" for d in range(dockets)]
+    sizes = docket_sizes(rng, dockets, comments)
+    rows = []
+    for docket_id, count in zip(docket_ids, sizes):
+        for index in range(count):
+            record = parse_json_to_record(make_comment_json(index + 2, comment_words(rng, median_words), docket_id,
+                                                            rng))
+            if rng.random() < 0.02:
+                record["comment"] += " " + rng.choice(RARE_WORDS)
+            rows.append(record_to_row(record))
+            if len(rows) == batch_size:
+                copy_insert_rows(rows, conn)
+                rows = []
+    copy_insert_rows(rows, conn)
+    conn.execute("ANALYZE comments;")
+    conn.commit()
+    return dict(zip(docket_ids, sizes))
+
+
+def ilike_terms(text):
+    # The baseline matches each plain word anywhere in the three columns
+    return [word for word in text.replace('"', '').split() if not word.startswith('-')]
+
+
+def ilike_search(conn, text, docket_id=None, agency_id=None, limit=20):
+    conditions = []
+    params = []
+    for word in ilike_terms(text):
+        conditions.append("(comment ILIKE %s OR title ILIKE %s OR organization ILIKE %s)")
+        params += [f"%{word}%"] * 3
+    if docket_id is not None:
+        conditions.append("docketId = %s")
+        params.append(docket_id)
+    if agency_id is not None:
+        conditions.append("agencyId = %s")
+        params.append(agency_id)
+    query = f"SELECT id FROM comments WHERE {' AND '.join(conditions)} ORDER BY id LIMIT %s;"
+    rows = conn.execute(query, [*params, limit]).fetchall()
+    conn.commit()
+    return rows
+
+
+def time_calls(function, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def deep_page(conn, text, docket_id, agency_id, pages):
+    # Follows the cursor to the given page and returns it, so only the last call is timed
+    cursor = None
+    for _ in range(pages - 1):
+        _, cursor = search_comments(conn, text, docket_id, agency_id, after=cursor)
+        if cursor is None:
+            return None
+    return cursor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ranked full-text search against ILIKE on a synthetic corpus")
+    parser.add_argument('--dsn', default='host=localhost dbname=postgres user=postgres',
+                        help="connection string of a local Postgres; its comments table is dropped")
+    parser.add_argument('--comments', type=int, default=100000)
+    parser.add_argument('--dockets', type=int, default=40)
+    parser.add_argument('--median-words', type=int, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20, help="timed runs of each query")
+    parser.add_argument('--page', type=int, default=5, help="page reached through the keyset cursor")
+    parser.add_argument('--queries', nargs='+', default=list(QUERIES))
+    parser.add_argument('--output', default='bench_search_results.json')
+    args = parser.parse_args()
+
+    results = []
+    with psycopg.connect(**conninfo_to_dict(args.dsn)) as conn:
+        started = time.perf_counter()
+        sizes = load_comments(conn, args.comments, args.dockets, args.median_words, args.seed)
+        print(f"Loaded {args.comments} comments in {time.perf_counter() - started:.1f}s.")
+        started = time.perf_counter()
+        create_search_index(conn)
+        index_seconds = time.perf_counter() - started
+        print(f"Added the search column and built its index in {index_seconds:.1f}s.")
+        conn.execute("ANALYZE comments;")
+        conn.commit()
+
+        largest = max(sizes, key=sizes.get)
+        scopes = {"all": (None, None), "agency": (None, largest.split("-")[0]), "docket": (largest, None)}
+        for text in args.queries:
+            for scope, (docket_id, agency_id) in scopes.items():
+                timings = {
+                    "ilike": time_calls(lambda: ilike_search(conn, text, docket_id, agency_id), args.repeat),
+                    "search": time_calls(lambda: search_comments(conn, text, docket_id, agency_id), args.repeat),
+                }
+                cursor = deep_page(conn, text, docket_id, agency_id, args.page)
+                if cursor is not None:
+                    timings[f"search_page_{args.page}"] = time_calls(
+                        lambda: search_comments(conn, text, docket_id, agency_id, after=cursor), args.repeat)
+                for method, latencies in timings.items():
+                    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+                    print(f"{text:>28} {scope:>6} {method:>14}  p50 {p50 * 1000:8.2f} ms  p99 {p99 * 1000:8.2f} ms")
+                    results.append({"query": text, "scope": scope, "method": method,
+                                    "p50_seconds": p50, "p99_seconds": p99})
+
+    with open(args.output, 'w') as file:
+        json.dump({
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+            "index_seconds": index_seconds,
+            "results": results,
+        }, file, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import random
+
+import boto3
+
+# Synthetic mirrulations corpus laid out like the bucket:
+#
+#   WHD/WHD-2023-0001/text-WHD-2023-0001/docket/WHD-2023-0001.json
+#   WHD/WHD-2023-0001/text-WHD-2023-0001/documents/WHD-2023-0001-0001.json
+#   WHD/WHD-2023-0001/text-WHD-2023-0001/comments/WHD-2023-0001-0002.json
+#
+# Field distributions follow what the real comments look like: most dockets
+# are small and a few are huge, most bodies are short with a long tail, many
+# only say "See attached", and organization, duplicateComments and withdrawn
+# are sparse.
+
+AGENCIES = ("WHD", "EPA", "FDA", "CMS", "OSHA", "FAA", "DOT", "IRS", "ED", "HHS", "USCIS", "FWS")
+
+WORDS = ("rule", "overtime", "employer", "worker", "wage", "hour", "exemption", "salary",
+         "threshold", "small", "business", "department", "comment", "proposed", "support", "oppose")
+
+CITIES = (("Chicago", "IL"), ("Denver", "CO"), ("Austin", "TX"), ("Portland", "OR"), ("Albany", "NY"))
+
+ORGANIZATIONS = ("Acme Staffing", "National Retail Federation", "Farm Workers Alliance", "Chamber of Commerce",
+                 "Legal Aid Society")
+
+
+def make_comment_json(index, comment_words=400, docket_id="WHD-2023-0001", rng=random):
+    """
+    Builds one comment document with the same shape as the mirrulations JSON.
+
+    :param index: number used to make the id unique within the docket.
+    :param comment_words: approximate length of the inline comment body; 0 gives "See attached file(s)".
+    :param docket_id: docket the comment belongs to; its first part is the agency.
+    :param rng: random.Random to draw optional fields from.
+    """
+    agency = docket_id.split("-")[0]
+    year = int(docket_id.split("-")[1]) if docket_id.split("-")[1].isdigit() else 2023
+    comment_id = f"{docket_id}-{index:07d}"
+    month, day = rng.randint(1, 12), rng.randint(1, 28)
+    city, state = rng.choice(CITIES + ((None, None),))
+    withdrawn = rng.random() < 0.01
+    comment = " ".join(rng.choice(WORDS) for _ in range(comment_words)) if comment_words else "See attached file(s)"
+    attributes = {
+        "commentOn": "09000064855fa5f1",
+        "commentOnDocumentId": f"{docket_id}-0001",
+        "duplicateComments": 0 if rng.random() < 0.95 else int(rng.paretovariate(1.2)),
+        "address1": None,
+        "address2": None,
+        "agencyId": agency,
+        "city": city,
+        "category": rng.choice(["Individual", "Individual", "Individual", "Business", "Nonprofit"]),
+        "comment": comment,
+        "country": "United States",
+        "displayProperties": [
+            {"name": "pageCount", "label": "Page Count", "tooltip": "Number of pages"},
+            {"name": "comment", "label": "Comment", "tooltip": "Comment text"},
+        ],
+        "docAbstract": None,
+        "docketId": docket_id,
+        "documentType": "Public Submission",
+        "email": None,
+        "fax": None,
+        "field1": None,
+        "field2": None,
+        "fileFormats": None,
+        "firstName": "Jane",
+        "govAgency": None,
+        "govAgencyType": None,
+        "objectId": f"0900006486{index:06x}",
+        "lastName": "Doe",
+        "legacyId": None,
+        "modifyDate": f"{year}-{month:02d}-{day:02d}T15:43:37Z",
+        "organization": rng.choice(ORGANIZATIONS) if rng.random() < 0.2 else None,
+        "originalDocumentId": None,
+        "pageCount": 1,
+        "phone": None,
+        "postedDate": f"{year}-{month:02d}-{day:02d}T04:00:00Z",
+        "postmarkDate": None,
+        "reasonWithdrawn": "Duplicate submission" if withdrawn else None,
+        "receiveDate": f"{year}-{month:02d}-{day:02d}T04:00:00Z",
+        "restrictReason": None,
+        "restrictReasonType": None,
+        "stateProvinceRegion": state,
+        "submitterRep": None,
+        "submitterRepAddress": None,
+        "submitterRepCityState": None,
+        "subtype": None,
+        "title": "Comment from Doe, Jane",
+        "trackingNbr": f"lmb-{index:04x}-abcd",
+        "withdrawn": withdrawn,
+        "zip": None,
+        "openForComment": False,
+    }
+    return json.dumps({
+        "data": {
+            "id": comment_id,
+            "type": "comments",
+            "links": {"self": f"https://api.regulations.gov/v4/comments/{comment_id}"},
+            "attributes": attributes,
+            "relationships": {"attachments": {"links": {"self": "", "related": ""}}},
+        }
+    }, indent=2).encode('utf-8')
+
+
+def make_docket_json(docket_id):
+    return json.dumps({
+        "data": {
+            "id": docket_id,
+            "type": "dockets",
+            "links": {"self": f"https://api.regulations.gov/v4/dockets/{docket_id}"},
+            "attributes": {
+                "agencyId": docket_id.split("-")[0],
+                "docketType": "Rulemaking",
+                "title": f"Proposed rule {docket_id}",
+                "modifyDate": "2023-11-08T15:43:37Z",
+            },
+        }
+    }, indent=2).encode('utf-8')
+
+
+def make_document_json(document_id, docket_id):
+    return json.dumps({
+        "data": {
+            "id": document_id,
+            "type": "documents",
+            "links": {"self": f"https://api.regulations.gov/v4/documents/{document_id}"},
+            "attributes": {
+                "agencyId": docket_id.split("-")[0],
+                "docketId": docket_id,
+                "documentType": "Proposed Rule",
+                "title": f"Proposed rule {docket_id}",
+                "postedDate": "2023-09-11T04:00:00Z",
+                "modifyDate": "2023-11-08T15:43:37Z",
+            },
+        }
+    }, indent=2).encode('utf-8')
+
+
+def comment_words(rng, median_words=120):
+    # About a third of comments only point at an attachment, the rest are log-normal
+    if rng.random() < 0.3:
+        return 0
+    return min(int(rng.lognormvariate(0, 1.0) * median_words), 20000)
+
+
+def docket_sizes(rng, dockets, comments):
+    # Pareto weights, so a few dockets hold most of the comments as in the real bucket
+    weights = [rng.paretovariate(1.1) for _ in range(dockets)]
+    total = sum(weights)
+    sizes = [max(1, int(comments * weight / total)) for weight in weights]
+    sizes[0] += max(0, comments - sum(sizes))
+    return sizes
+
+
+def write_file(path, payload):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(payload)
+
+
+def generate_corpus(output, agencies=4, dockets_per_agency=5, comments=10000, median_words=120, seed=0):
+    """
+    Writes a synthetic corpus under output.
+
+    :param output: directory to write into; it plays the role of the bucket root.
+    :param agencies: number of agency folders.
+    :param dockets_per_agency: number of docket folders in each agency.
+    :param comments: total number of comment files, spread unevenly over the dockets.
+    :param median_words: median length of a comment body that is not "See attached".
+    :param seed: seed for the random generator, so a corpus can be regenerated exactly.
+    :return: (files, bytes) written, counting only comment files.
+    """
+    rng = random.Random(seed)
+    dockets = [
+        f"{AGENCIES[a % len(AGENCIES)]}{a // len(AGENCIES) or ''}-{2015 + d % 10}-{d + 1:04d}"
+        for a in range(agencies) for d in range(dockets_per_agency)
+    ]
+    files = size = 0
+    for docket_id, count in zip(dockets, docket_sizes(rng, len(dockets), comments)):
+        agency = docket_id.split("-")[0]
+        base = os.path.join(output, agency, docket_id, f"text-{docket_id}")
+        write_file(os.path.join(base, "docket", f"{docket_id}.json"), make_docket_json(docket_id))
+        write_file(os.path.join(base, "documents", f"{docket_id}-0001.json"),
+                   make_document_json(f"{docket_id}-0001", docket_id))
+        for index in range(count):
+            payload = make_comment_json(index + 2, comment_words(rng, median_words), docket_id, rng)
+            write_file(os.path.join(base, "comments", f"{docket_id}-{index + 2:07d}.json"), payload)
+            files += 1
+            size += len(payload)
+    print(f"Wrote {files} comments ({size / 1e6:.1f} MB) in {len(dockets)} dockets to {output}.")
+    return files, size
+
+
+def upload_corpus(directory, bucket_name, endpoint_url=None, region='us-east-1', max_workers=32):
+    """
+    Uploads a generated corpus to a bucket, creating the bucket if needed.  Point endpoint_url
+    at a local S3 stand-in such as moto_server or MinIO.
+    """
+    s3 = boto3.client('s3', region_name=region, endpoint_url=endpoint_url)
+    try:
+        s3.create_bucket(Bucket=bucket_name)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    paths = [os.path.join(root, file) for root, _, files in os.walk(directory) for file in files]
+
+    def upload(path):
+        s3.upload_file(path, bucket_name, os.path.relpath(path, directory).replace(os.sep, "/"))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(upload, paths))
+    print(f"Uploaded {len(paths)} files to s3://{bucket_name}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic mirrulations corpus")
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--agencies', type=int, default=4)
+    parser.add_argument('--dockets', type=int, default=5, help="dockets per agency")
+    parser.add_argument('--comments', type=int, default=10000)
+    parser.add_argument('--median-words', type=int, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bucket', help="also upload the corpus to this bucket")
+    parser.add_argument('--endpoint-url', help="S3 endpoint, e.g. http://localhost:5000 for moto_server")
+    args = parser.parse_args()
+
+    generate_corpus(args.output, args.agencies, args.dockets, args.comments, args.median_words, args.seed)
+    if args.bucket:
+        upload_corpus(args.output, args.bucket, args.endpoint_url)
+
+
+if __name__ == '__main__':
+    main()
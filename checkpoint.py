@@ -0,0 +1,178 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+# Keys are only marked complete after the batch holding them has committed,
+# so a crashed worker or run leaves its keys unmarked and they are retried.
+#
+# Comments committed to the unlogged staging table are marked staged until
+# the table is merged.  A database crash or failover empties staging, so the
+# checkpoint also keeps the token of the staged rows (staging_load.staging_token);
+# when the token has changed, the staged keys were lost with the rows and are
+# forgotten, so they are ingested again.
+
+
+class CheckpointStore:
+    """
+    Persistent manifest of ingested objects and per-prefix delta watermarks, kept in a local SQLite file.
+
+    :param path: location of the SQLite file; created if missing.
+    :param source: bucket name or local directory the keys belong to.
+    """
+
+    def __init__(self, path='ingest_checkpoint.sqlite3', source='mirrulations'):
+        self.source = source
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS completed_keys (
+                source TEXT NOT NULL,
+                key TEXT NOT NULL,
+                etag TEXT,
+                completed_at TEXT NOT NULL,
+                PRIMARY KEY (source, key)
+            );
+            """)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(completed_keys);")]
+            if "staged" not in columns:
+                # Checkpoints written before staged keys were tracked
+                self.conn.execute("ALTER TABLE completed_keys ADD COLUMN staged INTEGER NOT NULL DEFAULT 0;")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS staging_tokens (
+                source TEXT PRIMARY KEY,
+                token TEXT NOT NULL
+            );
+            """)
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS watermarks (
+                source TEXT NOT NULL,
+                prefix TEXT NOT NULL,
+                last_modified TEXT NOT NULL,
+                PRIMARY KEY (source, prefix)
+            );
+            """)
+            self.conn.commit()
+
+    def get_watermark(self, prefix):
+        """
+        Returns the LastModified high-water mark of the last complete delta run of a prefix.
+
+        :return: timezone-aware datetime, or None if the prefix was never synced.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT last_modified FROM watermarks WHERE source = ? AND prefix = ?;",
+                (self.source, prefix)
+            ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def set_watermark(self, prefix, last_modified):
+        with self.lock:
+            self.conn.execute(
+                """
+                INSERT INTO watermarks (source, prefix, last_modified) VALUES (?, ?, ?)
+                ON CONFLICT (source, prefix) DO UPDATE SET last_modified = excluded.last_modified;
+                """,
+                (self.source, prefix, last_modified.isoformat())
+            )
+            self.conn.commit()
+
+    def is_done(self, key, etag=None):
+        """
+        Returns True if the key was ingested before with the same ETag.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag FROM completed_keys WHERE source = ? AND key = ?;",
+                (self.source, key)
+            ).fetchone()
+        return row is not None and row[0] == etag
+
+    def pending(self, items):
+        """
+        Returns the (key, etag) pairs not yet ingested with the same ETag, looking a whole
+        listing page up at once.
+        """
+        items = list(items)
+        done = {}
+        with self.lock:
+            # Kept under SQLite's default limit of 999 bound parameters per statement
+            for start in range(0, len(items), 900):
+                keys = [key for key, _ in items[start:start + 900]]
+                done.update(self.conn.execute(
+                    f"SELECT key, etag FROM completed_keys WHERE source = ? AND key IN ({', '.join('?' * len(keys))});",
+                    (self.source, *keys)
+                ).fetchall())
+        return [(key, etag) for key, etag in items if key not in done or done[key] != etag]
+
+    def mark_done(self, items, staged=False):
+        """
+        Records keys as ingested.
+
+        :param items: iterable of (key, etag) pairs from a committed batch.
+        :param staged: the batch was committed to the staging table, not yet merged.
+        """
+        completed_at = datetime.now(timezone.utc).isoformat()
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO completed_keys (source, key, etag, completed_at, staged) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (source, key) DO UPDATE SET etag = excluded.etag, completed_at = excluded.completed_at,
+                    staged = excluded.staged;
+                """,
+                [(self.source, key, etag, completed_at, int(staged)) for key, etag in items]
+            )
+            self.conn.commit()
+
+    def check_staging(self, token, merged=False):
+        """
+        Compares the token of the rows in staging with the one recorded.  If it changed, staging
+        was emptied since the keys were staged, and they are forgotten.  Call it before ingesting,
+        and with merged=True once staging has been merged, to mark the staged keys as merged.
+
+        :param token: staging_load.staging_token of the staging table.
+        :return: the number of staged keys forgotten.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT token FROM staging_tokens WHERE source = ?;", (self.source,)
+            ).fetchone()
+            lost = 0
+            if row is not None and row[0] != token:
+                lost = self.conn.execute(
+                    "DELETE FROM completed_keys WHERE source = ? AND staged = 1;", (self.source,)
+                ).rowcount
+            elif merged:
+                self.conn.execute("UPDATE completed_keys SET staged = 0 WHERE source = ? AND staged = 1;",
+                                  (self.source,))
+            self.conn.execute(
+                """
+                INSERT INTO staging_tokens (source, token) VALUES (?, ?)
+                ON CONFLICT (source) DO UPDATE SET token = excluded.token;
+                """,
+                (self.source, token)
+            )
+            self.conn.commit()
+        return lost
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM completed_keys WHERE source = ?;", (self.source,)
+            ).fetchone()[0]
+
+    def clear(self):
+        """
+        Forgets every key and watermark for this source, used when a run starts from an empty table.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM completed_keys WHERE source = ?;", (self.source,))
+            self.conn.execute("DELETE FROM watermarks WHERE source = ?;", (self.source,))
+            self.conn.execute("DELETE FROM staging_tokens WHERE source = ?;", (self.source,))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,272 @@
+import concurrent.futures
+import json
+import os
+
+import boto3
+from botocore.config import Config
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from copy_loader import record_to_row
+from entities import COMMENTS, parse_json_to_record
+from metrics import BYTES_FETCHED, FETCH_IN_FLIGHT, FETCH_SECONDS, OBJECTS_FETCHED, REGISTRY, errors
+from s3_listing import discover_shards, list_comment_pages
+
+# The bucket holds one small JSON object per comment, so a full re-ingest
+# pays a GET per comment.  Compaction packs each docket's comments into one
+# Parquet shard,
+#
+#   <destination>/<agency>/<docket>.parquet
+#
+# (comments listed directly under an agency, outside any docket folder, go
+# to <agency>/_root.parquet)
+#
+# with the comments table's columns and types, so a re-ingest reads a few
+# thousand shards instead.  Each shard's footer records the key and ETag of
+# every comment in it.  A later run lists the docket again and only touches
+# its shard if a comment was added, changed or removed, and then only GETs
+# those comments; the other rows are copied over from the old shard.
+#
+# The destination is a local directory or an s3://bucket/prefix URI.
+
+# Rows per row group; the shard loader reads one row group per batch
+ROW_GROUP_SIZE = 10000
+
+# Shard footer key holding {key: [etag, id]} of every comment in the shard
+SOURCES_KEY = b"mirrulations.sources"
+
+# Arrow type of each binary COPY type
+ARROW_TYPES = {"int4": pa.int32(), "timestamp": pa.timestamp("us"), "bool": pa.bool_(), "text": pa.string()}
+
+SHARDS_COMPACTED = REGISTRY.counter("compaction_shards_total", "Docket shards checked, by outcome", outcome="written")
+SHARDS_UNCHANGED = REGISTRY.counter("compaction_shards_total", "Docket shards checked, by outcome",
+                                    outcome="unchanged")
+
+
+def arrow_schema(entity=COMMENTS):
+    return pa.schema([pa.field(column, ARROW_TYPES[copy_type])
+                      for column, copy_type in zip(entity.columns, entity.copy_types)])
+
+
+SHARD_SCHEMA = arrow_schema(COMMENTS)
+
+
+def open_destination(destination):
+    """
+    Returns (filesystem, root) for a local directory or an s3://bucket/prefix URI.
+    """
+    if "://" not in destination:
+        destination = os.path.abspath(destination)
+    filesystem, root = pafs.FileSystem.from_uri(destination)
+    return filesystem, root.rstrip("/")
+
+
+# Shard name of the comments of a prefix that is not inside a docket folder
+ROOT_SHARD = "_root"
+
+
+def docket_prefix(prefix):
+    """
+    Returns the docket prefix ('WHD/WHD-2023-0001/') a prefix falls in, or the agency or
+    bucket prefix itself if it is above the docket level.
+    """
+    parts = [part for part in prefix.strip("/").split("/") if part][:2]
+    return "".join(f"{part}/" for part in parts)
+
+
+def shard_path(root, prefix):
+    parts = docket_prefix(prefix).split("/")[:-1]
+    if len(parts) == 2:
+        return f"{root}/{parts[0]}/{parts[1]}.parquet"
+    return "/".join([root] + parts + [f"{ROOT_SHARD}.parquet"])
+
+
+def read_sources(filesystem, path):
+    """
+    Returns the {key: [etag, id]} recorded in a shard's footer, or None if the shard is
+    missing or unreadable (e.g. cut short by a crash), in which case it is rebuilt.
+    """
+    try:
+        metadata = pq.read_schema(path, filesystem=filesystem).metadata or {}
+    except (FileNotFoundError, OSError, pa.ArrowInvalid):
+        return None
+    return json.loads(metadata[SOURCES_KEY]) if SOURCES_KEY in metadata else None
+
+
+def rows_to_table(rows, entity=COMMENTS):
+    """
+    Builds an Arrow table with the entity's column types from typed rows in column order.
+    """
+    schema = SHARD_SCHEMA if entity is COMMENTS else arrow_schema(entity)
+    columns = list(zip(*rows)) if rows else [[] for _ in schema]
+    return pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                schema=schema)
+
+
+def table_rows(table, entity=COMMENTS):
+    """
+    Converts an Arrow table or record batch into typed rows for binary COPY.  Each column is
+    converted to Python in one call, instead of one converter call per value.
+    """
+    columns = [table.column(name).to_pylist() for name in entity.columns]
+    return list(zip(*columns))
+
+
+def fetch_comment(s3, bucket_name, key, etag, cache=None):
+    with FETCH_IN_FLIGHT.track(), FETCH_SECONDS.time():
+        if cache:
+            body = cache.fetch(s3, bucket_name, key, etag)
+        else:
+            body = s3.get_object(Bucket=bucket_name, Key=key)["Body"].read()
+    OBJECTS_FETCHED.inc()
+    BYTES_FETCHED.inc(len(body))
+    return record_to_row(parse_json_to_record(body))
+
+
+def write_shard(filesystem, path, table):
+    filesystem.create_dir(path.rsplit("/", 1)[0], recursive=True)
+    if isinstance(filesystem, pafs.LocalFileSystem):
+        # Renamed into place, so a crash never leaves a half-written shard behind
+        temporary = f"{path}.tmp"
+        pq.write_table(table, temporary, filesystem=filesystem, row_group_size=ROW_GROUP_SIZE, compression="zstd")
+        filesystem.move(temporary, path)
+    else:
+        # An S3 PUT only becomes visible once it is complete
+        pq.write_table(table, path, filesystem=filesystem, row_group_size=ROW_GROUP_SIZE, compression="zstd")
+
+
+def compact_docket(s3, bucket_name, docket_prefix, filesystem, root, fetch_pool, cache=None):
+    """
+    Brings one docket's shard up to date with the bucket.
+
+    :param fetch_pool: executor the GETs are spread over.
+    :return: (docket_prefix, rows in the shard or None if it was unchanged, keys that failed to fetch).
+    """
+    path = shard_path(root, docket_prefix)
+    listed = {key: etag for page in list_comment_pages(s3, bucket_name, docket_prefix) for key, etag in page}
+    previous = read_sources(filesystem, path) or {}
+    if {key: source[0] for key, source in previous.items()} == listed:
+        SHARDS_UNCHANGED.inc()
+        return docket_prefix, None, 0
+
+    # Rows whose key and ETag are unchanged are copied from the old shard, everything else is fetched
+    kept = {key: previous[key] for key, etag in listed.items() if key in previous and previous[key][0] == etag}
+    fetch = [(key, etag) for key, etag in listed.items() if key not in kept]
+    tables = []
+    if kept:
+        old = pq.read_table(path, filesystem=filesystem, schema=SHARD_SCHEMA)
+        tables.append(old.filter(pc.is_in(old["id"], value_set=pa.array([source[1] for source in kept.values()]))))
+
+    sources = dict(kept)
+    rows = []
+    failed = 0
+    futures = {fetch_pool.submit(fetch_comment, s3, bucket_name, key, etag, cache): (key, etag)
+               for key, etag in fetch}
+    for future in concurrent.futures.as_completed(futures):
+        key, etag = futures[future]
+        try:
+            row = future.result()
+        except Exception as e:
+            # Left out of the footer, so the next run fetches it again
+            print(f"Error processing file {key}: {e}")
+            errors('fetch').inc()
+            failed += 1
+            continue
+        rows.append(row)
+        sources[key] = [etag, row[0]]
+    tables.append(rows_to_table(rows))
+
+    table = pa.concat_tables(tables).sort_by("id")
+    table = table.replace_schema_metadata({SOURCES_KEY: json.dumps(sources)})
+    write_shard(filesystem, path, table)
+    SHARDS_COMPACTED.inc()
+    print(f"Wrote {path}: {table.num_rows} comments, {len(rows)} fetched, {len(kept)} kept.")
+    return docket_prefix, table.num_rows, failed
+
+
+def compact(bucket_name, prefix, destination, max_workers=8, fetch_workers=64, max_listers=16, cache=None):
+    """
+    Compacts the comments of every docket under a prefix into one shard per docket.
+    Returns True if every docket was compacted and every comment fetched.
+
+    :param destination: local directory or s3://bucket/prefix URI the shards are written to.
+    :param max_workers: dockets compacted at once.
+    :param fetch_workers: threads doing GETs, shared by every docket.
+    :param cache: optional s3_cache.ObjectCache to read the comments through.
+    """
+    s3 = boto3.client('s3', region_name='us-east-1', config=Config(max_pool_connections=fetch_workers + max_workers))
+    filesystem, root = open_destination(destination)
+    # A prefix inside a docket is widened to the docket, so its shard is never rewritten with part of it
+    dockets = sorted({docket_prefix(shard) for shard in discover_shards(s3, bucket_name, prefix, max_listers)})
+    print(f"Compacting {len(dockets)} dockets into {destination}.")
+    complete = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=fetch_workers) as fetch_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as docket_pool:
+        futures = [docket_pool.submit(compact_docket, s3, bucket_name, docket, filesystem, root, fetch_pool, cache)
+                   for docket in dockets]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                _, _, failed = future.result()
+                complete = complete and not failed
+            except Exception as e:
+                print(f"Error compacting docket: {e}")
+                errors('compact').inc()
+                complete = False
+    return complete
+
+
+def list_shards(destination, prefix=''):
+    """
+    Returns (filesystem, paths) of the shards under a destination, optionally only those of
+    an agency ('WHD/') or docket ('WHD/WHD-2023-0001/') prefix.
+    """
+    filesystem, root = open_destination(destination)
+    parts = prefix.strip("/").split("/") if prefix.strip("/") else []
+    if len(parts) >= 2:
+        path = shard_path(root, prefix)
+        found = filesystem.get_file_info([path])
+        return filesystem, [info.path for info in found if info.type == pafs.FileType.File]
+    base = f"{root}/{parts[0]}" if parts else root
+    found = filesystem.get_file_info(pafs.FileSelector(base, recursive=True, allow_not_found=True))
+    return filesystem, sorted(info.path for info in found
+                              if info.type == pafs.FileType.File and info.path.endswith(".parquet"))
+
+
+def shard_row_groups(filesystem, paths):
+    """
+    Yields a (path, row group) pair for every row group of every shard, reading only the footers.
+    """
+    for path in paths:
+        with filesystem.open_input_file(path) as file:
+            row_groups = pq.ParquetFile(file).num_row_groups
+        for index in range(row_groups):
+            yield path, index
+
+
+def read_row_group(filesystem, path, index):
+    """
+    Reads one row group of a shard as typed rows for binary COPY.
+    """
+    with filesystem.open_input_file(path) as file:
+        table = pq.ParquetFile(file).read_row_group(index, columns=COMMENTS.columns)
+    return table_rows(table)
+
+
+def main():
+    bucket_name = 'mirrulations'
+    prefix = 'WHD/'
+    # A local directory, or e.g. 's3://mirrulations-shards/comments' to share the shards
+    destination = 'shards'
+    # Dockets compacted at once, and threads doing GETs for them
+    max_workers = 8
+    fetch_workers = 64
+
+    complete = compact(bucket_name, prefix, destination, max_workers, fetch_workers)
+    print(REGISTRY.summary())
+    print("Compaction complete." if complete else "Some comments were not compacted; run again to retry them.")
+
+
+if __name__ == '__main__':
+    main()
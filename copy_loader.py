@@ -0,0 +1,236 @@
+from psycopg.errors import Error
+
+from entities import COMMENTS
+from metrics import upsert_rows
+from rollups import RETURNING as ROLLUP_RETURNING, rollup_ctes
+
+# Column order of the comments table and of the rows from parse_json_to_record;
+# entities.COMMENTS is the single definition.  Every function here takes an
+# entity, so dockets and documents load the same way.
+SOURCE_COLUMNS = COMMENTS.source_columns
+COMMENT_COLUMNS = COMMENTS.columns
+
+
+def column_type(column):
+    return COMMENTS.column_type(column)
+
+
+def typed_row(row, entity=COMMENTS):
+    """
+    Converts an untyped tuple in the entity's column order into a tuple typed for binary COPY.
+    """
+    return entity.typed_row(row)
+
+
+def record_to_row(record, entity=COMMENTS):
+    """
+    Converts a record from parse_json_to_record into a tuple typed for binary COPY.
+
+    :param record: dict keyed by the entity's column names.
+    :return: tuple of Python values in column order.
+    """
+    return tuple(convert(record.get(column)) for convert, column in zip(entity.converters, entity.columns))
+
+
+def conflict_clause(on_conflict='nothing', entity=COMMENTS):
+    """
+    Builds the ON CONFLICT clause for inserts into the entity's table.
+    The INSERT must alias its target AS existing.
+
+    :param on_conflict: 'nothing' skips existing ids, 'update' overwrites the ones whose content hash changed.
+    """
+    if on_conflict == 'update':
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in entity.columns if column != "id")
+        # Unchanged rows are left alone, so they create no new tuple versions
+        return (f"ON CONFLICT (id) DO UPDATE SET {updates} "
+                "WHERE existing.contentHash IS DISTINCT FROM EXCLUDED.contentHash")
+    return "ON CONFLICT (id) DO NOTHING"
+
+
+def describe_error(e, table):
+    """
+    Adds a hint to a failed write's message when table is a partitioned comments table,
+    whose parent has no unique index on id for ON CONFLICT (id) to use.
+    """
+    # 42P10: no unique index or constraint matches the ON CONFLICT specification
+    if getattr(e, "sqlstate", None) == "42P10":
+        return (f"{e} ({table} is partitioned; load it through the staging table and "
+                "partitions.merge_partitioned_staging)")
+    return str(e)
+
+
+def record_upsert(on_conflict, distinct, inserted, updated, entity=COMMENTS):
+    """
+    Counts the new, changed and unchanged rows of an insert or merge and returns a
+    description for its log line.  With 'nothing' existing rows are never compared,
+    so only the new ones are counted.
+
+    :param distinct: number of distinct ids that were written.
+    """
+    upsert_rows("new", entity.table).inc(inserted)
+    if on_conflict != 'update':
+        return f"{inserted} new, {distinct - inserted} already present"
+    unchanged = distinct - inserted - updated
+    upsert_rows("changed", entity.table).inc(updated)
+    upsert_rows("unchanged", entity.table).inc(unchanged)
+    return f"{inserted} new, {updated} changed, {unchanged} unchanged"
+
+
+def create_load_table(cur, entity=COMMENTS):
+    # A session-local staging table is reused by every batch on this connection
+    cur.execute(f"""
+    CREATE TEMP TABLE IF NOT EXISTS {entity.table}_load
+    (LIKE {entity.table} INCLUDING DEFAULTS)
+    ON COMMIT DELETE ROWS;
+    """)
+
+
+def write_copy(cur, table, rows, entity=COMMENTS):
+    columns = ", ".join(entity.columns)
+    with cur.copy(f"COPY {table} ({columns}) FROM STDIN (FORMAT BINARY)") as copy:
+        copy.set_types(entity.copy_types)
+        for row in rows:
+            copy.write_row(row)
+
+
+def copy_insert_rows(rows, conn, on_conflict='nothing', table='comments', entity=COMMENTS):
+    """
+    Bulk loads typed rows with a binary COPY into a temp table, then moves them into
+    the entity's table with ON CONFLICT (id) DO NOTHING so duplicate ids are still skipped.
+    Any other table is treated as a keyless staging table and copied into directly.
+
+    :param rows: list of tuples in the entity's column order, as built by record_to_row.
+    :param conn: psycopg.Connection to the database holding the entity's table.
+    :param on_conflict: 'nothing' skips existing ids, 'update' upserts the ones whose content changed.
+    :param table: the entity's table, or the name of a staging table.
+    :param entity: entities.Entity the rows belong to.
+    :return: number of rows inserted or updated, or None if the batch failed.
+    """
+    if not rows:
+        return 0
+    try:
+        with conn.cursor() as cur:
+            if table != entity.table:
+                write_copy(cur, table, rows, entity)
+                written = len(rows)
+            else:
+                create_load_table(cur, entity)
+                write_copy(cur, f"{table}_load", rows, entity)
+                inserted, updated, distinct = merge_load_table(cur, on_conflict, entity)
+                written = inserted + updated
+        conn.commit()
+        if table != entity.table:
+            outcome = f"staged {written}"
+        else:
+            outcome = record_upsert(on_conflict, distinct, inserted, updated, entity)
+        print(f"Copied {len(rows)} records into {table}: {outcome}.")
+        return written
+    except Error as e:
+        print(f"Error copying records: {describe_error(e, table)}")
+        conn.rollback()
+        return None
+
+
+def merge_load_table(cur, on_conflict='nothing', entity=COMMENTS):
+    """
+    Moves the rows of the entity's session-local load table into its table.
+
+    :return: (inserted, updated, distinct ids loaded).
+    """
+    table = entity.table
+    columns = ", ".join(entity.columns)
+    # DISTINCT ON keeps an upsert from touching the same id twice in one statement;
+    # xmax is 0 only on freshly inserted row versions.  Comments also move their rollups.
+    returning, rollups = "", ""
+    if entity is COMMENTS:
+        returning = f"{ROLLUP_RETURNING}, "
+        rollups = rollup_ctes(table, f"{table}_load", on_conflict)
+    cur.execute(f"""
+    WITH merged AS (
+        INSERT INTO {table} AS existing ({columns})
+        SELECT DISTINCT ON (id) {columns} FROM {table}_load
+        ORDER BY id, modifyDate DESC NULLS LAST
+        {conflict_clause(on_conflict, entity)}
+        RETURNING {returning}(xmax = 0) AS inserted
+    ){rollups}
+    SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted),
+           (SELECT COUNT(DISTINCT id) FROM {table}_load)
+    FROM merged;
+    """)
+    return cur.fetchone()
+
+
+def executemany_insert_rows(rows, conn, on_conflict='nothing', table='comments', entity=COMMENTS):
+    """
+    Row-by-row counterpart of copy_insert_rows: the rows are sent with executemany instead of
+    a COPY, and then merged the same way, so the comment rollups stay current on this path too.
+    A staging table is inserted into directly.
+
+    :return: number of rows inserted or updated, or None if the batch failed.
+    """
+    if not rows:
+        return 0
+    target = table if table != entity.table else f"{table}_load"
+    query = f"""
+    INSERT INTO {target} ({", ".join(entity.columns)})
+    VALUES ({", ".join(["%s"] * len(entity.columns))});
+    """
+    try:
+        with conn.cursor() as cur:
+            if table != entity.table:
+                cur.executemany(query, rows)
+                written = len(rows)
+            else:
+                create_load_table(cur, entity)
+                cur.executemany(query, rows)
+                inserted, updated, distinct = merge_load_table(cur, on_conflict, entity)
+                written = inserted + updated
+        conn.commit()
+        if table != entity.table:
+            outcome = f"staged {written}"
+        else:
+            outcome = record_upsert(on_conflict, distinct, inserted, updated, entity)
+        print(f"Inserted {len(rows)} records into {table}: {outcome}.")
+        return written
+    except Error as e:
+        print(f"Error inserting records: {describe_error(e, table)}")
+        conn.rollback()
+        return None
+
+
+def copy_insert_records(records, conn, on_conflict='nothing', table='comments', entity=COMMENTS):
+    """
+    Same as copy_insert_rows, for the dicts returned by parse_json_to_record.
+    """
+    try:
+        rows = [record_to_row(record, entity) for record in records]
+    except ValueError as e:
+        print(f"Error copying records: {e}")
+        return None
+    return copy_insert_rows(rows, conn, on_conflict, table, entity)
+
+
+def batch_insert_rows(rows, conn, loader='executemany', on_conflict='nothing', table='comments', entity=COMMENTS):
+    """
+    Writes one batch of rows with the chosen loader.  Shared by the concurrent ingest scripts.
+
+    :param loader: 'copy' for a binary COPY, 'executemany' for row-by-row INSERTs.
+    :return: True if the batch committed.
+    """
+    if not rows:
+        return True
+    if loader == 'copy':
+        return copy_insert_rows(rows, conn, on_conflict, table, entity) is not None
+    # Row by row into the same load table and merge as COPY, so the rollups are maintained either way
+    return executemany_insert_rows(rows, conn, on_conflict, table, entity) is not None
+
+
+def batch_insert_records(records, conn, loader='executemany', on_conflict='nothing', table='comments'):
+    """
+    Same as batch_insert_rows, for the dicts returned by parse_json_to_record.
+    """
+    if not records:
+        return True
+    if loader == 'copy':
+        return copy_insert_records(records, conn, on_conflict, table) is not None
+    return batch_insert_rows([tuple(record.values()) for record in records], conn, loader, on_conflict, table)
@@ -0,0 +1,41 @@
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool
+
+# One pool is shared by every ingest worker, so a run pays for a handful of
+# TLS+auth handshakes instead of one per batch, and connections keep their
+# prepared statements between batches.
+#
+# Aurora only accepts writes on the cluster endpoint; the cluster-ro endpoint
+# spreads connections over the read replicas.  Ingest writes go to the writer
+# and queries (see queries.py and search.py) to the reader, so readers never
+# compete with a load for the writer's CPU.
+
+WRITER_HOST = "mirrulations.cluster-cb6gssewgl8x.us-east-1.rds.amazonaws.com"
+READER_HOST = "mirrulations.cluster-ro-cb6gssewgl8x.us-east-1.rds.amazonaws.com"
+
+
+def create_connection_pool(conn_params, min_size=2, max_size=15, prepare_threshold=1, timeout=60, name="ingest"):
+    """
+    Opens a connection pool for the ingest workers.
+
+    :param conn_params: dict of keyword arguments for psycopg.connect.
+    :param min_size: connections kept open even when idle.
+    :param max_size: upper bound on connections; match it to the number of workers.
+    :param prepare_threshold: executions of a query before psycopg prepares it on a connection.
+    :param timeout: seconds a worker waits for a free connection before failing.
+    :param name: pool name, shown in psycopg_pool's logs and stats.
+    :return: an open psycopg_pool.ConnectionPool, usable as a context manager.
+    """
+    pool = ConnectionPool(
+        conninfo=make_conninfo(**conn_params),
+        min_size=min(min_size, max_size),
+        max_size=max_size,
+        kwargs={"prepare_threshold": prepare_threshold},
+        # Checked when a connection is handed out, so dropped connections are replaced
+        check=ConnectionPool.check_connection,
+        timeout=timeout,
+        open=False,
+        name=name
+    )
+    pool.open(wait=True)
+    return pool
@@ -0,0 +1,181 @@
+import hashlib
+import math
+import os
+import struct
+import threading
+
+from psycopg.errors import Error
+
+from copy_loader import COMMENT_COLUMNS
+from metrics import REGISTRY
+
+# Drops duplicate comments before they are shipped to the database:
+#   - exact duplicates inside a batch (the latest modifyDate wins, as in the merge);
+#   - ids already in comments, found through a run-wide Bloom filter of known ids.
+#
+# A Bloom filter can answer "maybe present" for an id it has never seen, so a
+# hit is only a candidate: the candidates of a batch are confirmed with one
+# indexed SELECT, and only confirmed ids are dropped.  A stale or oversized
+# filter therefore costs extra lookups, never rows.
+#
+# Only use it with on_conflict='nothing' and not for a full reload: an upsert
+# or a table swap needs every row, including the ones already present.
+
+MODIFY_DATE = COMMENT_COLUMNS.index("modifyDate")
+MAGIC = b"BLM1"
+HEADER = struct.Struct("<4sQQQd")
+
+
+def dropped(reason):
+    return REGISTRY.counter("ingest_duplicates_dropped_total", "Rows dropped before insert as duplicates",
+                            reason=reason)
+
+
+def newer(row, current):
+    # Same order as the merge: latest modifyDate first, rows without one last
+    if row[MODIFY_DATE] is None:
+        return False
+    return current[MODIFY_DATE] is None or row[MODIFY_DATE] > current[MODIFY_DATE]
+
+
+BLOOM_CANDIDATES = REGISTRY.counter("ingest_bloom_candidates_total", "Ids the Bloom filter reported as maybe present")
+
+
+class BloomFilter:
+    """
+    Bloom filter over strings, sized for a number of items and a false positive rate.
+
+    :param capacity: number of ids the filter is expected to hold.
+    :param error_rate: false positive rate at capacity.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        positions = self.positions(key)
+        with self.lock:
+            for position in positions:
+                self.bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def save(self, path):
+        # Written next to the target and renamed, so a crash never leaves a torn filter
+        temporary = f"{path}.tmp"
+        with self.lock, open(temporary, "wb") as file:
+            file.write(HEADER.pack(MAGIC, self.capacity, self.hashes, self.count, self.error_rate))
+            file.write(self.bits)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            magic, capacity, hashes, count, error_rate = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a Bloom filter file")
+            bloom = cls(capacity, error_rate)
+            bloom.hashes = hashes
+            bloom.count = count
+            bloom.bits = bytearray(file.read())
+        return bloom
+
+
+class DuplicateFilter:
+    """
+    Removes duplicate rows from batches before they are inserted.
+
+    :param bloom: BloomFilter of ids known to be in comments.
+    :param path: where save() persists the filter between runs, or None.
+    """
+
+    def __init__(self, bloom, path=None):
+        self.bloom = bloom
+        self.path = path
+
+    @classmethod
+    def open(cls, path, conn, capacity=None, error_rate=0.001):
+        """
+        Loads the filter saved by an earlier run, or builds one from the ids in comments.
+
+        :param conn: psycopg.Connection used to preload the ids when there is no saved filter.
+        :param capacity: ids to size a new filter for; defaults to twice the rows in comments.
+        :param error_rate: false positive rate of a new filter.
+        """
+        if path and os.path.exists(path):
+            bloom = BloomFilter.load(path)
+            print(f"Loaded Bloom filter of {bloom.count} ids from {path}.")
+            if bloom.count > bloom.capacity:
+                print("The filter holds more ids than it was sized for; delete it to rebuild a larger one.")
+            return cls(bloom, path)
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM comments;")
+            existing = cur.fetchone()[0]
+        bloom = BloomFilter(capacity or max(2 * existing, 1_000_000), error_rate)
+        # A named cursor streams the ids from the server instead of fetching them all at once
+        with conn.transaction(), conn.cursor(name="bloom_preload") as cur:
+            cur.itersize = 50_000
+            cur.execute("SELECT id FROM comments;")
+            for (comment_id,) in cur:
+                bloom.add(comment_id)
+        print(f"Built Bloom filter of {bloom.count} ids from comments.")
+        return cls(bloom, path)
+
+    def filter_rows(self, rows, conn):
+        """
+        Returns the rows of a batch that are neither repeated in the batch nor already in comments.
+
+        :param rows: tuples in COMMENT_COLUMNS order.
+        :param conn: psycopg.Connection used to confirm the ids the Bloom filter reports.
+        """
+        latest = {}
+        for row in rows:
+            current = latest.get(row[0])
+            if current is None or newer(row, current):
+                latest[row[0]] = row
+        dropped("batch").inc(len(rows) - len(latest))
+
+        candidates = [comment_id for comment_id in latest if comment_id in self.bloom]
+        if candidates:
+            BLOOM_CANDIDATES.inc(len(candidates))
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT id FROM comments WHERE id = ANY(%s);", (candidates,))
+                    existing = {comment_id for (comment_id,) in cur.fetchall()}
+                conn.commit()
+            except Error as e:
+                # Without the confirmation nothing is dropped; ON CONFLICT still skips duplicates
+                print(f"Error checking existing ids: {e}")
+                conn.rollback()
+                existing = set()
+            for comment_id in existing:
+                del latest[comment_id]
+            dropped("existing").inc(len(existing))
+        return list(latest.values())
+
+    def add_rows(self, rows):
+        """
+        Records the ids of rows that have been committed.
+        """
+        for row in rows:
+            self.bloom.add(row[0])
+
+    def save(self):
+        if self.path:
+            self.bloom.save(self.path)
+            print(f"Saved Bloom filter of {self.bloom.count} ids to {self.path}.")
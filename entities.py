@@ -0,0 +1,243 @@
+import hashlib
+import json
+from datetime import datetime
+
+from psycopg.errors import Error
+
+# One schema per regulations.gov entity.  The mirror keeps each docket as
+#
+#   agency/docket/text-docket/docket/<docket>.json
+#   agency/docket/text-docket/documents/<document>.json
+#   agency/docket/text-docket/comments/<comment>.json
+#
+# so the folder a JSON file sits in tells which entity it is.  Every table
+# has id and apiurl, the entity's attributes in the order listed here, and a
+# contentHash of those values, so an upsert can tell a changed row from an
+# unchanged one by comparing a single value.
+#
+# Text extracted from comment attachments sits next to the comments, in
+#
+#   agency/docket/text-docket/comments_extracted_text/<extractor>/<comment>_attachment_<n>_extracted.txt
+#
+# and is loaded into comment_text, one row per file (see attachment_text.py).
+
+# Postgres type of each binary COPY type
+SQL_TYPES = {"int4": "INTEGER", "timestamp": "TIMESTAMP", "bool": "BOOLEAN", "text": "TEXT"}
+
+
+def to_timestamp(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    # Postgres ignores the zone of a literal cast to TIMESTAMP, so we do too
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+
+
+def to_integer(value):
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+def to_boolean(value):
+    if value is None or isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("t", "true", "y", "yes", "1")
+
+
+def to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        # Nested attributes such as fileFormats are stored as compact JSON, not a Python repr
+        return json.dumps(value, separators=(",", ":"))
+    return str(value)
+
+
+CONVERTERS = {"int4": to_integer, "timestamp": to_timestamp, "bool": to_boolean, "text": to_text}
+
+
+def content_hash(values):
+    """
+    Hashes the values of a row as parsed from JSON, before any type conversion.
+
+    :param values: iterable of the raw values in source column order.
+    :return: 32 hex characters; equal values always give the same hash, whichever parser read them.
+    """
+    # Values are joined with a unit separator and None is written as NUL, so None and ''
+    # hash differently; this is about three times cheaper than json.dumps on a large comment.
+    # surrogatepass keeps a lone surrogate escaped in the JSON from failing the row.
+    text = "\x1f".join("\x00" if value is None else str(value) for value in values)
+    return hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()[:32]
+
+
+class Entity:
+    """
+    Schema of one entity: where its JSON lives, which attributes become columns, and
+    the Postgres type of each column.  Attributes not listed are TEXT.
+
+    :param name: 'docket', 'document' or 'comment'.
+    :param folder: name of the mirror folder holding the entity's JSON files.
+    :param table: table the rows are loaded into.
+    :param attributes: names read from data.attributes, in column order.
+    """
+
+    suffix = ".json"
+
+    def __init__(self, name, folder, table, attributes, integers=(), timestamps=(), booleans=()):
+        self.name = name
+        self.folder = folder
+        self.table = table
+        self.attributes = tuple(attributes)
+        self.integers = set(integers)
+        self.timestamps = set(timestamps)
+        self.booleans = set(booleans)
+        self.source_columns = ["id", "apiurl", *self.attributes]
+        self.columns = self.source_columns + ["contentHash"]
+        self.copy_types = [self.column_type(column) for column in self.columns]
+        self.converters = [CONVERTERS[copy_type] for copy_type in self.copy_types]
+
+    def column_type(self, column):
+        if column in self.integers:
+            return "int4"
+        if column in self.timestamps:
+            return "timestamp"
+        if column in self.booleans:
+            return "bool"
+        return "text"
+
+    def extract(self, data, plain=None):
+        """
+        Picks the columns out of a decoded document and appends their contentHash.
+
+        :param data: the decoded JSON, with a top-level "data" object.
+        :param plain: optional function applied to each attribute value, e.g. to copy
+            nested arrays out of a simdjson document.
+        :return: untyped tuple in column order.
+        """
+        item = data["data"]
+        get = item["attributes"].get
+        if plain is None:
+            values = (item["id"], item["links"]["self"], *[get(key) for key in self.attributes])
+        else:
+            values = (item["id"], item["links"]["self"], *[plain(get(key)) for key in self.attributes])
+        return (*values, content_hash(values))
+
+    def typed_row(self, row):
+        """
+        Converts an untyped tuple in column order into a tuple typed for binary COPY.
+        """
+        return tuple(convert(value) for convert, value in zip(self.converters, row))
+
+    def create_table_sql(self):
+        columns = ",\n".join(
+            f"    {column} {SQL_TYPES[copy_type]}{' PRIMARY KEY' if column == 'id' else ''}"
+            for column, copy_type in zip(self.columns, self.copy_types)
+        )
+        return f"CREATE TABLE IF NOT EXISTS {self.table} (\n{columns}\n);"
+
+
+DOCKETS = Entity("docket", "docket", "dockets", [
+    "agencyId", "category", "dkAbstract", "docketType", "effectiveDate", "field1", "field2",
+    "generic", "keywords", "legacy", "modifyDate", "objectId", "organization", "petitionNbr",
+    "program", "rin", "shortTitle", "subType", "subType2", "title"
+], timestamps={"effectiveDate", "modifyDate"})
+
+DOCUMENTS = Entity("document", "documents", "documents", [
+    "additionalRins", "address1", "address2", "agencyId", "allowLateComments", "authorDate",
+    "authors", "category", "cfrPart", "city", "comment", "commentEndDate", "commentStartDate",
+    "country", "docAbstract", "docketId", "documentType", "effectiveDate", "email",
+    "exhibitLocation", "exhibitType", "fax", "field1", "field2", "fileFormats", "firstName",
+    "frDocNum", "frVolNum", "govAgency", "govAgencyType", "implementationDate", "lastName",
+    "legacyId", "media", "modifyDate", "objectId", "ombApproval", "openForComment",
+    "originalDocumentId", "pageCount", "paperLength", "paperWidth", "phone", "postedDate",
+    "postmarkDate", "reasonWithdrawn", "receiveDate", "regWriterInstruction", "restrictReason",
+    "restrictReasonType", "sourceCitation", "startEndPage", "subject", "submitterRep",
+    "submitterRepAddress", "submitterRepCityState", "subtype", "title", "topics", "trackingNbr",
+    "withdrawn", "zip"
+], integers={"pageCount", "paperLength", "paperWidth"},
+    timestamps={"authorDate", "commentEndDate", "commentStartDate", "effectiveDate", "implementationDate",
+                "modifyDate", "postedDate", "postmarkDate", "receiveDate"},
+    booleans={"allowLateComments", "openForComment", "withdrawn"})
+
+COMMENTS = Entity("comment", "comments", "comments", [
+    "commentOn", "commentOnDocumentId", "duplicateComments", "address1", "address2",
+    "agencyId", "city", "category", "comment", "country", "docAbstract", "docketId",
+    "documentType", "email", "fax", "field1", "field2", "fileFormats", "firstName",
+    "govAgency", "govAgencyType", "objectId", "lastName", "legacyId", "modifyDate",
+    "organization", "originalDocumentId", "pageCount", "phone", "postedDate", "postmarkDate",
+    "reasonWithdrawn", "receiveDate", "restrictReason", "restrictReasonType",
+    "stateProvinceRegion", "submitterRep", "submitterRepAddress", "submitterRepCityState",
+    "subtype", "title", "trackingNbr", "withdrawn", "zip", "openForComment"
+], integers={"duplicateComments", "pageCount"},
+    timestamps={"modifyDate", "postedDate", "postmarkDate", "receiveDate"},
+    booleans={"withdrawn", "openForComment"})
+
+
+class TextEntity:
+    """
+    Schema of the text extracted from attachments: one row per text file, keyed by the
+    comment it belongs to.  The content is streamed, never parsed, so there are no
+    attributes or converters.
+    """
+
+    suffix = ".txt"
+
+    def __init__(self, name, folder, table):
+        self.name = name
+        self.folder = folder
+        self.table = table
+        self.key_columns = ["commentId", "attachment", "extractor"]
+        self.columns = self.key_columns + ["key", "content", "contentHash"]
+
+    def create_table_sql(self):
+        return f"""CREATE TABLE IF NOT EXISTS {self.table} (
+    commentId TEXT NOT NULL,
+    attachment TEXT NOT NULL,
+    extractor TEXT NOT NULL,
+    key TEXT,
+    content TEXT,
+    contentHash TEXT,
+    PRIMARY KEY ({", ".join(self.key_columns)})
+);"""
+
+
+COMMENT_TEXT = TextEntity("comment_text", "comments_extracted_text", "comment_text")
+
+ENTITIES = {entity.name: entity for entity in (DOCKETS, DOCUMENTS, COMMENTS, COMMENT_TEXT)}
+
+
+def entity_for_path(path, entities=ENTITIES.values(), separator="/"):
+    """
+    Classifies an S3 key or a path relative to the mirror root by the folder it sits in.
+
+    :param entities: the entities to accept; files of any other entity return None.
+    :return: the Entity, or None if the path is not a file of an accepted entity.
+    """
+    folders = path.split(separator)[:-1]
+    for entity in entities:
+        if entity.folder in folders and path.endswith(entity.suffix):
+            return entity
+    return None
+
+
+def parse_json_to_record(json_text, entity=COMMENTS):
+    """
+    Parses one JSON document into a dict keyed by the entity's columns.
+    """
+    return dict(zip(entity.columns, entity.extract(json.loads(json_text))))
+
+
+def create_entity_table(conn, entity=COMMENTS):
+    """
+    Creates the entity's table if it does not exist yet.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(entity.create_table_sql())
+            # Tables created before contentHash existed
+            cur.execute(f"ALTER TABLE {entity.table} ADD COLUMN IF NOT EXISTS contentHash TEXT;")
+            conn.commit()
+            print(f"Table '{entity.table}' created successfully.")
+    except Error as e:
+        print(f"An error occurred: {e}")
+        conn.rollback()
@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import boto3
+from botocore.config import Config
+from psycopg_pool import PoolTimeout
+
+from db_pool import WRITER_HOST
+from ingest_comments_concurrent import fetch_batch, finish_batch, parse_batch
+from metrics import INSERT_IN_FLIGHT, INSERT_SECONDS, REGISTRY, ROWS_WRITTEN, errors
+from parse_pool import create_parse_pool
+from pipeline import Pipeline, Stage
+from router import EntityRouter
+from s3_cache import ObjectCache
+from s3_listing import ShardProgress, list_comment_keys_sharded
+from sinks import create_sink
+
+# Runs the list, fetch and parse stages of ingest_comments_concurrent.py into
+# any sink from sinks.py, chosen on the command line:
+#
+#   python export_comments.py --sink parquet --output exports/comments --prefix WHD/
+#   python export_comments.py --sink sqlite --output comments.sqlite3 --prefix WHD/WHD-2023-0001/
+#   python export_comments.py --sink null --prefix WHD/
+#   python export_comments.py --sink postgres --prefix WHD/
+
+
+def write_to_sink(batch, sink):
+    """
+    Write stage: hands the parsed rows of a batch to the sink.
+    """
+    entity, keys_batch, fetched, rows = batch
+    with INSERT_IN_FLIGHT.track(), INSERT_SECONDS.time():
+        written = sink.write(rows, entity)
+    if written:
+        ROWS_WRITTEN.inc(len(rows))
+    else:
+        errors('insert').inc()
+    return finish_batch(written and len(fetched) == len(keys_batch))
+
+
+def export_comments(bucket_name, prefix, sink, fetch_workers=64, parser_processes=None, batch_size=1000,
+                    max_listers=16, cache=None):
+    """
+    Lists, fetches and parses every comment under a prefix and writes the rows to a sink.
+    Returns True if every batch was written and the sink closed cleanly.
+
+    :param sink: one of the sinks from sinks.py; it is closed at the end.
+    :param cache: optional s3_cache.ObjectCache; an offline cache lists and fetches from disk alone.
+    """
+    router = EntityRouter(('comment',), batch_size)
+    s3 = boto3.client('s3', region_name='us-east-1', config=Config(max_pool_connections=fetch_workers))
+    progress = ShardProgress()
+
+    def generate_keys():
+        if cache and cache.offline:
+            return cache.list_keys(bucket_name, prefix, router.accepts)
+        keys = list_comment_keys_sharded(s3, bucket_name, prefix, progress, max_listers=max_listers,
+                                         accept=router.accepts)
+        return cache.remember(bucket_name, keys) if cache else keys
+
+    parse_pool = create_parse_pool(parser_processes) if parser_processes != 0 else None
+    try:
+        stages = [
+            Stage('fetch', lambda batch: fetch_batch(batch, s3, bucket_name, cache), fetch_workers),
+            Stage('parse', lambda batch: parse_batch(batch, parse_pool), parser_processes or os.cpu_count() or 1),
+            Stage('write', lambda batch: write_to_sink(batch, sink), sink.workers),
+        ]
+        complete = Pipeline(router.batches(generate_keys()), stages, fatal=(PoolTimeout, BrokenProcessPool)).run()
+    finally:
+        if parse_pool:
+            parse_pool.shutdown(cancel_futures=True)
+        closed = sink.close()
+    return complete and closed and not progress.failures
+
+
+def postgres_params():
+    client = boto3.client('secretsmanager', region_name='us-east-1')
+    secret_name = "mirrulationsdb/postgres/master"
+    response = client.get_secret_value(SecretId=secret_name)
+    secret = json.loads(response['SecretString'])
+    return {
+        "dbname": "postgres",
+        "user": secret['username'],
+        "password": secret['password'],
+        "host": WRITER_HOST,
+        "port": "5432"
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export comments from the bucket into Postgres, Parquet or SQLite")
+    parser.add_argument('--sink', choices=['postgres', 'parquet', 'sqlite', 'null'], required=True,
+                        help="'null' drops the rows, to measure the list, fetch and parse stages")
+    parser.add_argument('--output', help="Parquet directory or s3:// URI, or SQLite file")
+    parser.add_argument('--bucket', default='mirrulations')
+    parser.add_argument('--prefix', default='WHD/', help="agency or docket folder, '/' for the whole bucket")
+    parser.add_argument('--fetch-workers', type=int, default=64)
+    parser.add_argument('--parser-processes', type=int, default=None,
+                        help="default one per CPU, 0 parses in threads")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=8, help="write threads and connections for 'postgres'")
+    parser.add_argument('--row-group-size', type=int, default=50000, help="rows per Parquet row group")
+    parser.add_argument('--max-buffered-rows', type=int, default=500000,
+                        help="rows the Parquet sink may buffer across all partitions")
+    parser.add_argument('--max-open-files', type=int, default=64, help="Parquet files open at once")
+    parser.add_argument('--cache-directory', help="on-disk object cache (see s3_cache.py)")
+    parser.add_argument('--offline', action='store_true', help="read only from --cache-directory")
+    args = parser.parse_args()
+
+    options = {}
+    conn_params = None
+    if args.sink == 'postgres':
+        conn_params = postgres_params()
+        options = {"workers": args.workers}
+    elif args.sink == 'parquet':
+        options = {"row_group_size": args.row_group_size, "max_buffered_rows": args.max_buffered_rows,
+                   "max_open_files": args.max_open_files}
+    if args.sink in ('parquet', 'sqlite') and not args.output:
+        parser.error(f"--output is required for the {args.sink} sink")
+    if args.offline and not args.cache_directory:
+        parser.error("--offline needs --cache-directory")
+
+    sink = create_sink(args.sink, args.output, conn_params, **options)
+    cache = ObjectCache(args.cache_directory, offline=args.offline) if args.cache_directory else None
+    before = time.time()
+    try:
+        complete = export_comments(args.bucket, args.prefix, sink, args.fetch_workers, args.parser_processes,
+                                   args.batch_size, cache=cache)
+    finally:
+        if cache:
+            cache.close()
+    after = time.time()
+    print(REGISTRY.summary(after - before))
+    if cache:
+        print(cache.summary())
+    print("Export complete." if complete else "Some comments were not exported.")
+
+
+if __name__ == '__main__':
+    main()
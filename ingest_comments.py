@@ -3,65 +3,18 @@ import json
 import psycopg
 from psycopg.errors import Error
 
+from copy_loader import copy_insert_records
+from entities import COMMENTS, create_entity_table, parse_json_to_record
+from staging_load import STAGING_TABLE, create_staging_table, finish_staging
+from search import create_search_index
+from rollups import create_rollup_tables
+from queries import create_read_indexes
+from db_pool import WRITER_HOST
+from s3_cache import ObjectCache
+
 def create_comments_table(conn):
-    try:
-        with conn.cursor() as cur:
-            create_table_query = """
-            CREATE TABLE comments (
-                id TEXT PRIMARY KEY,
-                apiurl TEXT,
-                commentOn TEXT,
-                commentOnDocumentId TEXT,
-                duplicateComments INTEGER,
-                address1 TEXT,
-                address2 TEXT,
-                agencyId TEXT,
-                city TEXT,
-                category TEXT,
-                comment TEXT,
-                country TEXT,
-                docAbstract TEXT,
-                docketId TEXT,
-                documentType TEXT,
-                email TEXT,
-                fax TEXT,
-                field1 TEXT,
-                field2 TEXT,
-                fileFormats TEXT,
-                firstName TEXT,
-                govAgency TEXT,
-                govAgencyType TEXT,
-                objectId TEXT,
-                lastName TEXT,
-                legacyId TEXT,
-                modifyDate TIMESTAMP,
-                organization TEXT,
-                originalDocumentId TEXT,
-                pageCount INTEGER,
-                phone TEXT,
-                postedDate TIMESTAMP,
-                postmarkDate TIMESTAMP,
-                reasonWithdrawn TEXT,
-                receiveDate TIMESTAMP,
-                restrictReason TEXT,
-                restrictReasonType TEXT,
-                stateProvinceRegion TEXT,
-                submitterRep TEXT,
-                submitterRepAddress TEXT,
-                submitterRepCityState TEXT,
-                subtype TEXT,
-                title TEXT,
-                trackingNbr TEXT,
-                withdrawn BOOLEAN,
-                zip TEXT,
-                openForComment BOOLEAN
-            );
-            """
-            cur.execute(create_table_query)
-            conn.commit()
-            print("Table 'comments' created successfully.")
-    except Error as e:
-        print(f"An error occurred: {e}")
+    create_entity_table(conn, COMMENTS)
+    create_rollup_tables(conn)
 
 def drop_comments_table(conn):
     try:
@@ -73,34 +26,19 @@ def drop_comments_table(conn):
     except Error as e:
         print(f"An error occurred: {e}")
 
-def parse_json_to_record(json_text):
-    data = json.loads(json_text)
-    record = {
-        "id": data["data"]["id"],
-        "apiurl": data["data"]["links"]["self"],
-    }
-    attributes = data["data"]["attributes"]
-    for key in [
-        "commentOn", "commentOnDocumentId", "duplicateComments", "address1", "address2",
-        "agencyId", "city", "category", "comment", "country", "docAbstract", "docketId",
-        "documentType", "email", "fax", "field1", "field2", "fileFormats", "firstName",
-        "govAgency", "govAgencyType", "objectId", "lastName", "legacyId", "modifyDate",
-        "organization", "originalDocumentId", "pageCount", "phone", "postedDate", "postmarkDate",
-        "reasonWithdrawn", "receiveDate", "restrictReason", "restrictReasonType",
-        "stateProvinceRegion", "submitterRep", "submitterRepAddress", "submitterRepCityState",
-        "subtype", "title", "trackingNbr", "withdrawn", "zip", "openForComment"
-    ]:
-        record[key] = attributes.get(key)
-    return record
-
-def batch_insert_records(records, conn):
+def batch_insert_records(records, conn, loader='executemany', table='comments'):
     if not records:
         return
+    if loader == 'copy':
+        copy_insert_records(records, conn, table=table)
+        return
     columns = records[0].keys()
+    # A staging table has no keys to conflict on
+    conflict = 'ON CONFLICT (id) DO NOTHING' if table == 'comments' else ''
     query = f"""
-    INSERT INTO comments ({", ".join(columns)})
+    INSERT INTO {table} ({", ".join(columns)})
     VALUES ({", ".join(["%s"] * len(columns))})
-    ON CONFLICT (id) DO NOTHING;
+    {conflict};
     """
     values = [tuple(record.values()) for record in records]
     try:
@@ -112,35 +50,45 @@ def batch_insert_records(records, conn):
         print(f"Error inserting records: {e}")
         conn.rollback()
 
-def ingest_comments(bucket_name, prefix, conn):
+def ingest_comments(bucket_name, prefix, conn, loader='executemany', table='comments', batch_size=100, cache=None):
     session = boto3.Session()
     s3 = session.resource('s3')
     bucket = s3.Bucket(bucket_name)
 
-    batch_size = 100  # Batch size for inserts
     batch = []
 
-    for obj in bucket.objects.filter(Prefix=prefix):
-        key = obj.key
-        
+    # With an s3_cache.ObjectCache, cached objects are read from disk, and an offline cache
+    # also lists from its own index
+    if cache and cache.offline:
+        objects = cache.list_keys(bucket_name, prefix)
+    else:
+        objects = ((obj.key, obj.e_tag) for obj in bucket.objects.filter(Prefix=prefix))
+        if cache:
+            objects = cache.remember(bucket_name, objects)
+
+    for key, etag in objects:
         if key.endswith('.json'):
             try:
                 parts = key.split('/')
                 if 'comments' in parts:
                     print(key)
-                    json_obj = obj.get()["Body"].read().decode('utf-8')
+                    if cache:
+                        body = cache.fetch(s3.meta.client, bucket_name, key, etag)
+                    else:
+                        body = bucket.Object(key).get()["Body"].read()
+                    json_obj = body.decode('utf-8')
                     batch.append(parse_json_to_record(json_obj))
 
                 # Insert in batches
                 if len(batch) >= batch_size:
-                    batch_insert_records(batch, conn)
+                    batch_insert_records(batch, conn, loader, table)
                     batch.clear()
             except Exception as e:
                 print(f"Error processing file {key}: {e}")
     
     # Insert any remaining records
     if batch:
-        batch_insert_records(batch, conn)
+        batch_insert_records(batch, conn, loader, table)
         
 
 def main():
@@ -148,6 +96,13 @@ def main():
 
     bucket_name = 'mirrulations'
     prefix = 'WHD/WHD-2023-0001/'
+    # 'copy' uses a binary COPY, 'executemany' the row-by-row INSERT
+    loader = 'copy'
+    # Directory of an on-disk cache of fetched objects (e.g. 'object_cache'), None to always GET;
+    # offline = True runs from it alone
+    cache_directory = None
+    offline = False
+    cache = ObjectCache(cache_directory, 20 << 30, offline) if cache_directory else None
 
     client = boto3.client('secretsmanager')
     secret_name = "rds!cluster-60fb6e4d-4475-4da5-8fe1-945933b30166"
@@ -161,18 +116,26 @@ def main():
         "dbname": "postgres",
         "user": username,
         "password": password,
-        "host": "mirrulations.cluster-ro-cb6gssewgl8x.us-east-1.rds.amazonaws.com",
+        "host": WRITER_HOST,
         "port": "5432"
     }
 
     try:
         conn = psycopg.connect(**conn_params)
-        drop_comments_table(conn)
+        # Load into an unlogged staging table, then swap it in as the new comments table
         create_comments_table(conn)
-        ingest_comments(bucket_name, prefix, conn)
+        create_staging_table(conn, reset=True)
+        ingest_comments(bucket_name, prefix, conn, loader, STAGING_TABLE, cache=cache)
+        finish_staging(conn, full_reload=True)
+        # The swapped-in table gets its search column and indexes in one pass over the finished rows
+        create_search_index(conn)
+        create_read_indexes(conn)
     finally:
         if conn:
             conn.close()
+        if cache:
+            cache.close()
+            print(cache.summary())
 
 if __name__ == '__main__':
     main()
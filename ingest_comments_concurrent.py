@@ -1,73 +1,40 @@
-import concurrent.futures
-import threading
 import boto3
+from botocore.config import Config
 import json
+import os
 import time
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
 import psycopg
 from psycopg.errors import Error
+from psycopg_pool import PoolTimeout
 
-# Lock for database connection to ensure thread safety
-db_lock = threading.Lock()
+from copy_loader import batch_insert_rows
+from entities import COMMENT_TEXT, COMMENTS, ENTITIES, create_entity_table
+from router import EntityRouter
+from attachment_text import TextLoader, fetch_text_batch, write_text_batch
+from parse_pool import create_parse_pool, parse_payloads
+from async_fetch import ingest_async
+from db_pool import WRITER_HOST, create_connection_pool
+from checkpoint import CheckpointStore
+from staging_load import STAGING_TABLE, check_checkpoint, create_staging_table, finish_staging
+from partitions import create_partitioned_comments_table, merge_partitioned_staging
+from adaptive_concurrency import AdaptiveController, CloudWatchMetrics
+from metrics import (BATCHES_FAILED, BATCHES_OK, BYTES_FETCHED, FETCH_IN_FLIGHT, FETCH_SECONDS, INSERT_IN_FLIGHT,
+                     INSERT_SECONDS, KEYS_SKIPPED, OBJECTS_FETCHED, PARSE_BATCH_SECONDS, REGISTRY, ROWS_WRITTEN, errors,
+                     start_metrics_server)
+from s3_listing import ShardProgress, list_comment_keys_sharded
+from pipeline import Pipeline, Stage
+from s3_cache import ObjectCache
+from compaction import list_shards, read_row_group, shard_row_groups
+from dedup import DuplicateFilter
+from search import create_search_index
+from rollups import create_rollup_tables
+from queries import create_read_indexes
 
 def create_comments_table(conn):
-    try:
-        with conn.cursor() as cur:
-            create_table_query = """
-            CREATE TABLE comments (
-                id TEXT PRIMARY KEY,
-                apiurl TEXT,
-                commentOn TEXT,
-                commentOnDocumentId TEXT,
-                duplicateComments INTEGER,
-                address1 TEXT,
-                address2 TEXT,
-                agencyId TEXT,
-                city TEXT,
-                category TEXT,
-                comment TEXT,
-                country TEXT,
-                docAbstract TEXT,
-                docketId TEXT,
-                documentType TEXT,
-                email TEXT,
-                fax TEXT,
-                field1 TEXT,
-                field2 TEXT,
-                fileFormats TEXT,
-                firstName TEXT,
-                govAgency TEXT,
-                govAgencyType TEXT,
-                objectId TEXT,
-                lastName TEXT,
-                legacyId TEXT,
-                modifyDate TIMESTAMP,
-                organization TEXT,
-                originalDocumentId TEXT,
-                pageCount INTEGER,
-                phone TEXT,
-                postedDate TIMESTAMP,
-                postmarkDate TIMESTAMP,
-                reasonWithdrawn TEXT,
-                receiveDate TIMESTAMP,
-                restrictReason TEXT,
-                restrictReasonType TEXT,
-                stateProvinceRegion TEXT,
-                submitterRep TEXT,
-                submitterRepAddress TEXT,
-                submitterRepCityState TEXT,
-                subtype TEXT,
-                title TEXT,
-                trackingNbr TEXT,
-                withdrawn BOOLEAN,
-                zip TEXT,
-                openForComment BOOLEAN
-            );
-            """
-            cur.execute(create_table_query)
-            conn.commit()
-            print("Table 'comments' created successfully.")
-    except Error as e:
-        print(f"An error occurred: {e}")
+    create_entity_table(conn, COMMENTS)
+    create_rollup_tables(conn)
 
 def drop_comments_table(conn):
     try:
@@ -79,102 +46,281 @@ def drop_comments_table(conn):
     except Error as e:
         print(f"An error occurred: {e}")
 
-def parse_json_to_record(json_text):
-    data = json.loads(json_text)
-    record = {
-        "id": data["data"]["id"],
-        "apiurl": data["data"]["links"]["self"],
-    }
-    attributes = data["data"]["attributes"]
-    for key in [
-        "commentOn", "commentOnDocumentId", "duplicateComments", "address1", "address2",
-        "agencyId", "city", "category", "comment", "country", "docAbstract", "docketId",
-        "documentType", "email", "fax", "field1", "field2", "fileFormats", "firstName",
-        "govAgency", "govAgencyType", "objectId", "lastName", "legacyId", "modifyDate",
-        "organization", "originalDocumentId", "pageCount", "phone", "postedDate", "postmarkDate",
-        "reasonWithdrawn", "receiveDate", "restrictReason", "restrictReasonType",
-        "stateProvinceRegion", "submitterRep", "submitterRepAddress", "submitterRepCityState",
-        "subtype", "title", "trackingNbr", "withdrawn", "zip", "openForComment"
-    ]:
-        record[key] = attributes.get(key)
-    return record
-
-def batch_insert_records(records, conn):
-    if not records:
-        return
-    columns = records[0].keys()
-    query = f"""
-    INSERT INTO comments ({", ".join(columns)})
-    VALUES ({", ".join(["%s"] * len(columns))})
-    ON CONFLICT (id) DO NOTHING;
+def fetch_body(s3, bucket_name, key, etag=None, cache=None):
+    with FETCH_IN_FLIGHT.track(), FETCH_SECONDS.time():
+        if cache:
+            body = cache.fetch(s3, bucket_name, key, etag)
+        else:
+            body = s3.get_object(Bucket=bucket_name, Key=key)["Body"].read()
+    OBJECTS_FETCHED.inc()
+    BYTES_FETCHED.inc(len(body))
+    return body
+
+
+def finish_batch(complete):
+    (BATCHES_OK if complete else BATCHES_FAILED).inc()
+    return complete
+
+
+def fetch_batch(batch, s3, bucket_name, cache=None):
+    """
+    Fetch stage: GETs every key of an (entity, keys_batch) batch, or reads it from an
+    s3_cache.ObjectCache.  Returns (entity, keys_batch, fetched, payloads), where fetched holds
+    the (key, etag) pairs to record in the checkpoint once the insert commits.
+    """
+    entity, keys_batch = batch
+    fetched = []
+    payloads = []
+    for key, etag in keys_batch:
+        try:
+            payloads.append((key, fetch_body(s3, bucket_name, key, etag, cache)))
+            fetched.append((key, etag))
+        except Exception as e:
+            print(f"Error processing file {key}: {e}")
+            errors('fetch').inc()
+    return entity, keys_batch, fetched, payloads
+
+
+def parse_batch(batch, parse_pool=None):
+    """
+    Parse stage: turns the raw bodies into rows, in a parser process when there is a pool.
+    """
+    entity, keys_batch, fetched, payloads = batch
+    with PARSE_BATCH_SECONDS.time():
+        if parse_pool is not None:
+            rows = parse_pool.submit(parse_payloads, payloads, None, entity.name).result()
+        else:
+            rows = parse_payloads(payloads, None, entity.name)
+    return entity, keys_batch, fetched, rows
+
+
+def write_batch(batch, db_pool, loader='executemany', checkpoint=None, on_conflict='nothing', table='comments',
+                controller=None, dedup=None):
+    """
+    Write stage: inserts the rows and records the batch in the checkpoint.
+    """
+    entity, keys_batch, fetched, rows = batch
+    inserted = run_limited(controller, insert_rows, rows, db_pool, loader, on_conflict, table, controller, dedup,
+                           entity)
+    if inserted and checkpoint:
+        # Comments in the staging table are lost if the database crashes before they are merged
+        checkpoint.mark_done(fetched, staged=entity is COMMENTS and table != entity.table)
+    # The batch is complete only if every key was fetched and its rows committed
+    return finish_batch(inserted and len(fetched) == len(keys_batch))
+
+
+def insert_rows(rows, db_pool, loader='executemany', on_conflict='nothing', table='comments', controller=None,
+                dedup=None, entity=COMMENTS):
+    if entity is not COMMENTS:
+        # Dockets and documents are few and small, so they skip staging and are upserted straight
+        # into their own tables; only rows whose content hash changed are rewritten
+        table, on_conflict, dedup = entity.table, 'update', None
+    started = time.time()
+    with db_pool.connection() as conn:
+        if dedup:
+            # Duplicates in the batch and ids already in comments are dropped before they are sent
+            rows = dedup.filter_rows(rows, conn)
+        with INSERT_IN_FLIGHT.track(), INSERT_SECONDS.time():
+            inserted = batch_insert_rows(rows, conn, loader, on_conflict, table, entity)
+    if controller:
+        controller.record_batch(len(rows), time.time() - started)
+    if inserted:
+        ROWS_WRITTEN.inc(len(rows))
+        if dedup:
+            dedup.add_rows(rows)
+    else:
+        errors('insert').inc()
+    print('first record:', rows[0][0] if rows else 'No records')
+    return inserted
+
+
+def ingest_comments(bucket_name, prefix, conn_params, max_workers, loader='executemany', parser_processes=None,
+                    fetcher='threads', max_in_flight=256, checkpoint=None, since=None, on_conflict='nothing',
+                    table='comments', controller=None, batch_size=1000, max_listers=16, fetch_workers=None,
+                    dedup=None, entities=('comment',), text_fetch_workers=8, text_write_workers=4, text_batch_size=50,
+                    cache=None):
+    """
+    Ingests every comment under a prefix, batch_size objects per batch.  Returns True if every batch committed.
+    With entities set to ('docket', 'document', 'comment'), the same listing also loads the dockets and
+    documents tables; table, on_conflict and dedup only apply to comments.  With 'comment_text' in entities,
+    the attachment text files are streamed into comment_text by text_fetch_workers and text_write_workers
+    threads of their own, text_batch_size files per batch.
+    The prefix may be an agency or docket folder, or '' or '/' for the whole bucket; docket folders are
+    listed max_listers at a time.  With the 'threads' fetcher, fetch_workers threads (default max_workers)
+    do the GETs.
+
+    Objects whose LastModified is older than since are skipped, which together with
+    on_conflict='update' gives a delta sync of new and changed comments.  With table set
+    to a staging table, batches are only staged and on_conflict applies at the merge.
+    With an AdaptiveController, max_workers is an upper bound and the controller decides
+    how many workers are active.  With a dedup.DuplicateFilter, rows already in comments
+    are dropped before they are sent (only for on_conflict='nothing').
+
+    With an s3_cache.ObjectCache, objects are read from local disk when cached and cached when
+    fetched; an offline cache lists and fetches from the cache alone, with the 'threads' fetcher.
     """
-    values = [tuple(record.values()) for record in records]
+    if cache and cache.offline and fetcher == 'async':
+        print("The offline cache is read with the 'threads' fetcher.")
+        fetcher = 'threads'
+    router = EntityRouter(entities, batch_size, batch_sizes={COMMENT_TEXT.name: text_batch_size})
+    text = COMMENT_TEXT in router.entities
+    # Every worker borrows from one pool, so each inserts on its own connection without a lock
+    with create_connection_pool(conn_params, max_size=max_workers + (text_write_workers if text else 0)) as db_pool:
+        if controller:
+            controller.start()
+        text_loader = None
+        try:
+            if text:
+                s3 = boto3.client('s3', region_name='us-east-1',
+                                  config=Config(max_pool_connections=text_fetch_workers))
+                text_loader = create_text_loader(s3, bucket_name, db_pool, checkpoint, text_fetch_workers,
+                                                 text_write_workers, text_batch_size, cache).start()
+            if fetcher == 'async':
+                complete = ingest_comments_async(bucket_name, prefix, db_pool, max_workers, loader,
+                                                 parser_processes, max_in_flight, checkpoint, since, on_conflict,
+                                                 table, controller, batch_size, max_listers, dedup, router,
+                                                 text_loader, cache)
+            else:
+                complete = ingest_comments_threads(bucket_name, prefix, db_pool, max_workers, loader,
+                                                   parser_processes, checkpoint, since, on_conflict, table,
+                                                   controller, batch_size, max_listers, fetch_workers, dedup, router,
+                                                   text_loader, cache)
+        except BaseException:
+            if text_loader:
+                text_loader.close(abort=True)
+            raise
+        finally:
+            if controller:
+                controller.stop()
+        if text_loader:
+            complete = text_loader.close() and complete
+        return complete
+
+
+def create_text_loader(s3, bucket_name, db_pool, checkpoint, fetch_workers, write_workers, batch_size, cache=None):
+    # Text files are large and few, so they get their own fetch and write threads instead of
+    # queueing behind the JSON batches
+    stages = [
+        Stage('text_fetch', lambda batch: fetch_text_batch(batch, s3, bucket_name, cache), fetch_workers),
+        Stage('text_write', lambda batch: write_text_batch(batch, db_pool, checkpoint), write_workers),
+    ]
+    return TextLoader(stages, batch_size, queue_size=fetch_workers, fatal=(PoolTimeout,))
+
+
+def run_limited(controller, function, *args):
+    if controller is None:
+        return function(*args)
+    # Hold one of the controller's worker slots for the whole batch
+    with controller.limiter:
+        return function(*args)
+
+
+def ingest_comments_async(bucket_name, prefix, db_pool, max_workers, loader, parser_processes, max_in_flight,
+                          checkpoint=None, since=None, on_conflict='nothing', table='comments', controller=None,
+                          batch_size=1000, max_listers=16, dedup=None, router=None, text_loader=None, cache=None):
+    # GETs run on an event loop, max_workers batches are parsed and inserted at once
+    parse_pool = create_parse_pool(parser_processes) if parser_processes != 0 else None
     try:
-        with db_lock:  # Locking for thread safety
-            with conn.cursor() as cur:
-                cur.executemany(query, values)
-            conn.commit()
-            print(f"Inserted {len(records)} records successfully.")
-    except Error as e:
-        print(f"Error inserting records: {e}")
-        conn.rollback()
+        write_rows = lambda rows, entity: run_limited(controller, insert_rows, rows, db_pool, loader, on_conflict,
+                                                      table, controller, dedup, entity)
+        return ingest_async(bucket_name, prefix, write_rows,
+                            parse_pool=parse_pool, max_in_flight=max_in_flight, batch_size=batch_size,
+                            max_writers=max_workers, checkpoint=checkpoint, since=since, max_listers=max_listers,
+                            router=router, text_loader=text_loader, cache=cache, staging=table != COMMENTS.table)
+    finally:
+        if parse_pool:
+            parse_pool.shutdown()
+
+
+def ingest_comments_threads(bucket_name, prefix, db_pool, max_workers, loader, parser_processes, checkpoint=None,
+                            since=None, on_conflict='nothing', table='comments', controller=None, batch_size=1000,
+                            max_listers=16, fetch_workers=None, dedup=None, router=None, text_loader=None, cache=None):
+    fetch_workers = fetch_workers or max_workers
+    router = router or EntityRouter(batch_size=batch_size)
+    # One client is shared by every fetch thread, so give it a connection per thread
+    s3 = boto3.client('s3', region_name='us-east-1', config=Config(max_pool_connections=fetch_workers))
+
+    progress = ShardProgress()
+
+    # Generator to yield the (key, etag) pairs of every routed entity, skipping keys the checkpoint has seen;
+    # an offline cache lists from its index instead of S3
+    def generate_keys():
+        if cache and cache.offline:
+            keys = cache.list_keys(bucket_name, prefix, router.accepts)
+        else:
+            keys = list_comment_keys_sharded(s3, bucket_name, prefix, progress, since, max_listers, router.accepts)
+            if cache:
+                keys = cache.remember(bucket_name, keys)
+        for key, etag in keys:
+            if checkpoint and checkpoint.is_done(key, etag):
+                KEYS_SKIPPED.inc()
+                continue
+            yield key, etag
+
+    # Text batches are handed to the text pipeline; waiting for room there keeps listing in step with it
+    def json_batches():
+        for entity, batch in router.batches(generate_keys()):
+            if entity is COMMENT_TEXT:
+                if text_loader is None or not text_loader.put((entity, batch)):
+                    raise RuntimeError("text pipeline is not running")
+                continue
+            yield entity, batch
 
-def process_files(keys_batch, conn_params, bucket_name):
+    # Fetch and parse in their own threads (parse in processes unless parser_processes=0), insert in max_workers
+    # threads; bounded queues between the stages keep listing from running ahead of the database
+    parse_pool = create_parse_pool(parser_processes) if parser_processes != 0 else None
     try:
-        s3 = boto3.resource('s3', region_name='us-east-1')
-        bucket = s3.Bucket(bucket_name)
-        conn = psycopg.connect(**conn_params)
-        records = []
-
-        for key in keys_batch:
-            try:
-                obj = bucket.Object(key)
-                json_obj = obj.get()["Body"].read().decode('utf-8')
-                record = parse_json_to_record(json_obj)
-                records.append(record)
-            except Exception as e:
-                print(f"Error processing file {key}: {e}")
-
-        # Batch insert records into the database
-        batch_insert_records(records, conn)
-        print('first record:', records[0]['id'])
+        stages = [
+            Stage('fetch', lambda batch: fetch_batch(batch, s3, bucket_name, cache), fetch_workers),
+            Stage('parse', lambda batch: parse_batch(batch, parse_pool), parser_processes or os.cpu_count() or 1),
+            Stage('write', lambda batch: write_batch(batch, db_pool, loader, checkpoint, on_conflict, table,
+                                                     controller, dedup), max_workers),
+        ]
+        # A failed batch stays out of the checkpoint and is retried on the next run, but losing the
+        # database or a parser process stops the run
+        complete = Pipeline(json_batches(), stages, fatal=(PoolTimeout, BrokenProcessPool)).run()
+        # Keys of a shard that failed to list were never ingested
+        return complete and not progress.failures
     finally:
-        if conn:
-            conn.close()
+        if parse_pool:
+            parse_pool.shutdown(cancel_futures=True)
+
+
+def ingest_shards(destination, prefix, conn_params, max_workers, loader='copy', on_conflict='nothing',
+                  table='comments', controller=None, dedup=None, read_workers=8):
+    """
+    Ingests comments from the docket shards written by compaction.py instead of from the bucket,
+    one row group per batch, so a full re-ingest reads a few thousand shards instead of GETting
+    every comment.  Returns True if every batch committed.  The shards only hold comments, and
+    the checkpoint is not used: a shard load is a full re-ingest.
+
+    :param destination: local directory or s3://bucket/prefix URI holding the shards.
+    :param prefix: only load the shards of this agency or docket, '' for all of them.
+    :param read_workers: threads reading and converting row groups.
+    """
+    filesystem, paths = list_shards(destination, prefix)
+    print(f"Loading {len(paths)} shards from {destination}.")
+    with create_connection_pool(conn_params, max_size=max_workers) as db_pool:
+        if controller:
+            controller.start()
+        try:
+            stages = [
+                Stage('read', lambda piece: read_row_group(filesystem, *piece), read_workers),
+                Stage('write', lambda rows: finish_batch(run_limited(controller, insert_rows, rows, db_pool, loader,
+                                                                     on_conflict, table, controller, dedup)),
+                      max_workers),
+            ]
+            return Pipeline(shard_row_groups(filesystem, paths), stages, fatal=(PoolTimeout,)).run()
+        finally:
+            if controller:
+                controller.stop()
 
 
-def ingest_comments(bucket_name, prefix, conn_params, max_workers):
-    s3 = boto3.client('s3', region_name='us-east-1')
-
-    # Generator to yield batches of file keys
-    def generate_batches():
-        paginator = s3.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-            if 'Contents' in page:
-                batch = []
-                for obj in page['Contents']:
-                    if obj['Key'].endswith('.json'):
-                        parts = obj['Key'].split('/')
-                        if 'comments' in parts:
-                            batch.append(obj['Key'])
-                            if len(batch) == 1000:
-                                yield batch
-                                batch = []
-                if batch:
-                    yield batch
-
-    # Process batches in threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for batch in generate_batches():
-            futures.append(executor.submit(process_files, batch, conn_params, bucket_name))
-        concurrent.futures.wait(futures)
-        
-        
 def main():
     bucket_name = 'mirrulations'
     #prefix = 'WHD/WHD-2023-0001/'
     #prefix = 'WHD/WHD-2019-0003/'
+    #prefix = '/'  # the whole bucket, listed one docket folder per lister
     prefix = 'WHD/'
 
     client = boto3.client('secretsmanager', region_name='us-east-1')
@@ -189,22 +335,137 @@ def main():
         "dbname": "postgres",
         "user": username,
         "password": password,
-        "host": "mirrulations.cluster-ro-cb6gssewgl8x.us-east-1.rds.amazonaws.com",
+        "host": WRITER_HOST,
         "port": "5432"
     }
 
+    # True continues from the checkpoint, False reloads everything and swaps it in at the end
+    resume = True
+    full_reload = not resume
+    checkpoint = CheckpointStore('ingest_checkpoint.sqlite3', source=bucket_name)
+
+    # True lays comments out in partitions per agency and posted year (only applies when the table is created)
+    partitioned = False
+    # Entities loaded from the one listing pass; dockets, documents and attachment text go straight to
+    # their own tables
+    entities = ('docket', 'document', 'comment', 'comment_text')
+
+    # Batches go to an unlogged staging table that is published in one statement at the end
     try:
         conn = psycopg.connect(**conn_params)
-        drop_comments_table(conn)
-        create_comments_table(conn)
+        if full_reload:
+            checkpoint.clear()
+        if partitioned:
+            create_partitioned_comments_table(conn)
+        else:
+            create_comments_table(conn)
+        for name in entities:
+            if ENTITIES[name] is not COMMENTS:
+                create_entity_table(conn, ENTITIES[name])
+        create_staging_table(conn, reset=full_reload)
+        # Keys staged before a database restart or failover emptied staging are ingested again
+        check_checkpoint(conn, checkpoint)
     finally:
         if conn:
             conn.close()
+    print(f"{checkpoint.count()} keys already ingested.")
 
-    max_workers = 15
+    # True fetches only objects changed since the last complete delta run and upserts them
+    delta = False
+    since = checkpoint.get_watermark(prefix) if delta else None
+    # 'update' rewrites existing comments whose contentHash changed and leaves the rest untouched,
+    # 'nothing' only adds new ones
+    on_conflict = 'update' if delta else 'nothing'
+    # Taken before listing, so objects written during the run are picked up by the next one
+    run_started = datetime.now(timezone.utc)
+
+    # 's3' lists and fetches every object, 'shards' loads the comments from the docket shards written by
+    # compaction.py into shard_destination (comments only, no checkpoint)
+    source = 's3'
+    shard_destination = 'shards'
+    # Upper bound on workers; with adaptive = True a controller picks how many are active
+    max_workers = 32
+    adaptive = True
+    controller = None
+    if adaptive:
+        # CloudWatch needs the cluster identifier; its connection and ACU limits are read from the cluster.
+        # PgStatActivityMetrics(conn_params) works anywhere
+        metrics = CloudWatchMetrics.for_cluster('mirrulations', conn_params, region='us-east-1')
+        controller = AdaptiveController(metrics, initial_workers=8, min_workers=2, max_workers=max_workers)
+    # 'copy' uses a binary COPY, 'executemany' the row-by-row INSERT
+    loader = 'copy'
+    # None starts one parser process per CPU, 0 parses inside the worker threads
+    parser_processes = None
+    # 'async' keeps max_in_flight GETs running on an event loop, 'threads' fetches one key at a time per worker
+    fetcher = 'async'
+    max_in_flight = 256
+    # Threads doing GETs with the 'threads' fetcher; max_workers threads insert
+    fetch_workers = 64
+    # Attachment text files run up to several MB, so they are fetched and written by threads of their own
+    text_fetch_workers = 8
+    text_write_workers = 4
+    # True drops rows whose ids are already in comments before they are sent; only used when no row may be
+    # updated or replaced, i.e. not for a delta sync or a full reload
+    deduplicate = True
+    dedup = None
+    if deduplicate and on_conflict == 'nothing' and not full_reload:
+        with psycopg.connect(**conn_params) as conn:
+            dedup = DuplicateFilter.open('comment_ids.bloom', conn, error_rate=0.001)
+    # True adds the weighted full-text search column and its GIN index after the load (see search.py)
+    search_index = True
+    # True builds the covering indexes of the docket, agency and organization listings (see queries.py)
+    read_indexes = True
+    # Directory of an on-disk cache of fetched objects (e.g. 'object_cache'), shared by every run on this machine;
+    # None always GETs
+    cache_directory = None
+    cache_max_bytes = 20 << 30
+    # True runs from the cache alone, without listing or fetching from S3
+    offline = False
+    cache = ObjectCache(cache_directory, cache_max_bytes, offline) if cache_directory else None
+    # Port for a Prometheus /metrics endpoint (e.g. 9108), None to only print the summary at the end
+    metrics_port = None
+    if metrics_port:
+        start_metrics_server(metrics_port)
     before = time.time()
-    ingest_comments(bucket_name, prefix, conn_params, max_workers)
+    try:
+        if source == 'shards':
+            complete = ingest_shards(shard_destination, prefix, conn_params, max_workers, loader, on_conflict,
+                                     STAGING_TABLE, controller, dedup)
+        else:
+            complete = ingest_comments(bucket_name, prefix, conn_params, max_workers, loader, parser_processes,
+                                       fetcher, max_in_flight, checkpoint, since, on_conflict, STAGING_TABLE,
+                                       controller, fetch_workers=fetch_workers, dedup=dedup, entities=entities,
+                                       text_fetch_workers=text_fetch_workers, text_write_workers=text_write_workers,
+                                       cache=cache)
+        if partitioned:
+            # Only the staged agencies' partitions are reloaded or merged, one partition per worker
+            published = merge_partitioned_staging(conn_params, full_reload, on_conflict, max_workers)
+        else:
+            with psycopg.connect(**conn_params) as conn:
+                published = finish_staging(conn, full_reload, on_conflict)
+        if published:
+            with psycopg.connect(**conn_params) as conn:
+                check_checkpoint(conn, checkpoint, merged=True)
+        if search_index:
+            # Built once the rows are published, not maintained row by row during the bulk load
+            with psycopg.connect(**conn_params) as conn:
+                create_search_index(conn)
+        if read_indexes:
+            with psycopg.connect(**conn_params) as conn:
+                create_read_indexes(conn)
+        # The watermark only moves after a run in which every batch committed and was merged
+        if delta and complete and published:
+            checkpoint.set_watermark(prefix, run_started)
+    finally:
+        checkpoint.close()
+        if dedup:
+            dedup.save()
+        if cache:
+            cache.close()
     after = time.time()
+    print(REGISTRY.summary(after - before))
+    if cache:
+        print(cache.summary())
     print(max_workers, after - before)
 
 if __name__ == '__main__':
@@ -1,75 +1,36 @@
-import concurrent.futures
-import threading
 import os
 import json
 import time
+from concurrent.futures.process import BrokenProcessPool
 import psycopg
 from psycopg.errors import Error
+from psycopg_pool import PoolTimeout
+
 import boto3
 
+from copy_loader import batch_insert_rows
+from entities import COMMENT_TEXT, COMMENTS, ENTITIES, create_entity_table
+from attachment_text import TextLoader, open_text_batch, write_text_batch
+from parse_pool import create_parse_pool, parse_files
+from db_pool import create_connection_pool
+from checkpoint import CheckpointStore
+from staging_load import STAGING_TABLE, check_checkpoint, create_staging_table, finish_staging
+from partitions import create_partitioned_comments_table, merge_partitioned_staging
+from local_scan import scan_comment_files
+from s3_listing import ShardProgress
+from router import EntityRouter
+from metrics import (BATCHES_FAILED, BATCHES_OK, INSERT_IN_FLIGHT, INSERT_SECONDS, KEYS_SKIPPED, PARSE_BATCH_SECONDS,
+                     REGISTRY, ROWS_WRITTEN, errors, start_metrics_server)
+from pipeline import Pipeline, Stage
+from dedup import DuplicateFilter
+from search import create_search_index
+from rollups import create_rollup_tables
+from queries import create_read_indexes
 
-# Lock for database connection to ensure thread safety
-db_lock = threading.Lock()
 
 def create_comments_table(conn):
-    try:
-        with conn.cursor() as cur:
-            create_table_query = """
-            CREATE TABLE comments (
-                id TEXT PRIMARY KEY,
-                apiurl TEXT,
-                commentOn TEXT,
-                commentOnDocumentId TEXT,
-                duplicateComments INTEGER,
-                address1 TEXT,
-                address2 TEXT,
-                agencyId TEXT,
-                city TEXT,
-                category TEXT,
-                comment TEXT,
-                country TEXT,
-                docAbstract TEXT,
-                docketId TEXT,
-                documentType TEXT,
-                email TEXT,
-                fax TEXT,
-                field1 TEXT,
-                field2 TEXT,
-                fileFormats TEXT,
-                firstName TEXT,
-                govAgency TEXT,
-                govAgencyType TEXT,
-                objectId TEXT,
-                lastName TEXT,
-                legacyId TEXT,
-                modifyDate TIMESTAMP,
-                organization TEXT,
-                originalDocumentId TEXT,
-                pageCount INTEGER,
-                phone TEXT,
-                postedDate TIMESTAMP,
-                postmarkDate TIMESTAMP,
-                reasonWithdrawn TEXT,
-                receiveDate TIMESTAMP,
-                restrictReason TEXT,
-                restrictReasonType TEXT,
-                stateProvinceRegion TEXT,
-                submitterRep TEXT,
-                submitterRepAddress TEXT,
-                submitterRepCityState TEXT,
-                subtype TEXT,
-                title TEXT,
-                trackingNbr TEXT,
-                withdrawn BOOLEAN,
-                zip TEXT,
-                openForComment BOOLEAN
-            );
-            """
-            cur.execute(create_table_query)
-            conn.commit()
-            print("Table 'comments' created successfully.")
-    except Error as e:
-        print(f"An error occurred: {e}")
+    create_entity_table(conn, COMMENTS)
+    create_rollup_tables(conn)
 
 def drop_comments_table(conn):
     try:
@@ -81,87 +42,127 @@ def drop_comments_table(conn):
     except Error as e:
         print(f"An error occurred: {e}")
 
-def parse_json_to_record(json_text):
-    data = json.loads(json_text)
-    record = {
-        "id": data["data"]["id"],
-        "apiurl": data["data"]["links"]["self"],
-    }
-    attributes = data["data"]["attributes"]
-    for key in [
-        "commentOn", "commentOnDocumentId", "duplicateComments", "address1", "address2",
-        "agencyId", "city", "category", "comment", "country", "docAbstract", "docketId",
-        "documentType", "email", "fax", "field1", "field2", "fileFormats", "firstName",
-        "govAgency", "govAgencyType", "objectId", "lastName", "legacyId", "modifyDate",
-        "organization", "originalDocumentId", "pageCount", "phone", "postedDate", "postmarkDate",
-        "reasonWithdrawn", "receiveDate", "restrictReason", "restrictReasonType",
-        "stateProvinceRegion", "submitterRep", "submitterRepAddress", "submitterRepCityState",
-        "subtype", "title", "trackingNbr", "withdrawn", "zip", "openForComment"
-    ]:
-        record[key] = attributes.get(key)
-    return record
-
-def batch_insert_records(records, conn):
-    if not records:
-        return
-    columns = records[0].keys()
-    query = f"""
-    INSERT INTO comments ({", ".join(columns)})
-    VALUES ({", ".join(["%s"] * len(columns))})
-    ON CONFLICT (id) DO NOTHING;
+def file_version(file_path):
+    # Local files have no ETag, so size and modification time stand in for one
+    stat = os.stat(file_path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+def record_batch(inserted, count):
+    if inserted:
+        ROWS_WRITTEN.inc(count)
+        BATCHES_OK.inc()
+    else:
+        errors('insert').inc()
+        BATCHES_FAILED.inc()
+
+def parse_batch(batch, parse_pool=None, read_method='buffered'):
     """
-    values = [tuple(record.values()) for record in records]
-    try:
-        with db_lock:  # Locking for thread safety
-            with conn.cursor() as cur:
-                cur.executemany(query, values)
-            conn.commit()
-            print(f"Inserted {len(records)} records successfully.")
-    except Error as e:
-        print(f"Error inserting records: {e}")
-        conn.rollback()
+    Parse stage: reads and parses an (entity, files_batch) batch, in a parser process when there is a pool.
+    """
+    entity, files_batch = batch
+    file_paths = [file_path for file_path, _ in files_batch]
+    with PARSE_BATCH_SECONDS.time():
+        if parse_pool is not None:
+            rows = parse_pool.submit(parse_files, file_paths, None, read_method, entity.name).result()
+        else:
+            rows = parse_files(file_paths, None, read_method, entity.name)
+    return entity, files_batch, rows
 
-def process_files(files_batch, conn_params):
-    try:
-        conn = psycopg.connect(**conn_params)
-        records = []
+def write_batch(batch, db_pool, loader='executemany', checkpoint=None, table='comments', dedup=None):
+    """
+    Write stage: inserts the rows and records the files in the checkpoint.
+    """
+    entity, files_batch, rows = batch
+    on_conflict = 'nothing'
+    if entity is not COMMENTS:
+        # Dockets and documents are few and small, so they skip staging and are upserted straight
+        # into their own tables; only rows whose content hash changed are rewritten
+        table, on_conflict, dedup = entity.table, 'update', None
+    with db_pool.connection() as conn:
+        if dedup:
+            # Duplicates in the batch and ids already in comments are dropped before they are sent
+            rows = dedup.filter_rows(rows, conn)
+        with INSERT_IN_FLIGHT.track(), INSERT_SECONDS.time():
+            inserted = batch_insert_rows(rows, conn, loader, on_conflict, table, entity)
+    record_batch(inserted, len(rows))
+    if inserted and dedup:
+        dedup.add_rows(rows)
+    if inserted and checkpoint:
+        # Comments in the staging table are lost if the database crashes before they are merged
+        checkpoint.mark_done(files_batch, staged=entity is COMMENTS and table != entity.table)
+    print('first record:', rows[0][0] if rows else 'No records')
+    return inserted
 
-        for file_path in files_batch:
+def ingest_comments(directory, conn_params, max_workers, loader='executemany', parser_processes=None, checkpoint=None,
+                    table='comments', batch_size=1000, max_scanners=16, read_method='buffered', dedup=None,
+                    entities=('comment',), text_workers=4, text_batch_size=50):
+    """
+    Ingests every comment file under directory.  Docket directories are scanned max_scanners
+    at a time, and batches are inserted while the scan is still going.  Returns True if every
+    batch committed and every docket directory was scanned.  With a dedup.DuplicateFilter, rows
+    already in comments are not sent.
+    With entities set to ('docket', 'document', 'comment'), the same scan also loads the
+    dockets and documents tables.  With 'comment_text' in entities, the attachment text files are
+    streamed into comment_text by text_workers threads of their own, text_batch_size files per batch.
+    """
+    router = EntityRouter(entities, batch_size, root=directory, batch_sizes={COMMENT_TEXT.name: text_batch_size})
+    text = COMMENT_TEXT in router.entities
+    progress = ShardProgress()
+
+    # Generator to yield (path, version) pairs of every routed entity, skipping files the checkpoint has seen
+    def generate_files():
+        for file_path in scan_comment_files(directory, progress, max_scanners=max_scanners, folders=router.folders,
+                                            suffixes=router.suffixes):
+            version = None
+            if checkpoint:
+                version = file_version(file_path)
+                if checkpoint.is_done(file_path, version):
+                    KEYS_SKIPPED.inc()
+                    continue
+            yield file_path, version
+
+    # Text batches are handed to the text pipeline; waiting for room there keeps the scan in step with it
+    def json_batches(text_loader):
+        for entity, batch in router.batches(generate_files()):
+            if entity is COMMENT_TEXT:
+                if not text_loader.put((entity, batch)):
+                    raise RuntimeError("text pipeline is not running")
+                continue
+            yield entity, batch
+
+    # Read and parse in processes (parser_processes=0 parses in threads), insert in max_workers threads;
+    # bounded queues between the stages keep the scan from running ahead of the database
+    parse_pool = create_parse_pool(parser_processes) if parser_processes != 0 else None
+    try:
+        # Every worker borrows from one pool, so each inserts on its own connection without a lock
+        with create_connection_pool(conn_params, max_size=max_workers + (text_workers if text else 0)) as db_pool:
+            text_loader = None
+            if text:
+                # Files on disk need no fetching, so the text pipeline opens them and streams them into COPY
+                text_loader = TextLoader([
+                    Stage('text_open', open_text_batch),
+                    Stage('text_write', lambda batch: write_text_batch(batch, db_pool, checkpoint), text_workers),
+                ], text_batch_size, queue_size=text_workers, fatal=(PoolTimeout,)).start()
+            stages = [
+                Stage('parse', lambda batch: parse_batch(batch, parse_pool, read_method),
+                      parser_processes or os.cpu_count() or 1),
+                Stage('write', lambda batch: write_batch(batch, db_pool, loader, checkpoint, table, dedup),
+                      max_workers),
+            ]
+            # A failed batch stays out of the checkpoint and is retried on the next run, but losing the
+            # database or a parser process stops the run
             try:
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    json_obj = file.read()
-                    record = parse_json_to_record(json_obj)
-                    records.append(record)
-            except Exception as e:
-                print(f"Error processing file {file_path}: {e}")
-
-        # Batch insert records into the database
-        batch_insert_records(records, conn)
-        print('first record:', records[0]['id'] if records else 'No records')
+                complete = Pipeline(json_batches(text_loader), stages, fatal=(PoolTimeout, BrokenProcessPool)).run()
+            except BaseException:
+                if text_loader:
+                    text_loader.close(abort=True)
+                raise
+            if text_loader:
+                complete = text_loader.close() and complete
+            return complete and not progress.failures
     finally:
-        if conn:
-            conn.close()
-
-def ingest_comments(directory, conn_params, max_workers):
-    # Generator to yield batches of file paths
-    def generate_batches():
-        batch = []
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if file.endswith('.json') and 'comments' in root:
-                    batch.append(os.path.join(root, file))
-                    if len(batch) == 1000:
-                        yield batch
-                        batch = []
-        if batch:
-            yield batch
-
-    # Process batches in threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for batch in generate_batches():
-            futures.append(executor.submit(process_files, batch, conn_params))
-        concurrent.futures.wait(futures)
+        if parse_pool:
+            parse_pool.shutdown(cancel_futures=True)
 
 def main():
 
@@ -177,24 +178,93 @@ def main():
         "dbname": "postgres",
         "user": username,
         "password": password,
-        "host": "mirrulationsdb.cluster-ro-cb6gssewgl8x.us-east-1.rds.amazonaws.com",
+        # Writes need the writer (cluster) endpoint, not cluster-ro
+        "host": "mirrulationsdb.cluster-cb6gssewgl8x.us-east-1.rds.amazonaws.com",
         "port": "5432"
     }
 
+    directory = '/data/data'
+
+    # True continues from the checkpoint, False reloads everything and swaps it in at the end
+    resume = True
+    full_reload = not resume
+    checkpoint = CheckpointStore('ingest_checkpoint.sqlite3', source=directory)
+
+    # True lays comments out in partitions per agency and posted year (only applies when the table is created)
+    partitioned = False
+    # Entities loaded from the one scan; dockets, documents and attachment text go straight to their own tables
+    entities = ('docket', 'document', 'comment', 'comment_text')
+
+    # Batches go to an unlogged staging table that is published in one statement at the end
     try:
         conn = psycopg.connect(**conn_params)
-        drop_comments_table(conn)
-        create_comments_table(conn)
+        if full_reload:
+            checkpoint.clear()
+        if partitioned:
+            create_partitioned_comments_table(conn)
+        else:
+            create_comments_table(conn)
+        for name in entities:
+            if ENTITIES[name] is not COMMENTS:
+                create_entity_table(conn, ENTITIES[name])
+        create_staging_table(conn, reset=full_reload)
+        # Files staged before a database restart or failover emptied staging are ingested again
+        check_checkpoint(conn, checkpoint)
     finally:
         if conn:
             conn.close()
-
-    directory = '/data/data'
+    print(f"{checkpoint.count()} files already ingested.")
 
     max_workers = 15
+    # 'copy' uses a binary COPY, 'executemany' the row-by-row INSERT
+    loader = 'copy'
+    # None starts one parser process per CPU, 0 parses inside the worker threads
+    parser_processes = None
+    # 'raw' reads each file with a single os.read, 'buffered' with open().read(), 'mmap' maps it
+    read_method = 'raw'
+    # Threads streaming attachment text files into comment_text, on top of max_workers
+    text_workers = 4
+    # True drops rows whose ids are already in comments before they are sent (not for a full reload,
+    # which replaces the table with everything staged)
+    deduplicate = True
+    dedup = None
+    if deduplicate and not full_reload:
+        with psycopg.connect(**conn_params) as conn:
+            dedup = DuplicateFilter.open('comment_ids.bloom', conn, error_rate=0.001)
+    # True adds the weighted full-text search column and its GIN index after the load (see search.py)
+    search_index = True
+    # True builds the covering indexes of the docket, agency and organization listings (see queries.py)
+    read_indexes = True
+    # Port for a Prometheus /metrics endpoint (e.g. 9108), None to only print the summary at the end
+    metrics_port = None
+    if metrics_port:
+        start_metrics_server(metrics_port)
     before = time.time()
-    ingest_comments(directory, conn_params, max_workers)
+    try:
+        ingest_comments(directory, conn_params, max_workers, loader, parser_processes, checkpoint, STAGING_TABLE,
+                        read_method=read_method, dedup=dedup, entities=entities, text_workers=text_workers)
+        if partitioned:
+            # Only the staged agencies' partitions are reloaded or merged, one partition per worker
+            published = merge_partitioned_staging(conn_params, full_reload, 'nothing', max_workers)
+        else:
+            with psycopg.connect(**conn_params) as conn:
+                published = finish_staging(conn, full_reload, on_conflict='nothing')
+        if published:
+            with psycopg.connect(**conn_params) as conn:
+                check_checkpoint(conn, checkpoint, merged=True)
+        if search_index:
+            # Built once the rows are published, not maintained row by row during the bulk load
+            with psycopg.connect(**conn_params) as conn:
+                create_search_index(conn)
+        if read_indexes:
+            with psycopg.connect(**conn_params) as conn:
+                create_read_indexes(conn)
+    finally:
+        checkpoint.close()
+        if dedup:
+            dedup.save()
     after = time.time()
+    print(REGISTRY.summary(after - before))
     print(max_workers, after - before)
 
 if __name__ == '__main__':
@@ -5,6 +5,11 @@ import psycopg
 
 import psycopg
 
+from entities import COMMENTS, create_entity_table, parse_json_to_record
+from staging_load import STAGING_TABLE, create_staging_table, finish_staging
+from db_pool import WRITER_HOST
+from rollups import create_rollup_tables
+
 def create_comments_table(conn):
     """
     Creates the 'comments' table in the PostgreSQL database.
@@ -13,66 +18,8 @@ def create_comments_table(conn):
         conn: psycopg.Connection
             A connection object for the PostgreSQL database.
     """
-    try:
-        with conn.cursor() as cur:
-            # Define the CREATE TABLE query
-            create_table_query = """
-            CREATE TABLE comments (
-                id TEXT PRIMARY KEY,
-                apiurl TEXT,
-                commentOn TEXT,
-                commentOnDocumentId TEXT,
-                duplicateComments INTEGER,
-                address1 TEXT,
-                address2 TEXT,
-                agencyId TEXT,
-                city TEXT,
-                category TEXT,
-                comment TEXT,
-                country TEXT,
-                docAbstract TEXT,
-                docketId TEXT,
-                documentType TEXT,
-                email TEXT,
-                fax TEXT,
-                field1 TEXT,
-                field2 TEXT,
-                fileFormats TEXT,
-                firstName TEXT,
-                govAgency TEXT,
-                govAgencyType TEXT,
-                objectId TEXT,
-                lastName TEXT,
-                legacyId TEXT,
-                modifyDate TIMESTAMP,
-                organization TEXT,
-                originalDocumentId TEXT,
-                pageCount INTEGER,
-                phone TEXT,
-                postedDate TIMESTAMP,
-                postmarkDate TIMESTAMP,
-                reasonWithdrawn TEXT,
-                receiveDate TIMESTAMP,
-                restrictReason TEXT,
-                restrictReasonType TEXT,
-                stateProvinceRegion TEXT,
-                submitterRep TEXT,
-                submitterRepAddress TEXT,
-                submitterRepCityState TEXT,
-                subtype TEXT,
-                title TEXT,
-                trackingNbr TEXT,
-                withdrawn BOOLEAN,
-                zip TEXT,
-                openForComment BOOLEAN
-            );
-            """
-            # Execute the CREATE TABLE query
-            cur.execute(create_table_query)
-            conn.commit()
-            print("Table 'comments' created successfully.")
-    except psycopg.Error as e:
-        print(f"An error occurred: {e}")
+    create_entity_table(conn, COMMENTS)
+    create_rollup_tables(conn)
 
 
 def drop_comments_table(conn):
@@ -94,29 +41,9 @@ def drop_comments_table(conn):
         print(f"An error occurred: {e}")
 
 
-def generate_insert_sql(json_text):
-    # Parse the JSON string
-    data = json.loads(json_text)
-    
-    # Extract relevant fields
-    record = {
-        "id": data["data"]["id"],
-        "apiurl": data["data"]["links"]["self"],
-    }
-    
-    # Extract attributes, ignoring displayProperties
-    attributes = data["data"]["attributes"]
-    for key in [
-        "commentOn", "commentOnDocumentId", "duplicateComments", "address1", "address2",
-        "agencyId", "city", "category", "comment", "country", "docAbstract", "docketId",
-        "documentType", "email", "fax", "field1", "field2", "fileFormats", "firstName",
-        "govAgency", "govAgencyType", "objectId", "lastName", "legacyId", "modifyDate",
-        "organization", "originalDocumentId", "pageCount", "phone", "postedDate", "postmarkDate",
-        "reasonWithdrawn", "receiveDate", "restrictReason", "restrictReasonType",
-        "stateProvinceRegion", "submitterRep", "submitterRepAddress", "submitterRepCityState",
-        "subtype", "title", "trackingNbr", "withdrawn", "zip", "openForComment"
-    ]:
-        record[key] = attributes.get(key)
+def generate_insert_sql(json_text, table='comments'):
+    # Parse the JSON string into the comments columns, ignoring displayProperties
+    record = parse_json_to_record(json_text)
 
     # Build SQL INSERT statement
     columns = ", ".join(record.keys())
@@ -127,7 +54,7 @@ def generate_insert_sql(json_text):
         ]
     )
     
-    sql = f"INSERT INTO comments ({columns}) VALUES ({values});"
+    sql = f"INSERT INTO {table} ({columns}) VALUES ({values});"
     return sql
 
 
@@ -143,7 +70,7 @@ def execute_query(query, conn):
         conn.rollback()
 
 
-def ingest_comments(bucket_name, prefix, conn):
+def ingest_comments(bucket_name, prefix, conn, table='comments'):
     s3 = boto3.resource('s3')
     bucket = s3.Bucket(bucket_name)
     
@@ -154,7 +81,7 @@ def ingest_comments(bucket_name, prefix, conn):
             parts = key.split('/')
             if 'comments' in parts:
                 json_obj = obj.get()["Body"].read().decode('utf-8')
-                execute_query(generate_insert_sql(json_obj), conn)
+                execute_query(generate_insert_sql(json_obj, table), conn)
 
 
 def main():
@@ -173,17 +100,19 @@ def main():
         "dbname": "postgres",
         "user": username,
         "password": password,
-        "host": "mirrulations.cluster-ro-cb6gssewgl8x.us-east-1.rds.amazonaws.com",
+        "host": WRITER_HOST,
         "port": "5432"
     }
     
     try:
         conn = psycopg.connect(**conn_params)
         
-        drop_comments_table(conn)
+        # Load into an unlogged staging table, then swap it in as the new comments table
         create_comments_table(conn)
+        create_staging_table(conn, reset=True)
         
-        ingest_comments(bucket_name, prefix, conn)
+        ingest_comments(bucket_name, prefix, conn, STAGING_TABLE)
+        finish_staging(conn, full_reload=True)
     finally:
         if conn:
             conn.close()
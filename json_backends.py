@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+
+from entities import COMMENTS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# Each backend decodes the raw bytes from Body.read() or a file and returns the
+# document as a tuple in the entity's column order (comments by default),
+# skipping the intermediate dict that parse_json_to_record builds.  The stdlib
+# backend is always available.  Every backend appends the same contentHash as
+# parse_json_to_record.
+
+
+def parse_stdlib(payload, entity=COMMENTS):
+    # json.loads accepts bytes directly and detects the encoding itself
+    return entity.extract(json.loads(payload))
+
+
+def parse_orjson(payload, entity=COMMENTS):
+    return entity.extract(orjson.loads(payload))
+
+
+simdjson_parsers = threading.local()
+
+
+def plain(value):
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    if isinstance(value, simdjson.Object):
+        return value.as_dict()
+    return value
+
+
+def parse_simdjson(payload, entity=COMMENTS):
+    # A simdjson parser reuses its buffers, so keep one per thread
+    parser = getattr(simdjson_parsers, "parser", None)
+    if parser is None:
+        parser = simdjson_parsers.parser = simdjson.Parser()
+    document = parser.parse(payload)
+    # Nested arrays and objects (fileFormats) come back as proxies; copy them out so the
+    # hash and the stored text match the other backends
+    row = entity.extract(document, plain)
+    # The parser cannot be reused while proxies into its document are alive
+    del document
+    return row
+
+
+BACKENDS = {"stdlib": parse_stdlib}
+if orjson is not None:
+    BACKENDS["orjson"] = parse_orjson
+if simdjson is not None:
+    BACKENDS["simdjson"] = parse_simdjson
+
+
+def get_parser(name=None):
+    """
+    Returns the function that turns a raw payload into an untyped row tuple.  It takes the
+    payload and, optionally, the entities.Entity to extract (comments by default).
+
+    :param name: 'orjson', 'simdjson' or 'stdlib'.  Defaults to the INGEST_JSON_BACKEND
+        environment variable, then to the fastest installed backend.
+    """
+    name = name or os.environ.get("INGEST_JSON_BACKEND")
+    if name is None:
+        name = "orjson" if orjson is not None else "simdjson" if simdjson is not None else "stdlib"
+    if name not in BACKENDS:
+        print(f"JSON backend '{name}' is not installed, using stdlib.")
+        name = "stdlib"
+    return BACKENDS[name]
+
+
+def parse_to_row(payload, parser=None, entity=COMMENTS):
+    """
+    Parses a raw payload into a tuple typed for the entity's table.
+
+    :param payload: bytes (or str) holding one JSON document.
+    :param parser: function from get_parser; defaults to get_parser().
+    :param entity: entities.Entity the document belongs to.
+    """
+    return entity.typed_row((parser or get_parser())(payload, entity))
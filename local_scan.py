@@ -0,0 +1,72 @@
+import concurrent.futures
+import os
+
+from metrics import KEYS_LISTED, LIST_SECONDS
+from s3_listing import SHARD_DEPTH, ShardProgress, fan_out
+
+# The local mirror has the bucket's layout, agency/docket/text-docket/comments/,
+# so it is scanned the same way the bucket is listed: the agency and docket
+# directories are found first, then up to max_scanners dockets are walked at
+# once with os.scandir, each directory's comment files going onto one shared
+# queue as soon as it has been read.
+
+
+def subdirectories(path):
+    with os.scandir(path) as entries:
+        return [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+
+
+def discover_directories(directory, max_scanners=16):
+    """
+    Expands the mirror root into its docket directories, one level at a time.
+    Files directly in the root or an agency directory are not comments and are skipped.
+    A directory with no subdirectories is kept as a shard of its own.
+    """
+    shards = [directory]
+    for _ in range(SHARD_DEPTH):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_scanners) as executor:
+            children = list(executor.map(subdirectories, shards))
+        shards = [child for shard, found in zip(shards, children) for child in (found or [shard])]
+    return shards
+
+
+def scan_comment_pages(shard, directory, folders=('comments',), suffixes=('.json',)):
+    """
+    Walks one docket directory and yields the comment files of each directory as a list of paths.
+    A file is a comment if one of the directories between the mirror root and it is named comments.
+
+    :param folders: names of the folders whose files are yielded, e.g. every entity's folder.
+    :param suffixes: endings of the files yielded, e.g. '.json' and the '.txt' of extracted text.
+    """
+    stack = [shard]
+    while stack:
+        path = stack.pop()
+        with LIST_SECONDS.time(), os.scandir(path) as scanner:
+            entries = list(scanner)
+        in_folder = any(part in folders for part in os.path.relpath(path, directory).split(os.sep))
+        files = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif in_folder and entry.name.endswith(suffixes):
+                files.append(entry.path)
+        KEYS_LISTED.inc(len(files))
+        if files:
+            yield files
+
+
+def scan_comment_files(directory, progress=None, max_scanners=16, folders=('comments',), suffixes=('.json',)):
+    """
+    Yields the path of every comment file in a local mirror, walking up to max_scanners
+    docket directories at once.  Paths arrive in no particular order.
+
+    :param directory: root of the mirror, holding one directory per agency.
+    :param progress: ShardProgress; after the generator is exhausted, progress.failures
+        holds the dockets that could not be walked completely.
+    :param folders: names of the folders whose files are yielded.
+    :param suffixes: endings of the files yielded.
+    """
+    progress = progress or ShardProgress()
+    shards = discover_directories(directory, max_scanners)
+    progress.start(shards)
+    yield from fan_out(shards, lambda shard: scan_comment_pages(shard, directory, folders, suffixes), progress, max_scanners)
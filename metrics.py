@@ -0,0 +1,263 @@
+import bisect
+import contextlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stage-level instrumentation of the ingest: counters, gauges and latency
+# histograms kept in process, exposed in the Prometheus text format on an
+# optional /metrics endpoint and printed as a summary at the end of a run.
+# Recording a value is a lock and an addition (a bisect for histograms), so
+# it can stay on in production runs.
+#
+# Stages: list (one S3 page), fetch (one GET or file read), parse_batch
+# (one batch sent to the parser processes) and insert (one batch write).
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name):
+        yield name, self.labels, self.value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    @contextlib.contextmanager
+    def track(self):
+        self.inc()
+        try:
+            yield
+        finally:
+            self.dec()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, labels, buckets=DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = buckets
+        # The last slot counts observations above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def quantile(self, fraction):
+        """
+        Estimates a quantile by interpolating inside its bucket, as Prometheus does.
+        """
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return None
+        rank = fraction * count
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+    def samples(self, name):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{name}_bucket", self.labels + (("le", le),), cumulative
+        yield f"{name}_sum", self.labels, total
+        yield f"{name}_count", self.labels, count
+
+
+class Registry:
+    """
+    Holds every metric by name and labels.  Asking for the same name and labels again
+    returns the same metric, so callers can look metrics up where they use them.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help_text, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(key[1])
+                self.help[name] = (help_text, cls.kind)
+            return metric
+
+    def counter(self, name, help_text="", **labels):
+        return self.get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", **labels):
+        return self.get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text="", **labels):
+        return self.get(Histogram, name, help_text, labels)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        previous = None
+        for (name, _), metric in metrics:
+            if name != previous:
+                help_text, kind = self.help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                previous = name
+            for sample, labels, value in metric.samples(name):
+                lines.append(f"{sample}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, elapsed=None):
+        """
+        Returns a readable end-of-run summary: one line per counter and gauge,
+        and count, total, mean, p50 and p99 for each histogram.
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+        lines = ["Ingest metrics" + (f" after {elapsed:.1f}s:" if elapsed else ":")]
+        for (name, labels), metric in metrics:
+            label_text = format_labels(labels)
+            if isinstance(metric, Histogram):
+                if not metric.count:
+                    continue
+                lines.append(
+                    f"  {name}{label_text}: {metric.count} observations, {metric.sum:.2f}s total, "
+                    f"mean {metric.sum / metric.count * 1000:.1f} ms, "
+                    f"p50 {metric.quantile(0.5) * 1000:.1f} ms, p99 {metric.quantile(0.99) * 1000:.1f} ms"
+                )
+            else:
+                rate = f" ({metric.value / elapsed:.1f}/s)" if elapsed and metric.kind == "counter" else ""
+                lines.append(f"  {name}{label_text}: {metric.value}{rate}")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+KEYS_LISTED = REGISTRY.counter("ingest_keys_listed_total", "Comment keys returned by listing")
+KEYS_SKIPPED = REGISTRY.counter("ingest_keys_skipped_total", "Keys skipped by the checkpoint or watermark")
+OBJECTS_FETCHED = REGISTRY.counter("ingest_objects_fetched_total", "Objects read from S3 or disk")
+BYTES_FETCHED = REGISTRY.counter("ingest_bytes_fetched_total", "Bytes read from S3 or disk")
+ROWS_WRITTEN = REGISTRY.counter("ingest_rows_written_total", "Rows committed to the database")
+QUEUE_DEPTH = REGISTRY.gauge("ingest_queue_depth", "Batches listed but not yet finished")
+SHARDS_DISCOVERED = REGISTRY.gauge("ingest_shards", "Docket prefixes found to list")
+SHARDS_LISTED = REGISTRY.counter("ingest_shards_listed_total", "Docket prefixes listed completely or failed")
+
+
+def stage_seconds(stage):
+    return REGISTRY.histogram("ingest_stage_seconds", "Seconds spent per unit of work in each stage", stage=stage)
+
+
+def in_flight(stage):
+    return REGISTRY.gauge("ingest_in_flight", "Units of work currently in each stage", stage=stage)
+
+
+def errors(stage):
+    return REGISTRY.counter("ingest_errors_total", "Failures in each stage", stage=stage)
+
+
+LIST_SECONDS = stage_seconds("list")
+FETCH_SECONDS = stage_seconds("fetch")
+PARSE_BATCH_SECONDS = stage_seconds("parse_batch")
+INSERT_SECONDS = stage_seconds("insert")
+FETCH_IN_FLIGHT = in_flight("fetch")
+PARSE_IN_FLIGHT = in_flight("parse")
+INSERT_IN_FLIGHT = in_flight("insert")
+BATCHES_OK = REGISTRY.counter("ingest_batches_total", "Batches finished, by outcome", status="ok")
+BATCHES_FAILED = REGISTRY.counter("ingest_batches_total", "Batches finished, by outcome", status="failed")
+
+
+def upsert_rows(outcome, table="comments"):
+    return REGISTRY.counter("ingest_upsert_rows_total", "Distinct rows written or compared, by table and outcome",
+                            table=table, outcome=outcome)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be logged to stderr every few seconds
+        pass
+
+
+def start_metrics_server(port=9108, host="127.0.0.1"):
+    """
+    Serves REGISTRY on http://host:port/metrics from a daemon thread.  If the port cannot
+    be bound, e.g. because another ingest is serving on it, the run goes on without it.
+
+    :return: the server, or None if it could not be started; call shutdown() on it to stop serving.
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"Not serving ingest metrics on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving ingest metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,100 @@
+import concurrent.futures
+import mmap
+import multiprocessing
+import os
+
+from entities import ENTITIES
+from json_backends import get_parser, parse_to_row
+
+# JSON decoding is CPU bound, so it runs in worker processes where the GIL
+# cannot serialize it.  Only compact row tuples travel back to the I/O threads.
+
+
+def parse_payloads(payloads, backend=None, entity='comment'):
+    """
+    Parses a batch of raw JSON payloads of one entity in a parser process.
+
+    :param payloads: list of (name, bytes or str) pairs, where name is the S3 key or file path.
+    :param backend: JSON backend name for json_backends.get_parser.
+    :param entity: name of the entity in entities.ENTITIES; names are cheaper to send to a process.
+    :return: list of tuples in the entity's column order.
+    """
+    parser = get_parser(backend)
+    entity = ENTITIES[entity]
+    rows = []
+    for name, payload in payloads:
+        try:
+            rows.append(parse_to_row(payload, parser, entity))
+        except Exception as e:
+            print(f"Error processing file {name}: {e}")
+    return rows
+
+
+def read_file(file_path, read_method='buffered'):
+    """
+    Reads a whole file as bytes.
+
+    :param read_method: 'buffered' uses open().read(); 'raw' does a single os.read sized by
+        fstat, about half the syscalls for a small JSON file; 'mmap' maps the file, which only
+        pays off for large files.
+    """
+    if read_method == 'raw':
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            data = os.read(fd, size + 1)
+            # More than size bytes means the file grew since fstat, so read the rest
+            while len(data) > size:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                data += chunk
+            return data
+        finally:
+            os.close(fd)
+    if read_method == 'mmap':
+        with open(file_path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return mapped[:]
+    with open(file_path, 'rb') as file:
+        return file.read()
+
+
+def parse_files(file_paths, backend=None, read_method='buffered', entity='comment'):
+    """
+    Reads and parses a batch of local JSON files of one entity in a parser process.
+    Reading here keeps the file contents from being pickled between processes.
+
+    :param file_paths: list of paths to JSON files.
+    :param backend: JSON backend name for json_backends.get_parser.
+    :param read_method: how files are read, see read_file.
+    :param entity: name of the entity in entities.ENTITIES.
+    :return: list of tuples in the entity's column order.
+    """
+    parser = get_parser(backend)
+    entity = ENTITIES[entity]
+    rows = []
+    for file_path in file_paths:
+        try:
+            rows.append(parse_to_row(read_file(file_path, read_method), parser, entity))
+        except Exception as e:
+            print(f"Error processing file {file_path}: {e}")
+    return rows
+
+
+def create_parse_pool(parser_processes=None):
+    """
+    Creates the process pool used by the parse stage.
+
+    :param parser_processes: number of parser processes, defaults to one per CPU.
+    :return: concurrent.futures.ProcessPoolExecutor
+    """
+    if parser_processes is None:
+        parser_processes = os.cpu_count() or 1
+    # The pool is used from I/O threads, and forking a threaded process is unsafe
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=parser_processes,
+        mp_context=multiprocessing.get_context('spawn')
+    )
@@ -0,0 +1,267 @@
+import concurrent.futures
+import re
+
+from psycopg import sql
+from psycopg.errors import Error
+
+from copy_loader import COMMENT_COLUMNS, column_type, record_upsert
+from db_pool import create_connection_pool
+from entities import SQL_TYPES
+from staging_load import STAGING_TABLE, merge_statement
+from rollups import create_rollup_tables, rebuild_rollups
+
+# Optional partitioned layout of comments: one LIST partition per agencyId,
+# each RANGE partitioned by year of postedDate.  Comments without an agency or
+# a posted date land in DEFAULT partitions.
+#
+#   comments
+#     comments_whd                 FOR VALUES IN ('WHD')
+#       comments_whd_2023          FOR VALUES FROM ('2023-01-01') TO ('2024-01-01')
+#       comments_whd_undated       DEFAULT
+#     comments_default_agency      DEFAULT
+#
+# A primary key on a partitioned table must contain every partition column,
+# and postedDate may be NULL, so each leaf gets its own unique index on id and
+# rows are merged leaf by leaf with ON CONFLICT (id).  That index cannot see
+# the same id in another leaf, so each leaf's merge first deals with staged
+# ids that already sit elsewhere (a comment whose agency or posted year
+# changed), in the same transaction as the merge.  Writing to comments
+# directly with ON CONFLICT (id) fails; load through the staging table.
+
+def create_partitioned_comments_table(conn):
+    """
+    Creates comments as a table partitioned by agencyId and postedDate.
+    Partitions themselves are created on demand by ensure_partition.
+    """
+    columns = ",\n".join(f"    {column} {SQL_TYPES[column_type(column)]}" for column in COMMENT_COLUMNS)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE TABLE IF NOT EXISTS comments (\n{columns}\n) PARTITION BY LIST (agencyId);")
+            # Tables created before contentHash existed; the column is added to every partition
+            cur.execute("ALTER TABLE comments ADD COLUMN IF NOT EXISTS contentHash TEXT;")
+            conn.commit()
+        if not is_partitioned(conn):
+            print("Table 'comments' already exists and is not partitioned; drop it to switch layouts.")
+            return
+        with conn.cursor() as cur:
+            ensure_partition(cur, None, None)
+            conn.commit()
+            print("Partitioned table 'comments' created successfully.")
+        create_rollup_tables(conn)
+    except Error as e:
+        print(f"An error occurred: {e}")
+        conn.rollback()
+
+
+def is_partitioned(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('comments');")
+        row = cur.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def agency_partition(agency):
+    if agency is None:
+        return "comments_default_agency"
+    return "comments_" + re.sub(r"[^a-z0-9]+", "_", agency.lower()).strip("_")
+
+
+def leaf_partition(agency, year):
+    return f"{agency_partition(agency)}_{year if year is not None else 'undated'}"
+
+
+def ensure_partition(cur, agency, year):
+    """
+    Creates the agency partition and its year sub-partition if they do not exist yet.
+
+    :param cur: cursor of a connection that will commit the DDL.
+    :param agency: agencyId, or None for the DEFAULT agency partition.
+    :param year: year of postedDate, or None for the DEFAULT (undated) sub-partition.
+    :return: name of the leaf partition.
+    """
+    parent = sql.Identifier(agency_partition(agency))
+    if agency is None:
+        bound = sql.SQL("DEFAULT")
+    else:
+        bound = sql.SQL("FOR VALUES IN ({})").format(sql.Literal(agency))
+    cur.execute(sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {} PARTITION OF comments {} PARTITION BY RANGE (postedDate);"
+    ).format(parent, bound))
+
+    leaf = leaf_partition(agency, year)
+    if year is None:
+        bound = sql.SQL("DEFAULT")
+    else:
+        bound = sql.SQL("FOR VALUES FROM ({}) TO ({})").format(
+            sql.Literal(f"{year}-01-01"), sql.Literal(f"{year + 1}-01-01")
+        )
+    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} {};").format(
+        sql.Identifier(leaf), parent, bound
+    ))
+    cur.execute(sql.SQL("CREATE UNIQUE INDEX IF NOT EXISTS {} ON {} (id);").format(
+        sql.Identifier(f"{leaf}_id_key"), sql.Identifier(leaf)
+    ))
+    return leaf
+
+
+def leaf_condition(conn, agency, year):
+    # Renders the staged rows that belong to one leaf as a SQL condition
+    if agency is None:
+        condition = "agencyId IS NULL"
+    else:
+        condition = f"agencyId = {sql.Literal(agency).as_string(conn)}"
+    if year is None:
+        return condition + " AND postedDate IS NULL"
+    start = sql.Literal(f"{year}-01-01").as_string(conn)
+    end = sql.Literal(f"{year + 1}-01-01").as_string(conn)
+    return condition + f" AND postedDate >= {start}::timestamp AND postedDate < {end}::timestamp"
+
+
+def truncate_agency(conn, agency):
+    """
+    Empties one agency's partition (and all its years) without touching other agencies.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("TRUNCATE {};").format(sql.Identifier(agency_partition(agency))))
+        conn.commit()
+        print(f"Partition '{agency_partition(agency)}' truncated.")
+    except Error as e:
+        print(f"An error occurred: {e}")
+        conn.rollback()
+
+
+def detach_agency(conn, agency):
+    """
+    Detaches one agency's partition from comments.  The detached table is kept, so it
+    can be inspected, dropped, or swapped for a freshly loaded one.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("ALTER TABLE comments DETACH PARTITION {};").format(
+                sql.Identifier(agency_partition(agency))
+            ))
+        conn.commit()
+        print(f"Partition '{agency_partition(agency)}' detached.")
+    except Error as e:
+        print(f"An error occurred: {e}")
+        conn.rollback()
+
+
+def merge_leaf(db_pool, agency, year, on_conflict):
+    """
+    Merges the staged rows of one leaf in one transaction.  Staged ids already stored in
+    another leaf are deleted there with 'update', so the staged version replaces them, and
+    are skipped with 'nothing', so the stored version is kept.
+
+    :return: (inserted, updated, distinct, agencies rows were deleted from).
+    """
+    leaf = leaf_partition(agency, year)
+    with db_pool.connection() as conn:
+        condition = leaf_condition(conn, agency, year)
+        elsewhere = f"comments.tableoid <> {sql.Literal(leaf).as_string(conn)}::regclass"
+        with conn.cursor() as cur:
+            moved = set()
+            insert_where = "TRUE"
+            if on_conflict == 'update':
+                cur.execute(f"""
+                DELETE FROM comments
+                WHERE id IN (SELECT id FROM {STAGING_TABLE} WHERE {condition}) AND {elsewhere}
+                RETURNING agencyId;
+                """)
+                moved = {moved_from for (moved_from,) in cur.fetchall()}
+            else:
+                insert_where = f"NOT EXISTS (SELECT 1 FROM comments WHERE comments.id = staged.id AND {elsewhere})"
+            cur.execute(merge_statement(
+                sql.Identifier(leaf).as_string(conn),
+                on_conflict,
+                condition,
+                # Leaves are merged in parallel; the rollups are recomputed per agency afterwards
+                rollups=False,
+                insert_where=insert_where
+            ))
+            inserted, updated, distinct = cur.fetchone()
+        # Leaving the block commits the delete and the merge together
+    return inserted, updated, distinct, moved
+
+
+def merge_partitioned_staging(conn_params, full_reload=False, on_conflict='update', max_workers=4):
+    """
+    Publishes the staging table into a partitioned comments table.  Each worker merges
+    one leaf partition at a time, so concurrent merges never touch the same partition.
+
+    :param conn_params: dict of keyword arguments for psycopg.connect.
+    :param full_reload: truncate the partitions of every staged agency before merging.
+    :param on_conflict: 'update' or 'nothing', as for staging_load.merge_staging.
+    :param max_workers: number of leaf partitions merged at once.
+    :return: (inserted, updated, skipped) counts, or None if any part of the merge failed.
+    """
+    merged = set()
+    step = "counting staged records"
+    with create_connection_pool(conn_params, max_size=max_workers) as db_pool:
+        try:
+            with db_pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(f"SELECT COUNT(*) FROM {STAGING_TABLE};")
+                    staged_count = cur.fetchone()[0]
+                    # Keep only the latest version of each staged id, so every id belongs to exactly one
+                    # leaf and parallel leaf merges never touch the same id.  A join on ctid against one
+                    # window pass, so the cost stays linear in the size of staging
+                    step = "removing duplicate staged ids"
+                    cur.execute(f"""
+                    DELETE FROM {STAGING_TABLE} USING (
+                        SELECT ctid, row_number() OVER (PARTITION BY id ORDER BY modifyDate DESC NULLS LAST) AS rn
+                        FROM {STAGING_TABLE}
+                    ) AS ranked
+                    WHERE {STAGING_TABLE}.ctid = ranked.ctid AND ranked.rn > 1;
+                    """)
+                    step = "creating partitions"
+                    cur.execute(f"""
+                    SELECT DISTINCT agencyId, EXTRACT(YEAR FROM postedDate)::int FROM {STAGING_TABLE};
+                    """)
+                    leaves = cur.fetchall()
+                    for agency, year in leaves:
+                        ensure_partition(cur, agency, year)
+                    if full_reload:
+                        step = "truncating partitions for the full reload"
+                        for agency in {agency for agency, _ in leaves}:
+                            cur.execute(sql.SQL("TRUNCATE {};").format(sql.Identifier(agency_partition(agency))))
+        except Error as e:
+            print(f"Error {step} before the partitioned merge: {e}")
+            return None
+
+        inserted = updated = distinct = 0
+        failed = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(merge_leaf, db_pool, agency, year, on_conflict): (agency, year)
+                for agency, year in leaves
+            }
+            for future in concurrent.futures.as_completed(futures):
+                agency, year = futures[future]
+                try:
+                    leaf_inserted, leaf_updated, leaf_distinct, moved = future.result()
+                    inserted += leaf_inserted
+                    updated += leaf_updated
+                    distinct += leaf_distinct
+                    # The rollups of the leaf's agency and of the agencies its rows moved from changed
+                    merged |= {agency} | moved
+                    print(f"Merged into {leaf_partition(agency, year)}: {leaf_inserted} inserted, "
+                          f"{leaf_updated} updated.")
+                except Error as e:
+                    print(f"Error merging into {leaf_partition(agency, year)}: {e}")
+                    failed = True
+
+        with db_pool.connection() as conn:
+            # Leaves that committed changed comments even if others failed
+            if merged:
+                rebuild_rollups(conn, merged)
+            if failed:
+                # Staged rows are kept so the merge can be repeated; merged leaves find them unchanged
+                return None
+            conn.execute(f"TRUNCATE {STAGING_TABLE};")
+
+    skipped = staged_count - inserted - updated
+    outcome = record_upsert(on_conflict, distinct, inserted, updated)
+    print(f"Merged {staged_count} staged records: {outcome}, {staged_count - distinct} staged more than once.")
+    return inserted, updated, skipped
@@ -0,0 +1,169 @@
+import queue
+import threading
+
+from metrics import QUEUE_DEPTH, REGISTRY
+
+# Staged ingest: a source (the listing) feeds a chain of stages, each with its
+# own worker threads, through bounded queues.  When a stage falls behind, the
+# queue in front of it fills and the stages upstream block, so at most
+# (queue size + workers) batches are held per stage whatever the prefix size.
+#
+#   list -> [queue] -> fetch xN -> [queue] -> parse xM -> [queue] -> write xK
+#
+# A stage function takes a batch and returns the batch for the next stage.
+# The last stage returns True once the batch is committed.  Errors a stage
+# handles itself only fail that batch; exceptions listed as fatal, and Ctrl-C,
+# stop every stage and end the run.
+
+END = object()
+
+
+def stage_queue_depth(stage):
+    return REGISTRY.gauge("ingest_stage_queue", "Batches waiting in front of each stage", stage=stage)
+
+
+class Stage:
+    """
+    :param name: stage name, for messages and metrics.
+    :param function: called with each batch from one of the stage's worker threads.
+    :param workers: number of worker threads.
+    :param queue_size: batches that may wait in front of the stage; defaults to twice the workers.
+    """
+
+    def __init__(self, name, function, workers=1, queue_size=None):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size or workers * 2)
+        self.running = workers
+        self.depth = stage_queue_depth(name)
+
+
+class Pipeline:
+    """
+    Runs batches from a source through a chain of stages.
+
+    :param source: iterable of batches, consumed on the calling thread.
+    :param stages: list of Stage, in order.
+    :param fatal: exception types that stop the whole pipeline instead of failing one batch.
+    """
+
+    def __init__(self, source, stages, fatal=()):
+        self.source = source
+        self.stages = stages
+        self.fatal = fatal
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.failed = 0
+        self.error = None
+        self.threads = []
+
+    def put(self, stage, item):
+        # Blocks while the stage is full, but gives up once the pipeline is stopped
+        while not self.stopped.is_set():
+            try:
+                stage.queue.put(item, timeout=0.5)
+                stage.depth.set(stage.queue.qsize())
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, stage):
+        while not self.stopped.is_set():
+            try:
+                item = stage.queue.get(timeout=0.5)
+                stage.depth.set(stage.queue.qsize())
+                return item
+            except queue.Empty:
+                continue
+        return END
+
+    def stop(self, error=None):
+        with self.lock:
+            if error is not None and self.error is None:
+                self.error = error
+        self.stopped.set()
+
+    def fail_batch(self):
+        with self.lock:
+            self.failed += 1
+        QUEUE_DEPTH.dec()
+
+    def work(self, index):
+        stage = self.stages[index]
+        following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        try:
+            while True:
+                batch = self.get(stage)
+                if batch is END:
+                    return
+                try:
+                    result = stage.function(batch)
+                except self.fatal as e:
+                    print(f"Fatal error in {stage.name} stage, stopping: {e}")
+                    self.stop(e)
+                    return
+                except Exception as e:
+                    print(f"Error in {stage.name} stage: {e}")
+                    self.fail_batch()
+                    continue
+                if following is None:
+                    if result:
+                        QUEUE_DEPTH.dec()
+                    else:
+                        self.fail_batch()
+                elif result is None:
+                    self.fail_batch()
+                else:
+                    self.put(following, result)
+        finally:
+            with self.lock:
+                stage.running -= 1
+                last = stage.running == 0
+            # The last worker out tells every worker of the next stage that nothing more is coming
+            if last and following is not None:
+                for _ in range(following.workers):
+                    self.put(following, END)
+
+    def run(self):
+        """
+        Runs the pipeline to the end.
+
+        :return: True if every batch made it through every stage.
+        :raises: the first fatal error, or KeyboardInterrupt, after all stages have stopped.
+        """
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self.work, args=(index,), name=f"{stage.name}-{worker}",
+                                          daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        first = self.stages[0]
+        try:
+            for batch in self.source:
+                QUEUE_DEPTH.inc()
+                if not self.put(first, batch):
+                    break
+            for _ in range(first.workers):
+                self.put(first, END)
+            for thread in self.threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt as e:
+            print("Interrupted, stopping the pipeline.")
+            self.stop(e)
+        except BaseException as e:
+            print(f"Error listing batches, stopping: {e}")
+            self.stop(e)
+        finally:
+            for thread in self.threads:
+                # Workers notice the stop within one queue timeout; a batch already being
+                # written finishes first, so its checkpoint stays consistent
+                thread.join()
+            close = getattr(self.source, "close", None)
+            if close:
+                close()
+        if self.error is not None:
+            raise self.error
+        return self.failed == 0
@@ -0,0 +1,202 @@
+import json
+
+import boto3
+from psycopg.errors import Error
+
+from db_pool import READER_HOST, create_connection_pool
+
+# Read side of the comments table: comments of a docket, an agency or a
+# submitter organization, in postedDate order, one page at a time.
+#
+# Pages are keyset-paginated on (postedDate, id): the next page starts right
+# after the last row of the previous one, so page 500 is read with the same
+# short index range scan as page 1, where OFFSET would read and discard every
+# row before it.  Each listing has an index on (filter column, postedDate, id)
+# that INCLUDEs the bounded result columns (the docket and agency ids).  The
+# free-text title and organization are read from the heap: a btree entry must
+# fit in about a third of a page, so one long title would fail the whole build.
+# For the same reason the organization listing indexes only a prefix of the
+# organization and rechecks the full value against the row.
+#
+# Rows without a postedDate come last, ordered by id.  They are read as a
+# separate range of the same index rather than with an OR, which would stop
+# Postgres from walking the index in order.
+#
+# Point these at the reader endpoint (db_pool.READER_HOST); replicas trail the
+# writer by a few milliseconds, so a page read right after a load may not show
+# the newest rows yet.
+
+RESULT_COLUMNS = ["id", "docketId", "agencyId", "organization", "title", "postedDate"]
+
+# listing name: (column it filters on, covering index)
+LISTINGS = {
+    "docket": ("docketId", "comments_docket_posted_idx"),
+    "agency": ("agencyId", "comments_agency_posted_idx"),
+    "organization": ("organization", "comments_organization_posted_idx"),
+}
+
+# Result columns of unbounded length, kept out of INCLUDE and indexed by a prefix when filtered on
+FREE_TEXT_COLUMNS = ("title", "organization")
+KEY_PREFIX_LENGTH = 200
+
+
+def index_key(column):
+    return f"left({column}, {KEY_PREFIX_LENGTH})" if column in FREE_TEXT_COLUMNS else column
+
+
+def listing_queries(column):
+    # Fixed query text per listing, so each connection prepares it once and reuses the plan
+    columns = ", ".join(RESULT_COLUMNS)
+    match = f"{column} = %(value)s"
+    if column in FREE_TEXT_COLUMNS:
+        # The prefix condition is what lets Postgres use the index on the prefix
+        match = f"{index_key(column)} = left(%(value)s, {KEY_PREFIX_LENGTH}) AND {match}"
+    first = f"""
+    SELECT {columns} FROM comments
+    WHERE {match} AND postedDate IS NOT NULL
+    ORDER BY postedDate, id LIMIT %(limit)s;
+    """
+    after = f"""
+    SELECT {columns} FROM comments
+    WHERE {match} AND (postedDate, id) > (%(posted)s, %(id)s)
+    ORDER BY postedDate, id LIMIT %(limit)s;
+    """
+    undated = f"""
+    SELECT {columns} FROM comments
+    WHERE {match} AND postedDate IS NULL AND id > %(id)s
+    ORDER BY id LIMIT %(limit)s;
+    """
+    return first, after, undated
+
+
+QUERIES = {name: listing_queries(column) for name, (column, _) in LISTINGS.items()}
+
+
+def create_read_indexes(conn, vacuum=True):
+    """
+    Builds the index of every listing, each in its own transaction, so one that fails
+    does not undo the others.  Run it after the bulk load, so each index is built in
+    one sorted pass instead of being updated row by row.
+
+    :param conn: psycopg.Connection to the writer; comments must already exist.
+    :param vacuum: VACUUM ANALYZE comments afterwards, so the visibility map is up to date.
+    :return: True if every index was built.
+    """
+    built = []
+    for name, (column, index) in LISTINGS.items():
+        included = [other for other in RESULT_COLUMNS
+                    if other not in (column, "postedDate", "id") and other not in FREE_TEXT_COLUMNS]
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL maintenance_work_mem = '1GB';")
+                cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS {index} ON comments ({index_key(column)}, postedDate, id)
+                INCLUDE ({", ".join(included)});
+                """)
+            conn.commit()
+            built.append(index)
+        except Error as e:
+            print(f"Error creating the {name} listing index {index}: {e}")
+            conn.rollback()
+    if built:
+        print(f"Indexes {', '.join(built)} ready.")
+    if len(built) < len(LISTINGS):
+        return False
+    if vacuum:
+        # VACUUM cannot run inside a transaction
+        autocommit = conn.autocommit
+        conn.autocommit = True
+        try:
+            conn.execute("VACUUM (ANALYZE) comments;")
+        except Error as e:
+            print(f"Error vacuuming comments: {e}")
+        finally:
+            conn.autocommit = autocommit
+    return True
+
+
+def create_read_pool(conn_params, max_size=8):
+    """
+    Opens a pool for queries.  Pass the reader endpoint in conn_params.
+    """
+    return create_connection_pool(conn_params, min_size=1, max_size=max_size, name="queries")
+
+
+def fetch_page(cur, query, params):
+    cur.execute(query, params, prepare=True)
+    return [dict(zip(RESULT_COLUMNS, row)) for row in cur.fetchall()]
+
+
+def list_comments(conn, listing, value, limit=100, after=None):
+    """
+    Returns one page of the comments of a docket, agency or organization, oldest first.
+
+    :param conn: psycopg.Connection, preferably to the reader endpoint.
+    :param listing: 'docket', 'agency' or 'organization'.
+    :param value: the docketId, agencyId or organization to list.
+    :param limit: rows per page.
+    :param after: the cursor returned with the previous page, or None for the first page.
+    :return: (rows, cursor); rows are dicts of RESULT_COLUMNS, and cursor is None once
+        there are no more pages.
+    """
+    first, dated, undated = QUERIES[listing]
+    rows = []
+    with conn.cursor() as cur:
+        if after is None:
+            rows = fetch_page(cur, first, {"value": value, "limit": limit})
+        elif after[0] is not None:
+            rows = fetch_page(cur, dated, {"value": value, "posted": after[0], "id": after[1], "limit": limit})
+        # Once the dated rows run out, the page is topped up from the undated ones
+        if len(rows) < limit:
+            last_id = after[1] if after is not None and after[0] is None else ""
+            rows += fetch_page(cur, undated, {"value": value, "id": last_id, "limit": limit - len(rows)})
+    conn.commit()
+    cursor = None
+    if len(rows) == limit:
+        cursor = (rows[-1]["postedDate"], rows[-1]["id"])
+    return rows, cursor
+
+
+def comments_by_docket(conn, docket_id, limit=100, after=None):
+    return list_comments(conn, "docket", docket_id, limit, after)
+
+
+def comments_by_agency(conn, agency_id, limit=100, after=None):
+    return list_comments(conn, "agency", agency_id, limit, after)
+
+
+def comments_by_organization(conn, organization, limit=100, after=None):
+    return list_comments(conn, "organization", organization, limit, after)
+
+
+def main():
+    client = boto3.client('secretsmanager', region_name='us-east-1')
+    secret_name = "mirrulationsdb/postgres/master"
+    response = client.get_secret_value(SecretId=secret_name)
+    secret = json.loads(response['SecretString'])
+
+    # Queries go to the reader endpoint, never the writer the ingest uses
+    conn_params = {
+        "dbname": "postgres",
+        "user": secret['username'],
+        "password": secret['password'],
+        "host": READER_HOST,
+        "port": "5432"
+    }
+
+    docket_id = 'WHD-2023-0001'
+    pages = 3
+
+    with create_read_pool(conn_params) as pool, pool.connection() as conn:
+        cursor = None
+        for number in range(pages):
+            rows, cursor = comments_by_docket(conn, docket_id, after=cursor)
+            print(f"Page {number + 1}:")
+            for row in rows:
+                print(f"  {row['postedDate']} {row['id']} {row['organization'] or ''}")
+            if cursor is None:
+                break
+
+
+if __name__ == '__main__':
+    main()
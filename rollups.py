@@ -0,0 +1,220 @@
+import json
+
+import boto3
+import psycopg
+from psycopg.errors import Error
+
+from db_pool import WRITER_HOST
+
+# Dashboard counts kept next to comments, so a chart reads a few thousand
+# rollup rows instead of grouping millions of comments on every refresh:
+#
+#   comment_counts_daily    per docket and day of postedDate
+#   comment_counts_agency   per agency
+#
+# each holding the number of comments, the sum of duplicateComments and the
+# number withdrawn.  Comments without a postedDate are counted on day
+# 'infinity', and a missing docket or agency is ''.
+#
+# The rollups move in the same statement that writes comments: the INSERT
+# returns the rows it inserted or updated, the old versions of updated rows
+# are read from the statement's snapshot, and the difference is upserted
+# into both tables, grouped, so a batch costs one row per docket and day it
+# touches.  Rollup keys are upserted in sorted order, so concurrent batches
+# wait on each other instead of deadlocking.  A full reload, and a partitioned
+# merge, recompute the affected rollups from comments instead.
+
+DAILY_TABLE = "comment_counts_daily"
+AGENCY_TABLE = "comment_counts_agency"
+
+# Columns the writing INSERT must RETURN, ahead of its inserted flag
+RETURNING = "id, docketId, agencyId, postedDate, duplicateComments, withdrawn"
+
+
+def counts(weight):
+    # The three counts of a group of rows, each row counted weight times (-1 takes an old version away)
+    return f"""SUM({weight}) AS comments,
+           SUM({weight} * COALESCE(duplicateComments, 0)) AS duplicateComments,
+           COALESCE(SUM({weight}) FILTER (WHERE withdrawn), 0) AS withdrawn"""
+
+
+DAILY_KEY = "COALESCE(docketId, ''), COALESCE(postedDate::date, 'infinity'::date)"
+AGENCY_KEY = "COALESCE(agencyId, '')"
+
+ADD_COUNTS = """comments = rollup.comments + EXCLUDED.comments,
+        duplicateComments = rollup.duplicateComments + EXCLUDED.duplicateComments,
+        withdrawn = rollup.withdrawn + EXCLUDED.withdrawn"""
+
+
+def create_rollup_tables(conn):
+    """
+    Creates the rollup tables if they do not exist yet.  New tables are empty; run
+    rebuild_rollups once if comments already holds rows.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {DAILY_TABLE} (
+                docketId TEXT NOT NULL,
+                day DATE NOT NULL,
+                agencyId TEXT,
+                comments BIGINT NOT NULL DEFAULT 0,
+                duplicateComments BIGINT NOT NULL DEFAULT 0,
+                withdrawn BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (docketId, day)
+            );
+            """)
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {DAILY_TABLE}_agency_idx ON {DAILY_TABLE} (agencyId, day);")
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {AGENCY_TABLE} (
+                agencyId TEXT PRIMARY KEY,
+                comments BIGINT NOT NULL DEFAULT 0,
+                duplicateComments BIGINT NOT NULL DEFAULT 0,
+                withdrawn BIGINT NOT NULL DEFAULT 0
+            );
+            """)
+            conn.commit()
+            print(f"Tables '{DAILY_TABLE}' and '{AGENCY_TABLE}' created successfully.")
+    except Error as e:
+        print(f"An error occurred: {e}")
+        conn.rollback()
+
+
+def rollup_ctes(target, source, on_conflict='update'):
+    """
+    Builds the CTEs that apply a write to the rollups.  They follow a CTE named merged,
+    an INSERT into target that RETURNs RETURNING and (xmax = 0) AS inserted, and
+    start with a comma.
+
+    :param target: the table merged inserts into, to read the old versions of updated rows.
+    :param source: table or CTE holding the rows being written.
+    :param on_conflict: with 'nothing' no row is updated, so no old versions are read.
+    """
+    changes = f"SELECT 1 AS sign, {RETURNING} FROM merged"
+    previous = ""
+    if on_conflict == 'update':
+        # The statement's snapshot still holds the versions it is replacing
+        previous = f""",
+    previous AS (
+        SELECT {RETURNING} FROM {target} WHERE id IN (SELECT id FROM {source})
+    )"""
+        changes += f"""
+        UNION ALL
+        SELECT -1, {", ".join(f"previous.{column}" for column in RETURNING.split(", "))}
+        FROM previous JOIN merged USING (id) WHERE NOT merged.inserted"""
+    return f"""{previous},
+    changes AS (
+        {changes}
+    ), daily AS (
+        INSERT INTO {DAILY_TABLE} AS rollup (docketId, day, agencyId, comments, duplicateComments, withdrawn)
+        SELECT {DAILY_KEY}, MAX(agencyId), {counts("sign")}
+        FROM changes GROUP BY 1, 2 ORDER BY 1, 2
+        ON CONFLICT (docketId, day) DO UPDATE SET {ADD_COUNTS},
+        agencyId = COALESCE(EXCLUDED.agencyId, rollup.agencyId)
+    ), agency AS (
+        INSERT INTO {AGENCY_TABLE} AS rollup (agencyId, comments, duplicateComments, withdrawn)
+        SELECT {AGENCY_KEY}, {counts("sign")}
+        FROM changes GROUP BY 1 ORDER BY 1
+        ON CONFLICT (agencyId) DO UPDATE SET {ADD_COUNTS}
+    )"""
+
+
+def recompute_rollups(cur, agencies=None):
+    """
+    Replaces the rollups with counts recomputed from comments, inside the caller's transaction.
+
+    :param agencies: only recompute these agencyIds (None for comments without one), or None for all.
+    """
+    daily_where = agency_where = where = ""
+    params = ()
+    if agencies is not None:
+        keys = sorted({agency or '' for agency in agencies})
+        daily_where = "WHERE COALESCE(agencyId, '') = ANY(%s)"
+        agency_where = "WHERE agencyId = ANY(%s)"
+        where = "WHERE COALESCE(agencyId, '') = ANY(%s)"
+        params = (keys,)
+    cur.execute(f"DELETE FROM {DAILY_TABLE} {daily_where};", params)
+    cur.execute(f"DELETE FROM {AGENCY_TABLE} {agency_where};", params)
+    cur.execute(f"""
+    INSERT INTO {DAILY_TABLE} (docketId, day, agencyId, comments, duplicateComments, withdrawn)
+    SELECT {DAILY_KEY}, MAX(agencyId), {counts(1)}
+    FROM comments {where} GROUP BY 1, 2;
+    """, params)
+    cur.execute(f"""
+    INSERT INTO {AGENCY_TABLE} (agencyId, comments, duplicateComments, withdrawn)
+    SELECT {AGENCY_KEY}, {counts(1)}
+    FROM comments {where} GROUP BY 1;
+    """, params)
+
+
+def rebuild_rollups(conn, agencies=None):
+    """
+    Recomputes the rollups from comments in one transaction; dashboards keep seeing the
+    old counts until it commits.
+
+    :param agencies: only rebuild these agencyIds, or None for all of them.
+    :return: True if the rollups were rebuilt.
+    """
+    try:
+        with conn.cursor() as cur:
+            recompute_rollups(cur, agencies)
+        conn.commit()
+        scope = "all agencies" if agencies is None else f"{len(agencies)} agencies"
+        print(f"Rebuilt '{DAILY_TABLE}' and '{AGENCY_TABLE}' for {scope}.")
+        return True
+    except Error as e:
+        print(f"Error rebuilding the rollups: {e}")
+        conn.rollback()
+        return False
+
+
+def daily_counts(conn, docket_id):
+    """
+    Returns (day, comments, duplicateComments, withdrawn) for every day of a docket.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+        SELECT day, comments, duplicateComments, withdrawn FROM {DAILY_TABLE}
+        WHERE docketId = %s AND comments <> 0 ORDER BY day;
+        """, (docket_id,))
+        rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+
+def agency_counts(conn):
+    """
+    Returns (agencyId, comments, duplicateComments, withdrawn) for every agency, largest first.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""
+        SELECT agencyId, comments, duplicateComments, withdrawn FROM {AGENCY_TABLE}
+        WHERE comments <> 0 ORDER BY comments DESC;
+        """)
+        rows = cur.fetchall()
+    conn.commit()
+    return rows
+
+
+def main():
+    # Rebuilds every rollup from scratch, e.g. after rows were written to comments outside the ingest scripts
+    client = boto3.client('secretsmanager', region_name='us-east-1')
+    secret_name = "mirrulationsdb/postgres/master"
+    response = client.get_secret_value(SecretId=secret_name)
+    secret = json.loads(response['SecretString'])
+
+    conn_params = {
+        "dbname": "postgres",
+        "user": secret['username'],
+        "password": secret['password'],
+        "host": WRITER_HOST,
+        "port": "5432"
+    }
+
+    with psycopg.connect(**conn_params) as conn:
+        create_rollup_tables(conn)
+        rebuild_rollups(conn)
+
+
+if __name__ == '__main__':
+    main()
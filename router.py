@@ -0,0 +1,75 @@
+import os
+
+from entities import ENTITIES, entity_for_path
+from metrics import REGISTRY
+
+# One listing pass feeds every entity.  Each key (or local path) is classified
+# by the folder it sits in and grouped into batches of a single entity, so
+# dockets, documents and comments share the listing, the connection pool and
+# the pipeline instead of each needing a run of its own.
+
+
+def keys_routed(entity):
+    return REGISTRY.counter("ingest_keys_routed_total", "Listed keys sent to each entity's loader", entity=entity)
+
+
+class EntityRouter:
+    """
+    Sorts the keys of one listing into per-entity batches.
+
+    :param entities: names of the entities to ingest, from entities.ENTITIES.
+    :param batch_size: keys per batch.
+    :param root: for local paths, the mirror root the folders are relative to; None for S3 keys.
+    :param batch_sizes: optional dict of entity name to batch size, for entities whose files are much larger.
+    """
+
+    def __init__(self, entities=('comment',), batch_size=1000, root=None, batch_sizes=None):
+        self.entities = [ENTITIES[name] for name in entities]
+        self.folders = tuple(entity.folder for entity in self.entities)
+        self.suffixes = tuple({entity.suffix for entity in self.entities})
+        self.batch_size = batch_size
+        self.batch_sizes = {entity.name: (batch_sizes or {}).get(entity.name, batch_size) for entity in self.entities}
+        self.root = root
+        self.counters = {entity.name: keys_routed(entity.name) for entity in self.entities}
+
+    def entity_for(self, name):
+        """
+        Returns the Entity a key or path belongs to, or None if it is not ingested.
+        """
+        if self.root is None:
+            return entity_for_path(name, self.entities)
+        return entity_for_path(os.path.relpath(name, self.root), self.entities, os.sep)
+
+    def accepts(self, name):
+        return self.entity_for(name) is not None
+
+    def route(self, name):
+        """
+        Same as entity_for, counting the key towards its entity.
+        """
+        entity = self.entity_for(name)
+        if entity is not None:
+            self.counters[entity.name].inc()
+        return entity
+
+    def batches(self, items):
+        """
+        Groups items into batches of one entity each.  A batch is yielded as soon as it is
+        full, and the partly filled batches of every entity at the end.
+
+        :param items: iterable of tuples whose first element is the key or path.
+        :return: generator of (entity, batch) pairs.
+        """
+        pending = {entity.name: [] for entity in self.entities}
+        for item in items:
+            entity = self.route(item[0])
+            if entity is None:
+                continue
+            batch = pending[entity.name]
+            batch.append(item)
+            if len(batch) == self.batch_sizes[entity.name]:
+                yield entity, batch
+                pending[entity.name] = []
+        for entity in self.entities:
+            if pending[entity.name]:
+                yield entity, pending[entity.name]
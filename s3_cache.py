@@ -0,0 +1,371 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from metrics import REGISTRY
+
+# Development runs fetch the same objects again and again, so an ObjectCache
+# keeps every object it fetches in a local directory, keyed by bucket, key
+# and ETag: a changed object has a new ETag, so a stale copy is never served,
+# only left to age out.  Objects are written to a temporary file and renamed
+# into place, so readers in other threads or processes see a whole file or
+# none.
+#
+# An SQLite index next to the objects records the size and last use of each
+# one, so eviction finds the total size and the least recently used objects
+# with two queries instead of stat-ing every file; only one process evicts at
+# a time, under a lock file.  Uses are written to the index in batches.
+#
+# Listings are remembered in the same index, so a run with offline=True can
+# list and fetch from the cache alone.
+
+CHUNK_SIZE = 1 << 20
+
+# Eviction brings the cache back to this fraction of max_bytes, and is checked
+# again after a twentieth of max_bytes has been written
+EVICT_TO = 0.9
+EVICT_EVERY = 20
+
+# Temporary files left behind by a crashed process are removed after this many seconds
+STALE_SECONDS = 3600
+
+# Rows written to the index at once, and keys read from it at once by list_keys
+INDEX_BATCH = 1000
+
+CACHE_HITS = REGISTRY.counter("ingest_cache_requests_total", "Object cache lookups, by result", result="hit")
+CACHE_MISSES = REGISTRY.counter("ingest_cache_requests_total", "Object cache lookups, by result", result="miss")
+CACHE_BYTES_SERVED = REGISTRY.counter("ingest_cache_bytes_served_total", "Bytes read from the object cache")
+CACHE_EVICTED = REGISTRY.counter("ingest_cache_evicted_total", "Objects evicted from the object cache")
+
+
+class CacheMiss(Exception):
+    """
+    Raised by an offline cache for an object it does not hold.
+    """
+
+
+class ObjectCache:
+    """
+    On-disk cache of S3 objects keyed by bucket, key and ETag, evicting the least recently used
+    objects once they take up more than max_bytes.  One directory can be shared by every worker
+    and process on a machine.
+
+    :param directory: location of the cache; created if missing.
+    :param max_bytes: size the cached objects may take up.
+    :param offline: serve only from the cache; a miss raises CacheMiss instead of going to S3.
+    """
+
+    def __init__(self, directory, max_bytes=10 << 30, offline=False):
+        self.directory = directory
+        self.objects = os.path.join(directory, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.written = 0
+        self.listed = []
+        self.used = {}
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), timeout=60,
+                                    check_same_thread=False)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS listings (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                PRIMARY KEY (bucket, key)
+            );
+            """)
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS objects (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                used REAL NOT NULL
+            );
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS objects_used ON objects (used);")
+            self.conn.commit()
+            indexed = self.conn.execute("SELECT EXISTS (SELECT 1 FROM objects);").fetchone()[0]
+        if not indexed:
+            self.index_existing()
+
+    def path(self, bucket_name, key, etag):
+        # Listings and GETs both quote the ETag, but not every client does
+        etag = etag.strip('"')
+        digest = hashlib.sha256(f"{bucket_name}\0{key}\0{etag}".encode()).hexdigest()
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def index_existing(self):
+        """
+        Adds the objects already on disk to the index, for a directory cached into before the
+        index recorded them.  Their file times stand in for their last use.
+        """
+        found = []
+        for shard in os.scandir(self.objects):
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                with contextlib.suppress(FileNotFoundError):
+                    stat = entry.stat()
+                    found.append((entry.path, stat.st_size, stat.st_mtime))
+        if found:
+            self.write_used(found)
+
+    def touch(self, path, size):
+        # Marks an object recently used; kept in memory and written to the index in batches
+        with self.lock:
+            self.used[path] = (size, time.time())
+            if len(self.used) < INDEX_BATCH:
+                return
+            used, self.used = self.used, {}
+        self.write_used([(path, size, when) for path, (size, when) in used.items()])
+
+    def flush_used(self):
+        with self.lock:
+            used, self.used = self.used, {}
+        if used:
+            self.write_used([(path, size, when) for path, (size, when) in used.items()])
+
+    def write_used(self, used):
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO objects (path, size, used) VALUES (?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET size = excluded.size, used = max(used, excluded.used);
+                """,
+                used
+            )
+            self.conn.commit()
+
+    def hit(self, path, size):
+        self.touch(path, size)
+        CACHE_HITS.inc()
+        CACHE_BYTES_SERVED.inc(size)
+
+    def get(self, bucket_name, key, etag):
+        """
+        Returns the cached body of an object, or None if it is not cached.
+        """
+        path = self.path(bucket_name, key, etag)
+        try:
+            with open(path, 'rb') as file:
+                body = file.read()
+        except FileNotFoundError:
+            CACHE_MISSES.inc()
+            return None
+        self.hit(path, len(body))
+        return body
+
+    def store(self, bucket_name, key, etag, chunks):
+        """
+        Writes an object from an iterable of bytes and returns its path.
+        """
+        path = self.path(bucket_name, key, etag)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.tmp-', delete=False) as file:
+            try:
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                file.close()
+                os.remove(file.name)
+                raise
+        # A rename is atomic, so a concurrent reader never sees a partial object
+        os.replace(file.name, path)
+        self.touch(path, size)
+        self.added(size)
+        return path
+
+    def put(self, bucket_name, key, etag, body):
+        self.store(bucket_name, key, etag, [body])
+
+    def fetch(self, s3, bucket_name, key, etag):
+        """
+        Returns the body of an object, from the cache or else with a GET that is then cached.
+
+        :param s3: boto3 S3 client used on a miss.
+        :param etag: the ETag the object was listed with.
+        """
+        body = self.get(bucket_name, key, etag)
+        if body is not None:
+            return body
+        if self.offline:
+            raise CacheMiss(key)
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+        body = response["Body"].read()
+        # Cached under the ETag of what was read, in case the object changed since it was listed
+        self.put(bucket_name, key, response["ETag"], body)
+        return body
+
+    def open(self, s3, bucket_name, key, etag):
+        """
+        Like fetch, but returns a binary file object positioned at the start of the object.
+        A miss is streamed to the cache CHUNK_SIZE at a time instead of being read whole.
+        """
+        path = self.path(bucket_name, key, etag)
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            CACHE_MISSES.inc()
+        else:
+            self.hit(path, os.fstat(file.fileno()).st_size)
+            return file
+        if self.offline:
+            raise CacheMiss(key)
+        response = s3.get_object(Bucket=bucket_name, Key=key)
+        path = self.store(bucket_name, key, response["ETag"], response["Body"].iter_chunks(CHUNK_SIZE))
+        # An open file stays readable even if another process evicts it
+        return open(path, 'rb')
+
+    def added(self, size):
+        with self.lock:
+            self.written += size
+            due = self.written >= self.max_bytes // EVICT_EVERY
+            if due:
+                self.written = 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes the least recently used objects until the cache is back under EVICT_TO of
+        max_bytes.  Returns the number of objects deleted.
+        """
+        self.flush_used()
+        evicted = 0
+        with open(os.path.join(self.directory, 'evict.lock'), 'w') as lock_file:
+            # Two processes evicting at once would both delete down to the target
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.remove_stale()
+            with self.lock:
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM objects;").fetchone()[0]
+            while total > self.max_bytes * EVICT_TO:
+                with self.lock:
+                    oldest = self.conn.execute(
+                        "SELECT path, size FROM objects ORDER BY used LIMIT ?;", (INDEX_BATCH,)
+                    ).fetchall()
+                if not oldest:
+                    break
+                removed = []
+                for path, size in oldest:
+                    if total <= self.max_bytes * EVICT_TO:
+                        break
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+                        evicted += 1
+                    removed.append((path,))
+                    total -= size
+                with self.lock:
+                    self.conn.executemany("DELETE FROM objects WHERE path = ?;", removed)
+                    self.conn.commit()
+        CACHE_EVICTED.inc(evicted)
+        return evicted
+
+    def remove_stale(self):
+        # Crashes are rare, so each pass sweeps a single shard directory for their temporary files
+        shards = os.listdir(self.objects)
+        if not shards:
+            return
+        stale = time.time() - STALE_SECONDS
+        for entry in os.scandir(os.path.join(self.objects, random.choice(shards))):
+            if entry.name.startswith('.tmp-'):
+                with contextlib.suppress(FileNotFoundError):
+                    if entry.stat().st_mtime < stale:
+                        os.remove(entry.path)
+
+    def record(self, bucket_name, key, etag):
+        """
+        Adds a listed key to the index that offline runs list from.  Keys are written in
+        batches; close() writes the rest.
+        """
+        self.record_page(bucket_name, [(key, etag)])
+
+    def record_page(self, bucket_name, keys):
+        """
+        Same as record for a list of (key, etag) pairs, e.g. one listing page.
+        """
+        with self.lock:
+            self.listed.extend((bucket_name, key, etag) for key, etag in keys)
+            if len(self.listed) < INDEX_BATCH:
+                return
+            listed, self.listed = self.listed, []
+        self.write_listed(listed)
+
+    def write_listed(self, listed):
+        with self.lock:
+            self.conn.executemany(
+                """
+                INSERT INTO listings (bucket, key, etag) VALUES (?, ?, ?)
+                ON CONFLICT (bucket, key) DO UPDATE SET etag = excluded.etag;
+                """,
+                listed
+            )
+            self.conn.commit()
+
+    def remember(self, bucket_name, keys):
+        """
+        Passes (key, etag) pairs through, recording each in the index.
+        """
+        for key, etag in keys:
+            self.record(bucket_name, key, etag)
+            yield key, etag
+
+    def list_keys(self, bucket_name, prefix, accept=None):
+        """
+        Yields the (key, etag) pairs recorded under a prefix by earlier runs, in key order.
+        LastModified is not recorded, so an offline run cannot filter on it.
+
+        :param accept: function deciding which keys to keep, or None for all of them.
+        """
+        prefix = prefix.lstrip('/')
+        last = ''
+        while True:
+            # One chunk at a time after the last key, so the index is not locked while keys are consumed
+            with self.lock:
+                rows = self.conn.execute(
+                    """
+                    SELECT key, etag FROM listings WHERE bucket = ? AND substr(key, 1, ?) = ? AND key > ?
+                    ORDER BY key LIMIT ?;
+                    """,
+                    (bucket_name, len(prefix), prefix, last, INDEX_BATCH)
+                ).fetchall()
+            if not rows:
+                return
+            for key, etag in rows:
+                if accept is None or accept(key):
+                    yield key, etag
+            last = rows[-1][0]
+
+    def stats(self):
+        hits, misses = CACHE_HITS.value, CACHE_MISSES.value
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+            "bytes_served": CACHE_BYTES_SERVED.value,
+            "evicted": CACHE_EVICTED.value,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        rate = f"{stats['hit_rate']:.1%}" if stats['hit_rate'] is not None else "n/a"
+        return (f"Object cache: {stats['hits']} hits, {stats['misses']} misses ({rate} hit rate), "
+                f"{stats['bytes_served'] / (1 << 20):.1f} MB served from disk, {stats['evicted']} evicted.")
+
+    def close(self):
+        self.flush_used()
+        with self.lock:
+            listed, self.listed = self.listed, []
+        if listed:
+            self.write_listed(listed)
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,214 @@
+import concurrent.futures
+import queue
+import threading
+import time
+
+from metrics import KEYS_LISTED, KEYS_SKIPPED, LIST_SECONDS, SHARDS_DISCOVERED, SHARDS_LISTED
+
+# A single list_objects_v2 paginator returns 1000 keys per round trip, one
+# after the other, so listing a large agency (or the whole bucket) is slow.
+# The bucket is laid out as agency/docket/..., so we first discover the
+# docket prefixes with Delimiter='/' and then list the dockets concurrently,
+# each page of keys going onto one shared queue as soon as it arrives.
+#
+# Comment keys always sit below agency/docket/, so keys directly under the
+# bucket root or an agency folder are not listed.
+
+# Depth of the docket prefixes: agency/docket/
+SHARD_DEPTH = 2
+
+
+def is_comment_key(key):
+    return key.endswith('.json') and 'comments' in key.split('/')
+
+
+def normalize_prefix(prefix):
+    # '/' (or '') means the whole bucket; keys never start with a slash
+    return prefix.lstrip('/')
+
+
+def shard_levels(prefix):
+    """
+    Number of Delimiter='/' levels between a prefix and the docket prefixes below it.
+    """
+    return max(0, SHARD_DEPTH - prefix.count('/'))
+
+
+class ShardProgress:
+    """
+    Keys listed per shard, shared by the listing threads or tasks.  Prints a line when a
+    shard finishes and, every report_interval seconds, the shards that have been listing
+    the longest, so a hot docket stands out.
+    """
+
+    def __init__(self, report_interval=30):
+        self.report_interval = report_interval
+        self.lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        self.active = {}
+        self.failures = []
+        self.last_report = time.monotonic()
+
+    def start(self, shards):
+        self.total = len(shards)
+        SHARDS_DISCOVERED.set(self.total)
+        print(f"Listing {self.total} shards.")
+
+    def begin(self, shard):
+        with self.lock:
+            self.active[shard] = [time.monotonic(), 0]
+
+    def listed(self, shard, count):
+        with self.lock:
+            self.active[shard][1] += count
+            now = time.monotonic()
+            if now - self.last_report < self.report_interval:
+                return
+            self.last_report = now
+            longest = sorted(self.active.items(), key=lambda item: item[1][0])[:5]
+        running = ", ".join(f"{name} {keys} keys {now - started:.0f}s" for name, (started, keys) in longest)
+        print(f"Listed {self.done}/{self.total} shards; still listing {running}")
+
+    def finish(self, shard, error=None):
+        with self.lock:
+            started, keys = self.active.pop(shard)
+            self.done += 1
+            done = self.done
+            if error is not None:
+                self.failures.append(shard)
+        SHARDS_LISTED.inc()
+        if error is not None:
+            print(f"Error listing shard {shard}: {error}")
+        else:
+            print(f"Listed shard {shard}: {keys} keys in {time.monotonic() - started:.1f}s ({done}/{self.total})")
+
+
+def child_prefixes(s3, bucket_name, prefix):
+    paginator = s3.get_paginator('list_objects_v2')
+    return [
+        common['Prefix']
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/')
+        for common in page.get('CommonPrefixes', [])
+    ]
+
+
+def discover_shards(s3, bucket_name, prefix, max_listers=16):
+    """
+    Expands a prefix into the docket prefixes below it, one Delimiter='/' level at a time.
+    A prefix without sub-folders is kept as a shard of its own.
+    """
+    shards = [normalize_prefix(prefix)]
+    for _ in range(shard_levels(shards[0])):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_listers) as executor:
+            children = list(executor.map(lambda shard: child_prefixes(s3, bucket_name, shard), shards))
+        shards = [child for shard, found in zip(shards, children) for child in (found or [shard])]
+    return shards
+
+
+def list_comment_pages(s3, bucket_name, prefix, since=None, accept=is_comment_key):
+    """
+    Yields the comment keys of each list_objects_v2 page under a prefix as a list of (key, etag).
+    Objects last modified before since are skipped.
+
+    :param accept: function deciding which keys to keep; defaults to comment JSON only.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    started = time.perf_counter()
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        LIST_SECONDS.observe(time.perf_counter() - started)
+        keys = []
+        for obj in page.get('Contents', []):
+            if not accept(obj['Key']):
+                continue
+            KEYS_LISTED.inc()
+            if since and obj['LastModified'] < since:
+                KEYS_SKIPPED.inc()
+                continue
+            keys.append((obj['Key'], obj['ETag']))
+        yield keys
+        # The next page is requested when the loop resumes
+        started = time.perf_counter()
+
+
+def fan_out(shards, list_pages, progress, max_workers=16):
+    """
+    Runs list_pages(shard) for every shard on up to max_workers threads and yields the
+    items of every page they produce, in no particular order.  Shared by the S3 lister
+    and the local directory scanner.
+
+    :param list_pages: function from a shard to an iterable of lists of items.
+    :param progress: ShardProgress, told when each shard starts, grows and finishes.
+    """
+    pending = queue.SimpleQueue()
+    for shard in shards:
+        pending.put(shard)
+    # Bounded, so listing only runs a little ahead of the workers
+    pages = queue.Queue(maxsize=max_workers * 4)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def lister():
+        try:
+            while not stopped.is_set():
+                try:
+                    shard = pending.get_nowait()
+                except queue.Empty:
+                    return
+                progress.begin(shard)
+                try:
+                    for items in list_pages(shard):
+                        progress.listed(shard, len(items))
+                        put(items)
+                except Exception as e:
+                    progress.finish(shard, e)
+                else:
+                    progress.finish(shard)
+        finally:
+            put(None)
+
+    threads = [
+        threading.Thread(target=lister, name=f"lister-{i}", daemon=True)
+        for i in range(min(max_workers, len(shards)))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(threads)
+        while remaining:
+            items = pages.get()
+            if items is None:
+                remaining -= 1
+                continue
+            yield from items
+    finally:
+        # Lets the listers exit if the consumer stops early
+        stopped.set()
+
+
+def list_comment_keys_sharded(s3, bucket_name, prefix, progress=None, since=None, max_listers=16,
+                              accept=is_comment_key):
+    """
+    Yields (key, etag) for every comment under a prefix, listing up to max_listers docket
+    prefixes at once.  Keys arrive in no particular order.
+
+    :param s3: boto3 S3 client.
+    :param prefix: agency or docket folder, or '' or '/' for the whole bucket.
+    :param progress: ShardProgress; after the generator is exhausted, progress.failures
+        holds the shards that could not be listed completely.
+    :param since: optional timezone-aware datetime; objects last modified before it are skipped.
+    :param accept: function deciding which keys to keep, e.g. a router's is_routed for
+        dockets and documents as well.
+    """
+    progress = progress or ShardProgress()
+    shards = discover_shards(s3, bucket_name, prefix, max_listers)
+    progress.start(shards)
+    yield from fan_out(shards, lambda shard: list_comment_pages(s3, bucket_name, shard, since, accept), progress,
+                       max_listers)
@@ -0,0 +1,145 @@
+import json
+
+import boto3
+import psycopg
+from psycopg.errors import Error
+
+from db_pool import READER_HOST
+
+# Full-text search over comments.  A stored generated column keeps a weighted
+# tsvector of each comment, so it is computed once when the row is written
+# rather than on every query:
+#
+#   title          A
+#   organization   B
+#   comment        C
+#
+# The GIN index over it is built after the bulk load, in one pass over the
+# finished table; once it exists, later merges maintain it row by row.
+#
+# Results are ranked with ts_rank and paged by keyset on (rank, id), so a later
+# page does not fetch, sort and discard the rows of an OFFSET.  It is not free:
+# the rank is computed rather than indexed, so every page still evaluates
+# ts_rank over every row the GIN index matches, and a broad query costs as much
+# per page as the number of its matches.
+
+SEARCH_CONFIG = "english"
+SEARCH_INDEX = "comments_search_idx"
+
+SEARCH_VECTOR = f"""(
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(organization, '')), 'B') ||
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(comment, '')), 'C')
+)"""
+
+RESULT_COLUMNS = ["id", "docketId", "agencyId", "title", "organization", "postedDate"]
+
+
+def create_search_index(conn):
+    """
+    Adds the search column to comments if it is missing, then builds its GIN index.
+    Run it after the bulk load: adding the column rewrites the table once, and the
+    index is built over the finished table instead of being updated per row.
+
+    :param conn: psycopg.Connection; comments must already exist.
+    :return: True if comments is searchable.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+            ALTER TABLE comments ADD COLUMN IF NOT EXISTS search tsvector
+            GENERATED ALWAYS AS {SEARCH_VECTOR} STORED;
+            """)
+            # A larger maintenance_work_mem lets the GIN build sort in memory
+            cur.execute("SET LOCAL maintenance_work_mem = '1GB';")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {SEARCH_INDEX} ON comments USING GIN (search);")
+        conn.commit()
+        print(f"Index '{SEARCH_INDEX}' ready.")
+        return True
+    except Error as e:
+        print(f"Error creating the search index: {e}")
+        conn.rollback()
+        return False
+
+
+def search_comments(conn, text, docket_id=None, agency_id=None, limit=20, after=None):
+    """
+    Ranked full-text search over comments, best match first.
+
+    :param conn: psycopg.Connection.
+    :param text: search terms in web search syntax: words, "quoted phrases", OR, -excluded.
+    :param docket_id: only search this docket.
+    :param agency_id: only search this agency.
+    :param limit: results per page.
+    :param after: the cursor returned with the previous page, or None for the first page.
+    :return: (results, cursor); results are dicts of RESULT_COLUMNS and rank, and cursor
+        is None once there are no more pages.
+    """
+    conditions = ["search @@ query"]
+    params = {"text": text, "limit": limit}
+    if docket_id is not None:
+        conditions.append("docketId = %(docket_id)s")
+        params["docket_id"] = docket_id
+    if agency_id is not None:
+        conditions.append("agencyId = %(agency_id)s")
+        params["agency_id"] = agency_id
+    page = ""
+    if after is not None:
+        # rank is a real; passing the previous page's value back as a real compares it exactly
+        page = "WHERE rank < %(rank)s::real OR (rank = %(rank)s::real AND id > %(id)s)"
+        params["rank"], params["id"] = after
+    columns = ", ".join(RESULT_COLUMNS)
+    query = f"""
+    SELECT {columns}, rank FROM (
+        SELECT {columns}, ts_rank(search, query) AS rank
+        FROM comments, websearch_to_tsquery('{SEARCH_CONFIG}', %(text)s) AS query
+        WHERE {" AND ".join(conditions)}
+    ) matches
+    {page}
+    ORDER BY rank DESC, id
+    LIMIT %(limit)s;
+    """
+    with conn.cursor() as cur:
+        cur.execute(query, params)
+        names = [column.name for column in cur.description]
+        results = [dict(zip(names, row)) for row in cur.fetchall()]
+    conn.commit()
+    cursor = None
+    if len(results) == limit:
+        cursor = (results[-1]["rank"], results[-1]["id"])
+    return results, cursor
+
+
+def main():
+    client = boto3.client('secretsmanager', region_name='us-east-1')
+    secret_name = "mirrulationsdb/postgres/master"
+    response = client.get_secret_value(SecretId=secret_name)
+    secret = json.loads(response['SecretString'])
+
+    conn_params = {
+        "dbname": "postgres",
+        "user": secret['username'],
+        "password": secret['password'],
+        "host": READER_HOST,
+        "port": "5432"
+    }
+
+    text = 'overtime "small business"'
+    # None searches every docket or agency
+    docket_id = None
+    agency_id = 'WHD'
+    pages = 3
+
+    with psycopg.connect(**conn_params) as conn:
+        cursor = None
+        for number in range(pages):
+            results, cursor = search_comments(conn, text, docket_id, agency_id, after=cursor)
+            print(f"Page {number + 1}:")
+            for result in results:
+                print(f"  {result['rank']:.4f} {result['id']} {result['title']}")
+            if cursor is None:
+                break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+import collections
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from compaction import arrow_schema, open_destination
+from copy_loader import copy_insert_rows
+from db_pool import create_connection_pool
+from entities import COMMENTS, create_entity_table
+from partitions import is_partitioned
+from rollups import create_rollup_tables
+
+# Where the rows of the list/fetch/parse pipeline end up.  A sink takes typed
+# rows in the entity's column order, as built for binary COPY:
+#
+#   write(rows, entity)   True once the rows are stored
+#   close()               True once everything written is durable
+#   workers               write-stage threads the sink can keep busy
+#
+# PostgresSink upserts into the database like the ingest scripts,
+# ParquetSink writes a dataset partitioned by agencyId and docketId,
+# SQLiteSink a single file for a laptop, and NullSink drops the rows, to
+# measure how fast the stages before it run.
+
+SQLITE_TYPES = {"int4": "INTEGER", "timestamp": "TEXT", "bool": "INTEGER", "text": "TEXT"}
+
+# Directory name of a NULL partition value, as Hive and Spark write it
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+class NullSink:
+    workers = 4
+
+    def write(self, rows, entity=COMMENTS):
+        return True
+
+    def close(self):
+        return True
+
+
+class PostgresSink:
+    """
+    Upserts rows into the entity's table with a binary COPY, maintaining the rollups.
+    A partitioned comments table is refused with ValueError.
+
+    :param conn_params: dict of keyword arguments for psycopg.connect, for the writer endpoint.
+    :param workers: write threads, each with its own connection.
+    :param on_conflict: 'update' rewrites comments whose contentHash changed, 'nothing' only adds new ones.
+    """
+
+    def __init__(self, conn_params, workers=8, on_conflict='update', entity=COMMENTS):
+        self.workers = workers
+        self.on_conflict = on_conflict
+        self.pool = create_connection_pool(conn_params, max_size=workers, name="export")
+        with self.pool.connection() as conn:
+            partitioned = entity is COMMENTS and is_partitioned(conn)
+            if not partitioned:
+                create_entity_table(conn, entity)
+                if entity is COMMENTS:
+                    create_rollup_tables(conn)
+        if partitioned:
+            # The partitioned parent has no unique index for ON CONFLICT (id)
+            self.pool.close()
+            raise ValueError("comments is partitioned; load it with ingest_comments_concurrent.py, which "
+                             "merges through the staging table")
+
+    def write(self, rows, entity=COMMENTS):
+        with self.pool.connection() as conn:
+            return copy_insert_rows(rows, conn, self.on_conflict, entity.table, entity) is not None
+
+    def close(self):
+        self.pool.close()
+        return True
+
+
+class SQLiteSink:
+    """
+    Upserts rows into a table of the same name in a local SQLite file.  Timestamps are
+    stored as ISO 8601 text and booleans as 0 or 1.
+
+    :param path: SQLite file; created if missing.
+    """
+
+    workers = 1
+
+    def __init__(self, path, entity=COMMENTS):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        columns = ",\n".join(
+            f"    {column} {SQLITE_TYPES[copy_type]}{' PRIMARY KEY' if column == 'id' else ''}"
+            for column, copy_type in zip(entity.columns, entity.copy_types)
+        )
+        updates = ", ".join(f"{column} = excluded.{column}" for column in entity.columns if column != "id")
+        self.query = f"""
+        INSERT INTO {entity.table} ({", ".join(entity.columns)}) VALUES ({", ".join(["?"] * len(entity.columns))})
+        ON CONFLICT (id) DO UPDATE SET {updates}
+        WHERE {entity.table}.contentHash IS NOT excluded.contentHash;
+        """
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("PRAGMA synchronous=NORMAL;")
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {entity.table} (\n{columns}\n);")
+            self.conn.commit()
+
+    def write(self, rows, entity=COMMENTS):
+        values = [tuple(value.isoformat(sep=" ") if isinstance(value, datetime) else value for value in row)
+                  for row in rows]
+        with self.lock:
+            try:
+                self.conn.executemany(self.query, values)
+                self.conn.commit()
+                return True
+            except sqlite3.Error as e:
+                print(f"Error writing records to {self.path}: {e}")
+                self.conn.rollback()
+                return False
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        return True
+
+
+class ParquetSink:
+    """
+    Writes a Parquet dataset laid out as <destination>/agencyId=<agency>/docketId=<docket>/part-*.parquet,
+    readable by pyarrow.dataset, DuckDB or Spark with Hive partitioning.  The partition columns
+    are in the directory names, not the files.
+
+    Rows are buffered per partition and written as a row group once a partition has
+    row_group_size of them.  When more than max_buffered_rows are buffered in all, the
+    largest buffer is written early, and at most max_open_files files are open at once (the
+    least recently used is finished and a later row starts a new part), so memory stays
+    bounded however large a docket is.
+
+    :param destination: local directory or s3://bucket/prefix URI; must be empty or missing.
+    """
+
+    workers = 1
+
+    def __init__(self, destination, row_group_size=50000, max_buffered_rows=500000, max_open_files=64,
+                 entity=COMMENTS, partition_by=("agencyId", "docketId")):
+        self.filesystem, self.root = open_destination(destination)
+        if self.filesystem.get_file_info(pafs.FileSelector(self.root, allow_not_found=True)):
+            raise ValueError(f"{destination} is not empty; export into a new directory")
+        self.row_group_size = row_group_size
+        self.max_buffered_rows = max_buffered_rows
+        self.max_open_files = max_open_files
+        self.partition_by = partition_by
+        self.partition_indexes = [entity.columns.index(column) for column in partition_by]
+        self.data_indexes = [index for index, column in enumerate(entity.columns) if column not in partition_by]
+        self.schema = pa.schema([field for field in arrow_schema(entity) if field.name not in partition_by])
+        # Part files of this run are named after it, so parallel exports never collide
+        self.run = uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.buffered = 0
+        self.writers = collections.OrderedDict()
+        self.parts = collections.Counter()
+        self.files = 0
+
+    def write(self, rows, entity=COMMENTS):
+        with self.lock:
+            try:
+                for row in rows:
+                    partition = tuple(row[index] for index in self.partition_indexes)
+                    buffer = self.buffers.setdefault(partition, [])
+                    buffer.append(row)
+                    self.buffered += 1
+                    if len(buffer) >= self.row_group_size:
+                        self.flush(partition)
+                while self.buffered > self.max_buffered_rows:
+                    self.flush(max(self.buffers, key=lambda partition: len(self.buffers[partition])))
+                return True
+            except (OSError, pa.ArrowException) as e:
+                print(f"Error writing records to {self.root}: {e}")
+                return False
+
+    def flush(self, partition):
+        rows = self.buffers.pop(partition)
+        self.buffered -= len(rows)
+        columns = list(zip(*rows))
+        table = pa.Table.from_arrays([pa.array(columns[index], type=field.type)
+                                      for index, field in zip(self.data_indexes, self.schema)], schema=self.schema)
+        self.writer(partition).write_table(table, row_group_size=self.row_group_size)
+
+    def writer(self, partition):
+        if partition in self.writers:
+            self.writers.move_to_end(partition)
+            return self.writers[partition][0]
+        if len(self.writers) >= self.max_open_files:
+            self.finish(*self.writers.popitem(last=False)[1])
+        directory = "/".join([self.root] + [
+            f"{column}={NULL_PARTITION if value is None else quote(str(value), safe='')}"
+            for column, value in zip(self.partition_by, partition)
+        ])
+        self.filesystem.create_dir(directory, recursive=True)
+        name = f"part-{self.run}-{self.parts[partition]:05d}.parquet"
+        self.parts[partition] += 1
+        # Dataset readers skip files starting with '.', so an unfinished local part stays invisible
+        local = isinstance(self.filesystem, pafs.LocalFileSystem)
+        path = f"{directory}/.{name}.tmp" if local else f"{directory}/{name}"
+        stream = self.filesystem.open_output_stream(path)
+        writer = pq.ParquetWriter(stream, self.schema, compression="zstd")
+        self.writers[partition] = (writer, stream, path, f"{directory}/{name}")
+        return writer
+
+    def finish(self, writer, stream, path, final):
+        writer.close()
+        stream.close()
+        if path != final:
+            self.filesystem.move(path, final)
+        self.files += 1
+
+    def close(self):
+        with self.lock:
+            try:
+                for partition in sorted(self.buffers, key=lambda partition: tuple(map(str, partition))):
+                    self.flush(partition)
+                while self.writers:
+                    self.finish(*self.writers.popitem(last=False)[1])
+            except (OSError, pa.ArrowException) as e:
+                print(f"Error finishing {self.root}: {e}")
+                return False
+        print(f"Wrote {self.files} Parquet files to {self.root}.")
+        return True
+
+
+def create_sink(name, output=None, conn_params=None, **options):
+    """
+    Builds a sink by name: 'postgres', 'parquet', 'sqlite' or 'null'.
+
+    :param output: the Parquet destination or SQLite file.
+    :param conn_params: connection parameters for 'postgres'.
+    :param options: keyword arguments passed on to the sink's constructor.
+    """
+    if name == 'postgres':
+        return PostgresSink(conn_params, **options)
+    if name == 'parquet':
+        return ParquetSink(output, **options)
+    if name == 'sqlite':
+        return SQLiteSink(output, **options)
+    if name == 'null':
+        return NullSink()
+    raise ValueError(f"Unknown sink '{name}'")
@@ -0,0 +1,188 @@
+import uuid
+
+from psycopg.errors import Error
+
+from copy_loader import COMMENT_COLUMNS, conflict_clause, record_upsert
+from rollups import RETURNING as ROLLUP_RETURNING, recompute_rollups, rollup_ctes
+
+# Batches are written to an UNLOGGED table with no indexes, so loading pays
+# neither WAL nor primary key maintenance.  One set-based statement at the end
+# of the run moves everything into comments.
+#
+# The staging table survives client crashes, so a resumed run merges what the
+# previous run staged.  An unlogged table is emptied if the database itself
+# crashes or fails over.  A token kept in a second unlogged table is emptied
+# with it, so comparing the token with the one in the checkpoint shows when
+# keys checkpointed as staged have lost their rows (see
+# CheckpointStore.check_staging).
+
+STAGING_TABLE = "comments_staging"
+STAGING_TOKEN_TABLE = "comments_staging_token"
+
+
+def create_staging_table(conn, reset=False):
+    """
+    Creates the staging table with the columns of comments but no keys or indexes.
+
+    :param conn: psycopg.Connection; the comments table must already exist.
+    :param reset: drop rows left over from an earlier run.
+    """
+    try:
+        with conn.cursor() as cur:
+            if reset:
+                cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+                cur.execute(f"DROP TABLE IF EXISTS {STAGING_TOKEN_TABLE};")
+            cur.execute(f"""
+            CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE}
+            (LIKE comments INCLUDING DEFAULTS);
+            """)
+            cur.execute(f"CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TOKEN_TABLE} (token TEXT NOT NULL);")
+            # Staging tables created before contentHash existed
+            cur.execute(f"ALTER TABLE {STAGING_TABLE} ADD COLUMN IF NOT EXISTS contentHash TEXT;")
+            conn.commit()
+            print(f"Table '{STAGING_TABLE}' ready.")
+    except Error as e:
+        print(f"An error occurred: {e}")
+        conn.rollback()
+
+
+def staging_token(conn):
+    """
+    Returns the token of the rows in the staging table, creating one if there is none, as
+    after a database crash emptied the unlogged tables.
+
+    :return: the token, or None if it could not be read.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT token FROM {STAGING_TOKEN_TABLE};")
+            row = cur.fetchone()
+            if row is None:
+                row = (uuid.uuid4().hex,)
+                cur.execute(f"INSERT INTO {STAGING_TOKEN_TABLE} (token) VALUES (%s);", row)
+        conn.commit()
+        return row[0]
+    except Error as e:
+        print(f"Error reading the {STAGING_TABLE} token: {e}")
+        conn.rollback()
+        return None
+
+
+def check_checkpoint(conn, checkpoint, merged=False):
+    """
+    Forgets the keys a CheckpointStore holds as staged if their rows were lost with the staging
+    table, or with merged=True marks them merged; see CheckpointStore.check_staging.
+    """
+    token = staging_token(conn)
+    if token is None:
+        return
+    lost = checkpoint.check_staging(token, merged)
+    if lost:
+        print(f"{STAGING_TABLE} was emptied by a database restart or failover after {lost} keys were staged; "
+              f"they will be ingested again.")
+
+
+def merge_statement(target='comments', on_conflict='update', where='TRUE', rollups=True, insert_where='TRUE'):
+    """
+    Builds the INSERT ... SELECT DISTINCT ON (id) that moves staged rows into target.
+    When an id is staged more than once the row with the latest modifyDate wins.
+    The statement returns one row with the inserted, updated and distinct staged counts.
+
+    :param target: comments, or one of its partitions.
+    :param on_conflict: 'update' rewrites existing comments whose content hash changed,
+        'nothing' keeps existing comments as they are.
+    :param where: SQL condition selecting which staged rows to merge.
+    :param rollups: also apply the merged rows to the rollup tables (see rollups.py).
+    :param insert_where: SQL condition on the deduplicated rows (CTE staged) deciding which
+        are inserted; the others count as skipped.
+    """
+    columns = ", ".join(COMMENT_COLUMNS)
+    returning = f"{ROLLUP_RETURNING}, " if rollups else ""
+    ctes = rollup_ctes(target, "staged", on_conflict) if rollups else ""
+    # xmax is 0 only on freshly inserted row versions
+    return f"""
+    WITH staged AS (
+        SELECT DISTINCT ON (id) {columns} FROM {STAGING_TABLE}
+        WHERE {where}
+        ORDER BY id, modifyDate DESC NULLS LAST
+    ), merged AS (
+        INSERT INTO {target} AS existing ({columns})
+        SELECT {columns} FROM staged WHERE {insert_where}
+        {conflict_clause(on_conflict)}
+        RETURNING {returning}(xmax = 0) AS inserted
+    ){ctes}
+    SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted), (SELECT COUNT(*) FROM staged)
+    FROM merged;
+    """
+
+
+def merge_staging(conn, on_conflict='update'):
+    """
+    Moves the staged rows into comments in one INSERT ... SELECT DISTINCT ON (id).
+
+    :param on_conflict: 'update' rewrites existing comments whose content hash changed,
+        'nothing' keeps existing comments as they are.
+    :return: (inserted, updated, skipped) counts, or None if the merge failed.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {STAGING_TABLE};")
+            staged_count = cur.fetchone()[0]
+            cur.execute(merge_statement('comments', on_conflict))
+            inserted, updated, distinct = cur.fetchone()
+            cur.execute(f"TRUNCATE {STAGING_TABLE};")
+        conn.commit()
+    except Error as e:
+        print(f"Error merging {STAGING_TABLE}: {e}")
+        conn.rollback()
+        return None
+    skipped = staged_count - inserted - updated
+    outcome = record_upsert(on_conflict, distinct, inserted, updated)
+    print(f"Merged {staged_count} staged records: {outcome}, {staged_count - distinct} staged more than once.")
+    return inserted, updated, skipped
+
+
+def swap_staging(conn):
+    """
+    Replaces comments with the deduplicated staged rows, for a full reload.
+    The primary key is built once over the finished table instead of row by row,
+    and the rollups are recomputed from it in the same transaction.
+
+    :return: (inserted, updated, skipped) counts, or None if the swap failed.
+    """
+    columns = ", ".join(COMMENT_COLUMNS)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {STAGING_TABLE};")
+            staged_count = cur.fetchone()[0]
+            cur.execute("DROP TABLE IF EXISTS comments_swap;")
+            cur.execute(f"""
+            CREATE TABLE comments_swap AS
+            SELECT DISTINCT ON (id) {columns} FROM {STAGING_TABLE}
+            ORDER BY id, modifyDate DESC NULLS LAST;
+            """)
+            inserted = cur.rowcount
+            cur.execute("ALTER TABLE comments_swap ADD PRIMARY KEY (id);")
+            cur.execute("DROP TABLE IF EXISTS comments;")
+            cur.execute("ALTER TABLE comments_swap RENAME TO comments;")
+            cur.execute("ALTER INDEX comments_swap_pkey RENAME TO comments_pkey;")
+            cur.execute(f"DROP TABLE {STAGING_TABLE};")
+            recompute_rollups(cur)
+        conn.commit()
+    except Error as e:
+        print(f"Error swapping {STAGING_TABLE} into comments: {e}")
+        conn.rollback()
+        return None
+    skipped = staged_count - inserted
+    outcome = record_upsert('nothing', inserted, inserted, 0)
+    print(f"Swapped in {staged_count} staged records: {outcome}, {skipped} staged more than once.")
+    return inserted, 0, skipped
+
+
+def finish_staging(conn, full_reload=False, on_conflict='update'):
+    """
+    Publishes the staged rows: a table swap for a full reload, otherwise a merge.
+    """
+    if full_reload:
+        return swap_staging(conn)
+    return merge_staging(conn, on_conflict)
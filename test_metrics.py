@@ -0,0 +1,83 @@
+import re
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import Histogram, Registry, start_metrics_server
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? (\S+)$')
+
+
+def parse_exposition(text):
+    """
+    Returns (help and type lines per name, samples as (name, labels, value)) of exposition text.
+    """
+    comments = {}
+    samples = []
+    for line in text.splitlines():
+        if line.startswith("# "):
+            kind, name = line.split(" ")[1:3]
+            comments.setdefault(name, []).append(kind)
+            continue
+        match = SAMPLE.match(line)
+        assert match, f"not a sample line: {line!r}"
+        labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2) or ""))
+        samples.append((match.group(1), labels, float(match.group(3))))
+    return comments, samples
+
+
+def test_render_is_valid_exposition():
+    registry = Registry()
+    registry.counter("keys_total", "Keys").inc(3)
+    registry.gauge("depth", "Queue depth").set(2)
+    for stage, values in (("fetch", (0.002, 0.02, 0.2, 120)), ("insert", (0.5,))):
+        histogram = registry.histogram("stage_seconds", "Seconds per stage", stage=stage)
+        for value in values:
+            histogram.observe(value)
+
+    text = registry.render()
+    assert text.endswith("\n")
+    comments, samples = parse_exposition(text)
+    # One HELP and one TYPE per name, even with several label sets
+    assert comments == {name: ["HELP", "TYPE"] for name in ("depth", "keys_total", "stage_seconds")}
+    assert "# TYPE stage_seconds histogram" in text
+
+    for stage, count in (("fetch", 4), ("insert", 1)):
+        buckets = [(labels["le"], value) for name, labels, value in samples
+                   if name == "stage_seconds_bucket" and labels["stage"] == stage]
+        assert buckets[-1][0] == "+Inf"
+        counts = [value for _, value in buckets]
+        assert counts == sorted(counts)
+        assert counts[-1] == count
+        assert ("stage_seconds_count", {"stage": stage}, count) in samples
+    assert ("keys_total", {}, 3) in samples
+
+
+def test_quantile_interpolates_inside_the_bucket():
+    histogram = Histogram((), buckets=(1.0, 2.0, 4.0))
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 0.5, 1.5, 1.5):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == pytest.approx(1.0)
+    assert histogram.quantile(0.75) == pytest.approx(1.5)
+    assert histogram.quantile(0.25) == pytest.approx(0.5)
+
+
+def test_quantile_above_the_largest_bucket_is_capped():
+    histogram = Histogram((), buckets=(1.0, 2.0))
+    histogram.observe(30.0)
+    assert histogram.quantile(0.99) == 2.0
+
+
+def test_metrics_endpoint_serves_the_registry():
+    server = start_metrics_server(port=0)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            parse_exposition(response.read().decode("utf-8"))
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other")
+    finally:
+        server.shutdown()